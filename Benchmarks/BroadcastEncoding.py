@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import Protocol
+
+"""
+Micro-benchmark of the broadcast path: the old one (json.dumps per message,
+json.loads into the history, json.dumps of the whole history on replay)
+against Protocol.Message, which is encoded once and reused for fan-out,
+history and replay.
+
+Run with "python BroadcastEncoding.py".
+"""
+
+RECIPIENTS = (1, 100, 10000)
+HISTORY = 1000
+CONTENT = u"Hei p\xe5 deg, dette er en helt vanlig chatmelding"
+
+
+class Sink(object):
+    """Stands in for a client's send(); only counts bytes"""
+
+    def __init__(self):
+        self.bytes = 0
+
+    def send(self, data):
+        self.bytes += len(data)
+
+
+def old_broadcast(history, recipients):
+    msg = json.dumps({'content': CONTENT, 'sender': u"alice", 'response': "message",
+                      'timestamp': "1457700000"}) + "\n"
+    history.append(json.loads(msg))
+    for sink in recipients:
+        sink.send(msg)
+
+
+def new_broadcast(history, recipients):
+    message = Protocol.Message(u"alice", CONTENT, "1457700000")
+    history.append(message.frame)
+    for sink in recipients:
+        sink.send(message.frame)
+
+
+def old_replay(history):
+    return json.dumps({'content': history, 'sender': "server", 'response': "history",
+                       'timestamp': "1457700000"}) + "\n"
+
+
+def new_replay(history):
+    header = Protocol.encode({'content': [], 'count': len(history), 'sender': "server",
+                              'response': "history", 'timestamp': "1457700000"})
+    return header + b''.join(history)
+
+
+def per_call(function, args, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        function(*args)
+    return (time.time() - start) / repeat
+
+
+def main():
+    print("%-12s %14s %14s %8s" % ("recipients", "old (us/msg)", "new (us/msg)", "speedup"))
+    for count in RECIPIENTS:
+        recipients = [Sink() for _ in range(count)]
+        repeat = max(10, 200000 // count)
+        old = per_call(old_broadcast, ([], recipients), repeat)
+        new = per_call(new_broadcast, ([], recipients), repeat)
+        print("%-12d %14.2f %14.2f %7.2fx" % (count, old * 1e6, new * 1e6, old / new))
+
+    old_history, new_history = [], []
+    for _ in range(HISTORY):
+        old_broadcast(old_history, [])
+        new_broadcast(new_history, [])
+    old = per_call(old_replay, (old_history,), 200)
+    new = per_call(new_replay, (new_history,), 200)
+    print("")
+    print("History replay of %d messages: old %.1f us, new %.1f us (%.1fx)" % (
+        HISTORY, old * 1e6, new * 1e6, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+import os
+import sys
+import json
+import argparse
+
+import LoadGen
+
+"""
+Write coalescing of Server/Server.py: runs a LoadGen scenario once per
+--coalesce-window and engine, and reports next to each other what the
+clients got and how many socket writes the server needed for it.
+
+    python Coalescing.py [scenarios/busy-room.json] [--windows 0,0.001,0.002,0.005]
+
+The scenario must start Server/Server.py with a metrics port, like
+scenarios/busy-room.json. A window of 0 is one write per frame, unless
+frames happened to queue up while the previous write was going on.
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Socket writes and latency per coalescing window")
+    parser.add_argument('scenario', nargs='?', default=os.path.join(HERE, 'scenarios', 'busy-room.json'))
+    parser.add_argument('--windows', default='0,0.001,0.002,0.005', help="comma separated seconds")
+    parser.add_argument('--engines', default='threaded,event')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help="override a scenario key; VALUE is JSON")
+    args = parser.parse_args()
+    LoadGen.raise_fd_limit()
+
+    print("%-9s %8s %12s %12s %12s %10s %10s %6s" % ("engine", "window", "delivered/s", "writes/s",
+                                                      "writes/msg", "p50 (ms)", "p99 (ms)", "CPU"))
+    for engine in args.engines.split(','):
+        for window in args.windows.split(','):
+            scenario = LoadGen.load_scenario(args.scenario, args.set)
+            scenario['server'] = dict(scenario['server'])
+            scenario['server']['args'] = scenario['server']['args'] + ['--engine', engine,
+                                                                       '--coalesce-window', window]
+            server = LoadGen.ServerProcess(scenario)
+            try:
+                result = LoadGen.run(scenario, server.pid)
+            finally:
+                server.stop()
+            if result['server_writes'] is None:
+                sys.exit("The scenario's server has no metrics port")
+            print("%-9s %8s %12.0f %12.0f %12.3f %10.2f %10.2f %5.0f%%" % (
+                engine, window, result['delivered_per_second'], result['server_writes'] / scenario['duration'],
+                result['server_writes'] / max(1, result['delivered']), result['latency_ms']['p50'],
+                result['latency_ms']['p99'], result['server_cpu_percent']))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
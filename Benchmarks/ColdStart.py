@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import subprocess
+from threading import Thread, Event
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import MessageLog
+import Protocol
+
+"""
+Start time of Server/Server.py against the size of its history, from a
+message log of that many messages in one room:
+
+    cold            no snapshot: every room's search index is rebuilt from the log
+    warm            from the snapshot of the server before, nothing to replay
+    warm + tail     from that snapshot, with --tail messages logged after it
+
+A start is timed from starting the process to the answer to a login. The
+snapshot comes from a handoff (kill -USR2) of the cold server, during which
+a client connects and logs in again and again:
+
+    handoff (ms)    the longest a connection waited for its login answer
+    refused         connections that were refused or reset (should be 0)
+
+Run with "python ColdStart.py [--messages 10000 100000 1000000]", on Linux.
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(HERE, os.pardir, 'Server')
+PORT = 9917
+WORDS = (u"hei jeg du vi er har ikke det som p\xe5 med til en skal kan bare n\xe5 hva lab "
+         u"oving server klient melding socket tr\xe5d kommer snart takk ok haha lol "
+         u"the server is down again did you push the fix yes no maybe later").split()
+RARE = 50000
+
+
+def fill(directory, start, count):
+    """Appends count messages to the log of room "all" in directory"""
+    rng = random.Random(start)
+    log = MessageLog.MessageLog(os.path.join(directory, MessageLog.room_directory(u"all")))
+    for i in range(start, start + count):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(2, 15))] + [u"w%dx" % rng.randrange(RARE)]
+        log.append(Protocol.Message(u"user%d" % (i % 50), u" ".join(words), str(1457700000 + i)).frame)
+    log.sync()
+    log.close()
+
+
+def login(timeout=60.0):
+    """Seconds until a connection gets the answer to a login, None if it was refused or reset"""
+    started = time.time()
+    try:
+        sock = socket.create_connection(('127.0.0.1', PORT), timeout)
+        sock.settimeout(timeout)
+        sock.sendall(Protocol.encode({'request': 'login', 'content': u"probe"}))
+        answered = bool(sock.recv(4096))
+        sock.close()
+    except socket.error:
+        return None
+    return time.time() - started if answered else None
+
+
+def start(directory):
+    """(process, seconds until it answered a login)"""
+    started = time.time()
+    process = subprocess.Popen([sys.executable, 'Server.py', '--port', str(PORT), '--data-dir', directory,
+                                '--log-level', 'WARNING', '--snapshot-interval', '3600'], cwd=SERVER)
+    while login() is None:
+        if process.poll() is not None:
+            sys.exit("The server exited with %d" % process.returncode)
+        time.sleep(0.01)
+    return process, time.time() - started
+
+
+def stop(process):
+    process.send_signal(signal.SIGTERM)
+    process.wait()
+
+
+def successor():
+    """The pid of the server that took over the port"""
+    out = subprocess.check_output(['pgrep', '-f', 'Server.py --port %d' % PORT]).split()
+    return int(out[0])
+
+
+def hand_over(process):
+    """(longest login during a handoff in seconds, refused) while process hands over to a new server"""
+    waits, done = [], Event()
+
+    def probe():
+        while not done.is_set():
+            waits.append(login())
+            time.sleep(0.002)
+    prober = Thread(target=probe)
+    prober.start()
+    time.sleep(0.2)
+    process.send_signal(signal.SIGUSR2)
+    process.wait()
+    time.sleep(0.5)
+    done.set()
+    prober.join()
+    os.kill(successor(), signal.SIGTERM)
+    time.sleep(0.5)
+    return max(wait for wait in waits if wait is not None), waits.count(None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server start time against history size, with and without snapshot")
+    parser.add_argument('--messages', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--tail', type=int, default=10000, help="messages logged after the snapshot")
+    args = parser.parse_args()
+
+    print("%10s %10s %12s %10s %14s %14s %9s" % ("messages", "cold (s)", "snapshot", "warm (s)",
+                                                 "warm+tail (s)", "handoff (ms)", "refused"))
+    for count in args.messages:
+        directory = tempfile.mkdtemp(prefix='coldstart')
+        try:
+            fill(directory, 0, count)
+            process, cold = start(directory)
+            longest, refused = hand_over(process)
+            size = os.path.getsize(os.path.join(directory, 'snapshot'))
+            process, warm = start(directory)
+            stop(process)
+            fill(directory, count, args.tail)
+            process, tail = start(directory)
+            stop(process)
+        finally:
+            shutil.rmtree(directory)
+        print("%10d %10.2f %11.1fM %10.2f %14.2f %14.0f %9d" % (count, cold, size / 2 ** 20, warm, tail,
+                                                               longest * 1000, refused))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+import os
+import sys
+import time
+import socket
+import argparse
+import multiprocessing
+from threading import Thread
+
+import LoadGen
+
+"""
+What one flooding client does to the rest of its room: runs a LoadGen
+scenario while a "flooder" in the same room sends messages as fast as the
+server takes them, once with the server's request limits and once without
+(--connection-rate none --command-rate message=none), and reports the
+latency the well-behaved clients saw and how many requests were throttled.
+
+    python Flood.py [scenarios/busy-room.json] [--set rate=1]
+
+The scenario must start Server/Server.py with a metrics port. The flooder
+reads everything it is sent, so it is not dropped as a slow consumer.
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+UNLIMITED = ['--connection-rate', 'none', '--command-rate', 'message=none']
+BATCH = 100             # Messages per sendall of the flooder
+
+
+def flood(scenario, stop, sent):
+    sock = socket.create_connection((scenario['host'], scenario['port']))
+    sock.sendall(LoadGen.encode('login', u"flooder"))
+
+    def drain():
+        try:
+            while sock.recv(1 << 16):
+                pass
+        except socket.error:
+            pass
+    reader = Thread(target=drain)
+    reader.daemon = True
+    reader.start()
+    batch = LoadGen.encode('message', u"flood " + u"x" * max(0, scenario['size'] - 6)) * BATCH
+    try:
+        while not stop.is_set():
+            sock.sendall(batch)
+            sent.value += BATCH
+    except socket.error:
+        pass            # Disconnected for flooding
+    sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Room latency next to a flooding client, with and without limits")
+    parser.add_argument('scenario', nargs='?', default=os.path.join(HERE, 'scenarios', 'busy-room.json'))
+    parser.add_argument('--set', action='append', default=['rate=1.0'], metavar='KEY=VALUE',
+                        help="override a scenario key; VALUE is JSON (default rate=1.0)")
+    args = parser.parse_args()
+    LoadGen.raise_fd_limit()
+
+    print("%-9s %12s %12s %10s %10s %10s" % ("limits", "flood sent", "throttled", "p50 (ms)", "p99 (ms)", "CPU"))
+    for name, extra in (("on", []), ("off", UNLIMITED)):
+        scenario = LoadGen.load_scenario(args.scenario, args.set)
+        scenario['server'] = dict(scenario['server'])
+        scenario['server']['args'] = scenario['server']['args'] + extra
+        server = LoadGen.ServerProcess(scenario)
+        stop, sent = multiprocessing.Event(), multiprocessing.Value('l', 0)
+        flooder = multiprocessing.Process(target=flood, args=(scenario, stop, sent))
+        try:
+            flooder.start()
+            result = LoadGen.run(scenario, server.pid)
+            metrics = LoadGen.scrape(scenario)
+        finally:
+            stop.set()
+            flooder.join(10)
+            server.stop()
+        if metrics is None:
+            sys.exit("The scenario's server has no metrics port")
+        throttled = sum(value for key, value in metrics.items() if key.startswith('requests_throttled'))
+        print("%-9s %12d %12d %10.2f %10.2f %9.0f%%" % (name, sent.value, throttled, result['latency_ms']['p50'],
+                                                       result['latency_ms']['p99'], result['server_cpu_percent']))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import zlib
+import random
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import Protocol
+
+"""
+Bytes on the wire and CPU time of replaying a 10k message history, raw and
+over the per-connection zlib stream of Protocol.Compressor:
+
+    raw             the frames as they are
+    one piece       the whole history as one compressed write
+    pages of 50     one write per history page, on one stream
+    per message     every frame its own write, on one stream (threshold 0)
+    no stream       every frame compressed on its own, no shared dictionary
+
+Server CPU is the time to compress, client CPU the time for a StreamDecoder
+to turn what arrives into payloads. Done for both encodings.
+
+Run with "python HistoryCompression.py [messages]", on either Python.
+"""
+
+MESSAGES = 10000
+PAGE = 50
+SENDERS = [u"user%d" % i for i in range(20)]
+WORDS = (u"hei jeg du vi er har ikke det som p\xe5 med til en skal kan bare n\xe5 hva lab "
+         u"oving server klient melding socket tr\xe5d kommer snart takk ok haha lol "
+         u"the server is down again did you push the fix yes no maybe later").split()
+
+clock = getattr(time, 'process_time', None) or time.clock
+
+
+def history(count):
+    rng = random.Random(1)
+    for i in range(count):
+        content = u" ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 20)))
+        yield Protocol.Message(rng.choice(SENDERS), content, str(1457700000 + i))
+
+
+def json_frames(messages):
+    return [message.frame for message in messages]
+
+
+def binary_frames(messages):
+    interner, known, frames = Protocol.Interner(), set(), []
+    for message in messages:
+        sender_id = interner.id(message.sender)
+        frame = message.binary(sender_id)
+        if sender_id not in known:
+            known.add(sender_id)
+            frame = Protocol.encode_binary(Protocol.SENDER, sender_id, 0, message.sender) + frame
+        frames.append(frame)
+    return frames
+
+
+def pieces(frames, size):
+    """The frames joined into writes of size frames each"""
+    return [b''.join(frames[i:i + size]) for i in range(0, len(frames), size)]
+
+
+def streamed(writes):
+    compressor = Protocol.Compressor(threshold=0)
+    return [compressor.wrap(write) for write in writes]
+
+
+def decode(wire):
+    decoder = Protocol.StreamDecoder()
+    return sum(len(decoder.feed(write)) for write in wire)
+
+
+def timed(function, *args):
+    start = clock()
+    result = function(*args)
+    return result, clock() - start
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+    messages = list(history(count))
+    print("%-8s %-14s %12s %8s %12s %12s" % ("format", "case", "wire bytes", "ratio", "server (ms)", "client (ms)"))
+    for name, frames in (("json", json_frames(messages)), ("binary", binary_frames(messages))):
+        raw = sum(len(frame) for frame in frames)
+        for case, make in (("raw", lambda: frames),
+                           ("one piece", lambda: streamed(pieces(frames, len(frames)))),
+                           ("pages of %d" % PAGE, lambda: streamed(pieces(frames, PAGE))),
+                           ("per message", lambda: streamed(frames)),
+                           ("no stream", lambda: [zlib.compress(frame) for frame in frames])):
+            wire, server = timed(make)
+            size = sum(len(write) for write in wire)
+            if case == "no stream":
+                client = "-"
+            else:
+                decoded, seconds = timed(decode, wire)
+                assert decoded == count, (case, decoded)
+                client = "%.1f" % (seconds * 1e3)
+            print("%-8s %-14s %12d %7.2fx %12.1f %12s" % (name, case, size, raw / float(size), server * 1e3, client))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+import os
+import sys
+import time
+import random
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import History
+import Protocol
+
+"""
+Memory of a room's in-memory history, kept as frames (RoomHistory) and as
+compact records (CompactHistory), for the messages of Server.py (epoch
+timestamps) and of daniel-stuff (date and time, and a seq):
+
+    bytes/msg       growth of the resident set per message kept
+    append (us)     time to store one message
+    page (us)       time to page 50 messages, the work of a history request
+
+Every history is filled in a child process of its own, so what one leaves
+behind is not counted for the next. Both kinds must page the same frames.
+
+Run with "python HistoryMemory.py [messages]", on either Python, on Linux.
+"""
+
+MESSAGES = 100000
+PAGE = 50
+PAGES = 2000
+SENDERS = [u"user%d" % i for i in range(20)]
+WORDS = (u"hei jeg du vi er har ikke det som p\xe5 med til en skal kan bare n\xe5 hva lab "
+         u"oving server klient melding socket tr\xe5d kommer snart takk ok haha lol "
+         u"the server is down again did you push the fix yes no maybe later").split()
+STYLES = ('Server.py', 'daniel-stuff')
+
+clock = getattr(time, 'perf_counter', None) or time.time
+
+
+def messages(style, count):
+    rng = random.Random(1)
+    for i in range(count):
+        content = u" ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 20)))
+        if style == 'Server.py':
+            yield Protocol.Message(rng.choice(SENDERS), content, str(1457700000 + i))
+        else:
+            stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1457700000 + i))
+            yield Protocol.Message(rng.choice(SENDERS), content, stamp, seq=i)
+
+
+def rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def measure(kind, style, count, out):
+    """Child: fills a history and writes "bytes/msg append page checksum" to out"""
+    before = rss()
+    history = kind(count)
+    started = clock()
+    for message in messages(style, count):
+        history.append(message)
+    appended = clock() - started
+    used = rss() - before
+    rng = random.Random(2)
+    started = clock()
+    checksum = 0
+    for _ in range(PAGES):
+        frames, _ = history.page(rng.randint(PAGE, count), PAGE)
+        checksum = (checksum * 31 + hash(b''.join(frames))) & 0xffffffff
+    paged = clock() - started
+    os.write(out, ("%f %f %f %d" % (used / count, appended / count * 1e6, paged / PAGES * 1e6, checksum))
+             .encode('ascii'))
+
+
+def run(kind, style, count):
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            measure(kind, style, count, write)
+        finally:
+            os._exit(0)
+    os.close(write)
+    result = os.read(read, 256).decode('ascii').split()
+    os.close(read)
+    os.waitpid(pid, 0)
+    return [float(value) for value in result[:3]] + [int(result[3])]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else MESSAGES
+    print("%d messages per history, pages of %d\n" % (count, PAGE))
+    print("%-14s %-16s %12s %12s %12s" % ("messages", "history", "bytes/msg", "append (us)", "page (us)"))
+    for style in STYLES:
+        checksums = set()
+        for kind in (History.RoomHistory, History.CompactHistory):
+            used, append, page, checksum = run(kind, style, count)
+            checksums.add(checksum)
+            print("%-14s %-16s %12.1f %12.2f %12.1f" % (style, kind.__name__, used, append, page))
+        if len(checksums) != 1:
+            sys.exit("The histories paged different frames")
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
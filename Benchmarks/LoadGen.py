@@ -0,0 +1,617 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+import os
+import re
+import sys
+import json
+import time
+import errno
+import heapq
+import random
+import select
+import shutil
+import socket
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from array import array
+try:
+    from Queue import Empty
+    from urllib2 import urlopen
+except ImportError:
+    from queue import Empty
+    from urllib.request import urlopen
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import Protocol
+
+"""
+Load generator and benchmark harness for the chat servers.
+
+A scenario file (see scenarios/) says which server to start and what the
+simulated clients do. The clients are spread over a few generator processes,
+each of which drives its share from one epoll loop, so thousands of clients
+cost no more than a handful of processes. They speak the protocol of
+Client.Client: log in, change chatroom if the scenario has more than one room,
+then send messages at a fixed rate per client and read everything the server
+sends them.
+
+Reported:
+
+    messages/s          sent by the clients and delivered to them
+    fan-out latency     from a message being sent to it arriving at each
+                        member of the room, p50/p99/p999 (every message carries
+                        its send time; the generators share the machine's clock)
+    login latency       from connecting to having received the login history,
+                        for every client, and for "probe" logins done while
+                        the load runs, next to how many messages had been sent
+    server CPU and RSS  of the server process and its children, from /proc
+    server writes       socket writes the server made while the load ran,
+                        from its metrics endpoint, if the scenario has a
+                        metrics_port
+
+Linux only (epoll, /proc). Run it with the Python the server runs on:
+
+    python LoadGen.py scenarios/one-big-room.json [--output result.json]
+
+Any scenario key can be overridden on the command line, e.g.
+"--set clients=2000 --set duration=30".
+"""
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+DEFAULTS = {
+    'server': {'script': 'Server/Server.py', 'args': ['--in-memory', '--port', '{port}'], 'files': {}},
+    'host': '127.0.0.1',
+    'port': 9990,
+    'processes': 4,         # Generator processes
+    'clients': 100,
+    'rooms': 1,             # More than one: clients change to room0, room1, ... after login
+    'connect_rate': 500,    # Clients connecting per second, over all generators; 0 for all at once
+    'rate': 1.0,            # Messages per second per client
+    'size': 64,             # Bytes of content per message
+    'duration': 10.0,       # Seconds of sending
+    'drain': 2.0,           # Seconds to wait for messages still in flight
+    'history': 0,           # Messages sent before the clients log in
+    'login_probes': 0,      # Logins timed while the load runs
+    'setup_timeout': 120.0,
+    'metrics_port': None,   # Where the server serves its metrics; "{metrics_port}" in the server args
+}
+
+CONNECTING, LOGIN, JOIN, READY, DEAD = range(5)
+
+_MESSAGE = b'"response": "message"'
+_STAMP = re.compile(br'"content": "@([0-9.]+) ')
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def encode(request, content=None):
+    return Protocol.encode({'request': request, 'content': content})
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return float('nan')
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class SimClient(object):
+    """One simulated client, driven by a generator's loop"""
+
+    def __init__(self, name, room):
+        self.name = name
+        self.room = room
+        self.sock = None
+        self.state = CONNECTING
+        self.decoder = Protocol.FrameDecoder()
+        self.skip = 0           # History frames still to come
+        self.started = None
+        self.ready_at = None
+        self.out = b''          # Written but not yet taken by the socket
+
+    def connect(self, address):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.started = time.time()
+        code = self.sock.connect_ex(address)
+        if code not in (0, errno.EINPROGRESS):
+            raise socket.error(code, os.strerror(code))
+
+    def write(self, data):
+        self.out += data
+        self.flush()
+
+    def flush(self):
+        try:
+            sent = self.sock.send(self.out)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        self.out = self.out[sent:]
+
+
+class Generator(object):
+    """
+    Drives a share of the clients. Runs in a process of its own; results go
+    back to the harness through a queue.
+    """
+
+    def __init__(self, scenario, clients):
+        self.scenario = scenario
+        self.address = (scenario['host'], scenario['port'])
+        self.clients = [SimClient(name, room) for name, room in clients]
+        self.by_fd = {}
+        self.epoll = select.epoll()
+        self.sent = {}          # room : messages sent
+        self.delivered = 0
+        self.errors = []
+        self.logins = array('d')
+        self.latency = array('d')
+
+    def run(self, ready, go, results, sent_counter):
+        raise_fd_limit()
+        self.setup()
+        ready.put(sum(1 for client in self.clients if client.state == READY))
+        go.wait()
+        self.load(sent_counter)
+        results.put({'sent': self.sent, 'delivered': self.delivered, 'errors': self.errors,
+                     'logins': self.logins, 'latency': self.latency})
+        for client in self.clients:
+            if client.sock is not None:
+                client.sock.close()
+
+    def setup(self):
+        """Connects, logs in and joins every client, at the scenario's connect rate"""
+        rate = float(self.scenario['connect_rate']) / self.scenario['processes']
+        start = time.time()
+        deadline = start + self.scenario['setup_timeout']
+        waiting = list(reversed(self.clients))
+        pending = len(self.clients)
+        while pending and time.time() < deadline:
+            now = time.time()
+            while waiting and (not rate or len(self.clients) - len(waiting) < (now - start) * rate):
+                client = waiting.pop()
+                try:
+                    client.connect(self.address)
+                except socket.error as e:
+                    self.fail(client, "connect: %s" % e)
+                    continue
+                self.by_fd[client.sock.fileno()] = client
+                self.epoll.register(client.sock.fileno(), select.EPOLLOUT)
+            self.poll(0.01)
+            pending = sum(1 for client in self.clients if client.state not in (READY, DEAD))
+
+    def load(self, sent_counter):
+        """Sends at the scenario's rate for its duration, then drains"""
+        rate, duration = self.scenario['rate'], self.scenario['duration']
+        padding = 'x' * max(0, self.scenario['size'] - 20)
+        start = time.time()
+        end = start + duration
+        ready = [client for client in self.clients if client.state == READY]
+        schedule = []
+        if rate > 0:
+            schedule = [(start + random.uniform(0, 1.0 / rate), i) for i in range(len(ready))]
+            heapq.heapify(schedule)
+        reported = 0
+        counted = start
+        while True:
+            now = time.time()
+            if now >= end + self.scenario['drain']:
+                break
+            while schedule and schedule[0][0] <= now and now < end:
+                at, i = heapq.heappop(schedule)
+                client = ready[i]
+                if client.state != READY:
+                    continue
+                try:
+                    client.write(encode('message', u"@%.6f %s" % (time.time(), padding)))
+                except socket.error as e:
+                    self.fail(client, str(e))
+                    continue
+                self.sent[client.room] = self.sent.get(client.room, 0) + 1
+                heapq.heappush(schedule, (at + 1.0 / rate, i))
+            self.poll(max(0.0, min(0.05, schedule[0][0] - now)) if schedule and now < end else 0.05)
+            if now - counted > 0.1:
+                total = sum(self.sent.values())
+                with sent_counter.get_lock():
+                    sent_counter.value += total - reported
+                reported, counted = total, now
+
+    def poll(self, timeout):
+        for fd, event in self.epoll.poll(timeout):
+            client = self.by_fd.get(fd)
+            if client is None:
+                continue
+            try:
+                if event & select.EPOLLOUT:
+                    self.writable(client)
+                if event & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+                    self.readable(client)
+            except (socket.error, ValueError) as e:
+                self.fail(client, str(e))
+
+    def writable(self, client):
+        if client.state == CONNECTING:
+            code = client.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if code:
+                raise socket.error(code, os.strerror(code))
+            client.state = LOGIN
+            client.write(encode('login', client.name))
+        else:
+            client.flush()
+        self.epoll.modify(client.sock.fileno(), select.EPOLLIN | (select.EPOLLOUT if client.out else 0))
+
+    def readable(self, client):
+        data = client.sock.recv(1 << 16)
+        if not data:
+            raise socket.error("server closed the connection")
+        now = time.time()
+        for frame in client.decoder.feed(data):
+            self.frame(client, frame, now)
+        if client.out:
+            self.epoll.modify(client.sock.fileno(), select.EPOLLIN | select.EPOLLOUT)
+
+    def frame(self, client, frame, now):
+        if _MESSAGE in frame:
+            if client.skip:
+                client.skip -= 1
+                if not client.skip:
+                    self.history_done(client, now)
+            elif client.state == READY:
+                self.delivered += 1
+                stamp = _STAMP.search(frame)
+                if stamp is not None and float(stamp.group(1)) >= client.ready_at:
+                    self.latency.append(now - float(stamp.group(1)))
+            return
+        payload = Protocol.decode(frame)
+        response = payload.get('response')
+        if response == 'history' and client.state in (LOGIN, JOIN):
+            client.skip = payload.get('count', 0)
+            if not client.skip:
+                self.history_done(client, now)
+        elif response == 'error':
+            self.errors.append(payload.get('content'))
+            if client.state in (LOGIN, JOIN):
+                self.fail(client, None)
+
+    def history_done(self, client, now):
+        if client.state == LOGIN:
+            self.logins.append(now - client.started)
+            if self.scenario['rooms'] > 1:
+                client.state = JOIN
+                client.write(encode('chatroom', client.room))
+                return
+        client.state = READY
+        client.ready_at = now
+
+    def fail(self, client, error):
+        if error is not None:
+            self.errors.append(error)
+        client.state = DEAD
+        if client.sock is not None:
+            self.by_fd.pop(client.sock.fileno(), None)
+            try:
+                self.epoll.unregister(client.sock.fileno())
+            except (IOError, ValueError):
+                pass
+            client.sock.close()
+
+
+def generate(scenario, clients, ready, go, results, sent_counter):
+    Generator(scenario, clients).run(ready, go, results, sent_counter)
+
+
+class ServerProcess(object):
+    """The server under test, started in a scratch directory"""
+
+    def __init__(self, scenario):
+        self.directory = tempfile.mkdtemp(prefix='loadgen')
+        server = scenario['server']
+        for name, content in server.get('files', {}).items():
+            with open(os.path.join(self.directory, name), 'w') as f:
+                f.write(content)
+        args = [arg.format(port=scenario['port'], metrics_port=scenario['metrics_port'])
+                for arg in server.get('args', [])]
+        self.process = subprocess.Popen([server.get('python', sys.executable),
+                                         os.path.join(ROOT, server['script'])] + args,
+                                        cwd=self.directory, preexec_fn=raise_fd_limit,
+                                        stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        self.pid = self.process.pid
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection((scenario['host'], scenario['port'])).close()
+                break
+            except socket.error:
+                if time.time() > deadline or self.process.poll() is not None:
+                    self.stop()
+                    raise RuntimeError("Server did not start")
+                time.sleep(0.05)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+        self.process.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class Usage(object):
+    """CPU time and resident memory of a process and its children, sampled from /proc"""
+
+    _TICK = float(os.sysconf('SC_CLK_TCK'))
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.rss = 0            # Highest sum of VmRSS seen, bytes
+        self.restart()
+
+    def restart(self):
+        """Measures CPU from now on"""
+        self._start = (time.time(), self._cpu())
+
+    def sample(self):
+        rss = 0
+        for pid in self._pids():
+            try:
+                with open('/proc/%d/status' % pid) as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            rss += int(line.split()[1]) * 1024
+            except IOError:
+                pass
+        self.rss = max(self.rss, rss)
+
+    def cpu_percent(self):
+        now, cpu = time.time(), self._cpu()
+        return 100.0 * (cpu - self._start[1]) / (now - self._start[0])
+
+    def _cpu(self):
+        total = 0.0
+        for pid in self._pids():
+            try:
+                with open('/proc/%d/stat' % pid) as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                total += (int(fields[11]) + int(fields[12])) / self._TICK    # utime, stime
+            except IOError:
+                pass
+        return total
+
+    def _pids(self):
+        pids = [self.pid]
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                try:
+                    with open('/proc/%s/stat' % name) as f:
+                        if int(f.read().rsplit(')', 1)[1].split()[1]) == self.pid:
+                            pids.append(int(name))
+                except IOError:
+                    pass
+        return pids
+
+
+def read_history(sock, decoder):
+    """Reads until a history header and its messages have arrived. Returns the count"""
+    count = None
+    while count is None or count > 0:
+        data = sock.recv(1 << 16)
+        if not data:
+            raise EOFError("Server closed the connection")
+        for frame in decoder.feed(data):
+            if count is not None and _MESSAGE in frame:
+                count -= 1
+            elif count is None and b'"history"' in frame:
+                count = Protocol.decode(frame).get('count', 0)
+                seen = count
+    return seen
+
+
+def prefill(scenario, count):
+    """Sends count messages to the first room before the clients arrive"""
+    sock = socket.create_connection((scenario['host'], scenario['port']))
+    decoder = Protocol.FrameDecoder()
+    sock.sendall(encode('login', u"prefill"))
+    read_history(sock, decoder)
+    if scenario['rooms'] > 1:
+        sock.sendall(encode('chatroom', u"room0"))
+        read_history(sock, decoder)
+    padding = 'x' * max(0, scenario['size'] - 20)
+    echoed = 0
+    for i in range(count):
+        sock.sendall(encode('message', u"@0.0 %s" % padding))
+        if i % 100 == 99 or i == count - 1:
+            while echoed <= i:
+                echoed += sum(1 for frame in decoder.feed(sock.recv(1 << 16)) if _MESSAGE in frame)
+    sock.sendall(encode('logout'))
+    sock.close()
+
+
+def scrape(scenario):
+    """The server's metrics as {name: value}, or None without a metrics_port"""
+    if not scenario['metrics_port']:
+        return None
+    try:
+        body = urlopen('http://%s:%d/' % (scenario['host'], scenario['metrics_port']), timeout=10).read()
+    except (IOError, socket.error):
+        return None
+    return dict((name, float(value)) for name, value in
+                (line.rsplit(' ', 1) for line in body.decode('utf-8').splitlines() if ' ' in line))
+
+
+def probe_login(scenario, name):
+    """Times one login. Returns (seconds, messages in the login history)"""
+    start = time.time()
+    sock = socket.create_connection((scenario['host'], scenario['port']))
+    try:
+        sock.sendall(encode('login', name))
+        count = read_history(sock, Protocol.FrameDecoder())
+        elapsed = time.time() - start
+        sock.sendall(encode('logout'))
+        return elapsed, count
+    finally:
+        sock.close()
+
+
+def run(scenario, server_pid=None):
+    """Runs scenario against a server that is already listening. Returns the results"""
+    clients = [(u"c%d" % i, u"room%d" % (i % scenario['rooms'])) for i in range(scenario['clients'])]
+    room_size = {}
+    for _, room in clients:
+        room_size[room] = room_size.get(room, 0) + 1
+    if scenario['history']:
+        prefill(scenario, scenario['history'])
+
+    ready, results = multiprocessing.Queue(), multiprocessing.Queue()
+    go = multiprocessing.Event()
+    sent_counter = multiprocessing.Value('l', 0)
+    generators = [multiprocessing.Process(target=generate, args=(scenario, clients[i::scenario['processes']],
+                                                                  ready, go, results, sent_counter))
+                  for i in range(scenario['processes'])]
+    usage = Usage(server_pid) if server_pid else None
+    for generator in generators:
+        generator.daemon = True
+        generator.start()
+    joined, waited = 0, 0
+    deadline = time.time() + scenario['setup_timeout'] + 30
+    while waited < len(generators):
+        if usage is not None:
+            usage.sample()
+        try:
+            joined += ready.get(timeout=0.5)
+            waited += 1
+        except Empty:
+            if time.time() > deadline:
+                raise RuntimeError("Generators did not finish logging in")
+
+    metrics = scrape(scenario)
+    go.set()
+    start = time.time()
+    end = start + scenario['duration'] + scenario['drain']
+    probes = []
+    probe_every = scenario['duration'] / (scenario['login_probes'] + 1) if scenario['login_probes'] else None
+    next_probe = start + (probe_every or 0)
+    if usage is not None and scenario['duration']:
+        usage.restart()         # CPU of the load, not of the logins; a login storm only has the latter
+    while True:
+        if usage is not None:
+            usage.sample()
+        if time.time() >= end:
+            break
+        if probe_every and time.time() >= next_probe and len(probes) < scenario['login_probes']:
+            seconds, count = probe_login(scenario, u"probe%d" % len(probes))
+            probes.append({'sent': scenario['history'] + sent_counter.value, 'history': count,
+                           'seconds': seconds})
+            next_probe += probe_every
+        time.sleep(0.1)
+    cpu = usage.cpu_percent() if usage is not None else None
+    writes = None
+    if metrics is not None:
+        writes = scrape(scenario).get('socket_writes', 0) - metrics.get('socket_writes', 0)
+
+    parts = [results.get(timeout=60) for _ in generators]
+    for generator in generators:
+        generator.join()
+
+    sent, delivered, expected = 0, 0, 0
+    logins, latency, errors = [], [], []
+    for part in parts:
+        for room, count in part['sent'].items():
+            sent += count
+            expected += count * room_size[room]
+        delivered += part['delivered']
+        logins.extend(part['logins'])
+        latency.extend(part['latency'])
+        errors.extend(part['errors'])
+    logins.sort()
+    latency.sort()
+    duration = scenario['duration'] or float('nan')
+    return {
+        'scenario': scenario,
+        'clients_ready': joined,
+        'errors': len(errors),
+        'first_errors': errors[:5],
+        'sent': sent,
+        'delivered': delivered,
+        'expected': expected,
+        'sent_per_second': sent / duration,
+        'delivered_per_second': delivered / duration,
+        'latency_ms': dict((name, percentile(latency, fraction) * 1000)
+                           for name, fraction in (('p50', .5), ('p99', .99), ('p999', .999), ('max', 1.0))),
+        'login_ms': dict((name, percentile(logins, fraction) * 1000)
+                         for name, fraction in (('p50', .5), ('p99', .99), ('p999', .999), ('max', 1.0))),
+        'login_probes': probes,
+        'server_cpu_percent': cpu,
+        'server_rss_mb': usage.rss / float(1 << 20) if usage is not None else None,
+        'server_writes': writes,
+    }
+
+
+def report(result):
+    scenario = result['scenario']
+    print("%s: %d clients in %d room(s), %.2f msg/s each for %.0f s" % (
+        scenario.get('name', '?'), scenario['clients'], scenario['rooms'], scenario['rate'], scenario['duration']))
+    print("  ready          %d clients, %d errors %s" % (result['clients_ready'], result['errors'],
+                                                         result['first_errors'] or ''))
+    print("  sent           %d (%.0f/s)" % (result['sent'], result['sent_per_second']))
+    print("  delivered      %d of %d (%.0f/s)" % (result['delivered'], result['expected'],
+                                                  result['delivered_per_second']))
+    for name in ('latency_ms', 'login_ms'):
+        values = result[name]
+        print("  %-14s p50 %.2f  p99 %.2f  p999 %.2f  max %.2f" % (
+            name.replace('_ms', ' (ms)'), values['p50'], values['p99'], values['p999'], values['max']))
+    for probe in result['login_probes']:
+        print("  login probe    %.2f ms after %d messages (%d in history page)" % (
+            probe['seconds'] * 1000, probe['sent'], probe['history']))
+    if result['server_cpu_percent'] is not None:
+        print("  server         %.0f%% CPU, %.1f MB RSS" % (result['server_cpu_percent'], result['server_rss_mb']))
+    if result['server_writes'] is not None:
+        print("  server writes  %d (%.2f per delivered message)" % (
+            result['server_writes'], result['server_writes'] / max(1, result['delivered'])))
+
+
+def load_scenario(path, overrides):
+    scenario = dict(DEFAULTS)
+    with open(path) as f:
+        scenario.update(json.load(f))
+    for override in overrides:
+        key, value = override.split('=', 1)
+        scenario[key] = json.loads(value)
+    return scenario
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the chat servers")
+    parser.add_argument('scenario', help="scenario file, see scenarios/")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help="override a scenario key; VALUE is JSON")
+    parser.add_argument('--connect', metavar='HOST:PORT', help="use a running server instead of starting one")
+    parser.add_argument('--pid', type=int, help="process to measure CPU and RSS of, with --connect")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    args = parser.parse_args()
+    scenario = load_scenario(args.scenario, args.set)
+    raise_fd_limit()
+
+    if args.connect:
+        host, port = args.connect.rsplit(':', 1)
+        scenario['host'], scenario['port'] = host, int(port)
+        result = run(scenario, args.pid)
+    else:
+        server = ServerProcess(scenario)
+        try:
+            result = run(scenario, server.pid)
+        finally:
+            server.stop()
+    report(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import errno
+import select
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+
+"""
+Stress test of daniel-stuff/Server.py: a fixed number of clients is spread
+evenly over 1, 2, 4, ... chatrooms and every client sends the same number of
+messages as fast as the server takes them. Since a message is only handled
+under the lock of its own room and fanned out to that room's members, the
+rate at which the server accepts messages should grow with the number of
+rooms, while the number of frames it writes per second stays about the same.
+
+The server runs as its own process, in a scratch directory, and is restarted
+for every room count. The clients are driven by a few load generator
+processes so they do not share one interpreter lock with each other.
+
+Run with "python RoomScaling.py [--clients 64] [--messages 100] [--rooms 1,2,4,8,16]",
+using the Python 2 the server runs on.
+"""
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'daniel-stuff', 'Server.py')
+ADDRESS = ('localhost', 9998)   # Where daniel-stuff/Server.py listens
+TIMEOUT = 60.0                  # Seconds a run may take before it is given up
+
+
+def encode(request, content=None):
+    return (json.dumps({'request': request, 'content': content}) + '\n').encode('utf-8')
+
+
+def start_server(directory):
+    with open(os.path.join(directory, '.admins'), 'w'):
+        pass
+    server = subprocess.Popen([sys.executable, SERVER], cwd=directory,
+                              stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(ADDRESS).close()
+            return server
+        except socket.error:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("Server did not start")
+
+
+def read_until(sock, text):
+    """Reads from sock until a frame containing text arrives"""
+    data = b''
+    while text.encode('utf-8') not in data:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise EOFError("Server closed the connection")
+        data += chunk
+
+
+def join(name, room):
+    sock = socket.create_connection(ADDRESS)
+    sock.sendall(encode('login', name))
+    read_until(sock, '"history"')
+    sock.sendall(encode('chatroom', room))
+    read_until(sock, '"history"')       # The history of the new room
+    sock.setblocking(False)
+    return sock
+
+
+def load(clients, messages, room_size, ready, go, results):
+    """
+    Load generator process: joins its clients, waits for the others, then
+    sends and receives until every client got every message of its room.
+    """
+    socks = [join(name, room) for name, room in clients]
+    ready.put(len(socks))
+    go.wait()
+
+    frame = encode('message', u"x" * 64)
+    expected = messages * room_size
+    left = dict((sock, messages) for sock in socks)
+    received = dict((sock, 0) for sock in socks)
+    start = time.time()
+    while any(received[sock] < expected for sock in socks) and time.time() - start < TIMEOUT:
+        readable, writable, _ = select.select(socks, [sock for sock in socks if left[sock]], [], 1.0)
+        for sock in writable:
+            try:
+                sock.send(frame)
+                left[sock] -= 1
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+        for sock in readable:
+            received[sock] += sock.recv(1 << 20).count(b'\n')
+    results.put((time.time() - start, sum(received.values())))
+    for sock in socks:
+        sock.close()
+
+
+def run(clients, messages, rooms, generators):
+    directory = tempfile.mkdtemp(prefix='roomscaling')
+    server = start_server(directory)
+    try:
+        room_size = clients // rooms
+        everyone = [('c%d' % i, 'room%d' % (i % rooms)) for i in range(room_size * rooms)]
+        ready, results = multiprocessing.Queue(), multiprocessing.Queue()
+        go = multiprocessing.Event()
+        workers = [multiprocessing.Process(target=load, args=(everyone[i::generators], messages, room_size,
+                                                              ready, go, results))
+                   for i in range(generators)]
+        for worker in workers:
+            worker.start()
+        for _ in workers:
+            ready.get(timeout=TIMEOUT)
+        go.set()
+        runs = [results.get(timeout=2 * TIMEOUT) for _ in workers]
+        for worker in workers:
+            worker.join()
+        elapsed = max(seconds for seconds, _ in runs)
+        delivered = sum(frames for _, frames in runs)
+        sent = len(everyone) * messages
+        return elapsed, sent, delivered, sent * room_size
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message throughput of daniel-stuff/Server.py per number of rooms")
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--messages', type=int, default=100, help="Messages sent per client")
+    parser.add_argument('--rooms', default='1,2,4,8,16', help="Comma separated room counts")
+    parser.add_argument('--generators', type=int, default=4, help="Load generator processes")
+    args = parser.parse_args()
+
+    print("%-6s %10s %12s %14s %10s" % ("rooms", "seconds", "messages/s", "deliveries/s", "lost"))
+    for rooms in [int(count) for count in args.rooms.split(',')]:
+        elapsed, sent, delivered, expected = run(args.clients, args.messages, rooms, args.generators)
+        print("%-6d %10.2f %12.0f %14.0f %10d" % (rooms, elapsed, sent / elapsed, delivered / elapsed,
+                                                  expected - delivered))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import Search
+
+"""
+Cost of a room's search index: the time to add a message, the memory it
+takes, estimated by the index and measured as growth of the resident set,
+and the time to get a page of results for queries of every kind, from the
+newest messages and from deep in the history.
+
+Messages are made of a vocabulary with a long tail, like chat: a few words
+are in most messages and most words are rare.
+
+Run with "python SearchIndex.py [--messages N] [--memory MB]", on Linux.
+"""
+
+COMMON = (u"hei jeg du vi er har ikke det som p\xe5 med til en skal kan bare n\xe5 hva lab "
+          u"oving server klient melding socket tr\xe5d kommer snart takk ok haha lol "
+          u"the server is down again did you push the fix yes no maybe later").split()
+RARE = 50000            # Words of the long tail
+PAGE = 50
+RUNS = 200              # Per query
+
+
+def messages(count):
+    rng = random.Random(1)
+    rare = [u"w%dx" % i for i in range(RARE)]
+    for _ in range(count):
+        words = [rng.choice(COMMON) for _ in range(rng.randint(2, 15))]
+        words += [rare[int(rng.paretovariate(0.8)) % RARE] for _ in range(rng.randint(0, 3))]
+        yield u" ".join(words)
+
+
+def rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query time and memory of a room's search index")
+    parser.add_argument('--messages', type=int, default=2000000)
+    parser.add_argument('--memory', type=int, default=Search.DEFAULT_MEMORY >> 20, help="index bound, megabytes")
+    args = parser.parse_args()
+
+    index = Search.RoomIndex(args.memory << 20)
+    before = rss()
+    started = time.time()
+    for i, text in enumerate(messages(args.messages)):
+        index.add(i, text)
+        index.catch_up()
+    elapsed = time.time() - started
+    grown = rss() - before
+    print("%d messages, index bound %d MB" % (args.messages, args.memory))
+    print("  add            %.1f us a message, finding its words included" % (elapsed / args.messages * 1e6))
+    print("  memory         %.1f MB estimated, %.1f MB resident, %d postings" % (
+        index.bytes / 2 ** 20, grown / 2 ** 20, index.postings))
+    print("  searchable     the newest %d messages\n" % (args.messages - index.oldest))
+
+    deep = index.oldest + (args.messages - index.oldest) // 10
+    queries = [(u"rare word", u"w4000x"), (u"common word", u"server"), (u"two common", u"server fix"),
+               (u"common + rare", u"hei w20x"), (u"prefix", u"kl*"), (u"short prefix", u"s*"),
+               (u"no match", u"hei zzz")]
+    print("%-15s %-12s %10s %10s %10s" % ("query", "from", "results", "p50 (ms)", "p99 (ms)"))
+    for name, text in queries:
+        query = Search.parse_query(text)
+        for where, cursor in (("newest", None), ("10% in", deep)):
+            times = []
+            for _ in range(RUNS):
+                started = time.time()
+                found, _ = index.search(query, cursor, PAGE)
+                times.append(time.time() - started)
+            print("%-15s %-12s %10d %10.3f %10.3f" % (name, where, len(found), percentile(times, 0.5) * 1000,
+                                                      percentile(times, 0.99) * 1000))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
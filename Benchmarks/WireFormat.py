@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import Protocol
+
+"""
+Micro-benchmark of the two encodings of Protocol.py: a chat message encoded
+with json.dumps and decoded with json.loads, against the binary frame of
+Protocol.encode_binary decoded by a StreamDecoder. Also reports the bytes
+per frame of each, for a short and a long message.
+
+Run with "python WireFormat.py", on either Python.
+"""
+
+REPEAT = 100000
+SENDERS = [u"user%d" % i for i in range(50)]
+CONTENTS = (u"Hei p\xe5 deg", u"Hei p\xe5 deg, dette er en helt vanlig chatmelding " * 4)
+TIMESTAMP = "1457700000"
+
+
+def json_encode(messages):
+    return [(json.dumps({'content': content, 'sender': sender, 'response': "message",
+                         'timestamp': TIMESTAMP}) + "\n").encode('utf-8')
+            for sender, content in messages]
+
+
+def binary_encode(messages, interner):
+    return [Protocol.encode_binary(Protocol.MESSAGE, interner.id(sender), TIMESTAMP, content)
+            for sender, content in messages]
+
+
+def json_decode(frames):
+    return [json.loads(frame.decode('utf-8')) for frame in frames]
+
+
+def binary_decode(frames, decoder):
+    return [decoder.feed(frame) for frame in frames]
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def main():
+    print("%-8s %-8s %14s %14s %12s" % ("content", "format", "encode (k/s)", "decode (k/s)", "bytes/frame"))
+    for content in CONTENTS:
+        messages = [(SENDERS[i % len(SENDERS)], content) for i in range(REPEAT)]
+        interner = Protocol.Interner()
+        decoder = Protocol.StreamDecoder()
+        # Every sender's name is sent once, ahead of its first message
+        decoder.feed(b''.join(Protocol.encode_binary(Protocol.SENDER, interner.id(sender), 0, sender)
+                              for sender in SENDERS))
+
+        json_frames = json_encode(messages)
+        binary_frames = binary_encode(messages, interner)
+        assert binary_decode(binary_frames[:1], decoder)[0][0]['content'] == content
+        for name, encode, decode, frames in (
+                ("json", lambda: json_encode(messages), lambda: json_decode(json_frames), json_frames),
+                ("binary", lambda: binary_encode(messages, interner), lambda: binary_decode(binary_frames, decoder),
+                 binary_frames)):
+            print("%-8d %-8s %14.0f %14.0f %12.1f" % (len(content), name, REPEAT / timed(encode) / 1e3,
+                                                       REPEAT / timed(decode) / 1e3,
+                                                       sum(len(frame) for frame in frames) / float(len(frames))))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,47 @@
 # -*- coding: utf-8 -*-
+import os
+import sys
 import socket
-import json
 import logging
 from threading import *
 from Queue import Queue         # Queue for multithreading purposes
+from collections import deque
 from datetime import datetime   # Format unix time
 import time
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import Protocol                 # Framing shared with the server
+
 logging.basicConfig(level=logging.DEBUG)
 
+ROUND_TRIPS = 1000      # Round trips kept for /latency
+
 
 class Client(Thread):
 
-    def __init__(self, host, server_port):
+    def __init__(self, host, server_port, binary=False, compress=False, echo=False, on_receive=None):
         super(Client, self).__init__(name="Sender")
 
         self._host = host
         self._server_port = server_port
+        self._binary = binary       # Ask for the binary encoding at login, see Protocol.py
+        self._compress = compress   # Ask for zlib compression at login
+        self._echo = echo           # Time own messages until the server broadcasts them back
         self._connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)     # Each request goes out at once
 
         self._out_queue = Queue()   # Queue for outgoing traffic
         self._in_queue = Queue()    # Queue for incoming traffic
+        # Called with every line for the user on the receiver thread, as soon as it is read;
+        # without it lines wait in the in queue for get_next()
+        self._deliver = on_receive or self._in_queue.put
+        self._decoder = Protocol.StreamDecoder()
+        self._history_cursor = None     # Cursor of the next older history page
+        self._search = None             # (query, cursor) of the next page of search results
+        self._username = None           # Last name logged in with, to know own messages by
+        self._unanswered = deque(maxlen=ROUND_TRIPS)    # (content, time sent) of own messages on their way
+        self._round_trips = deque(maxlen=ROUND_TRIPS)   # Seconds from sending to getting back, latest last
+        self._echo_lock = Lock()        # Guards both, the sender and the receiver use them
 
         self.daemon = True
 
@@ -28,7 +49,8 @@ class Client(Thread):
         self._handle = {'message': self._handle_message,
                         'info': self._handle_message,
                         'error': self._handle_message,
-                        'history': self._handle_history}
+                        'history': self._handle_history,
+                        'search': self._handle_search}
 
         self.start()
 
@@ -42,12 +64,17 @@ class Client(Thread):
             raise Exception("Client has been closed")
         return not self._in_queue.empty()
 
-    def get_next(self):
+    def get_next(self, timeout=None):
         if self._exit_flag.is_set():
             raise Exception("Client has been closed")
 
-        # Blocks if queue is empty, so check first with has_next
-        return self._in_queue.get()
+        # Blocks until there is a line, or for at most timeout seconds (then raises Queue.Empty)
+        return self._in_queue.get(timeout=timeout)
+
+    def round_trips(self):
+        """Seconds each of the latest own messages took to come back from the server, with echo on"""
+        with self._echo_lock:
+            return list(self._round_trips)
 
     def run(self):
         self._connection.connect((self._host, self._server_port))
@@ -70,7 +97,13 @@ class Client(Thread):
                 continue
             elif string[0] == "/":
                 args = string[1:].split(" ", 1)  # Max two results
-                if len(args) == 1:
+                if args == ["history"]:
+                    self._request_older_history()
+                elif args == ["search"]:
+                    self._request_more_results()
+                elif args == ["latency"]:
+                    self._report_latency()
+                elif len(args) == 1:
                     self._send_payload(args[0], None)
                 elif len(args) == 2:
                     self._send_payload(args[0], args[1])
@@ -85,36 +118,18 @@ class Client(Thread):
             if raw == '':           # '' usually means closed/broken pipe
                 self.disconnect()
                 break
-            jsns = self._load_jsons(raw)
-            for jsn in jsns:
+            for jsn in self._decoder.feed(raw):
                 response, time_stamp, sender, content = self._extract_fields(jsn)
+                if response == 'message' and self._echo and sender == self._username:
+                    self._echoed(content)
+                if response == 'history':
+                    self._history_cursor = jsn.get('next', None)
+                elif response == 'search':
+                    self._search = (jsn.get('query'), jsn.get('next', None))
+                    content = jsn.get('count', 0)
                 if response in self._handle:
                     self._handle[response](time_stamp, sender, content)
 
-    def _load_jsons(self, raw):
-        jsns = []
-        end = 0
-        while True:
-            start = raw.find("{", end)
-            if start == -1:
-                break
-            end = start + 1
-            depth = 1
-
-            while depth > 0 and end < len(raw):
-                if raw[end] == "{":
-                    depth += 1
-                elif raw[end] == "}":
-                    depth -= 1
-                end += 1
-            if depth != 0:
-                break
-            try:
-                jsns.append(json.loads(raw[start : end]))
-            except ValueError:
-                logging.debug("Couldn't load json " + raw[start : end])
-        return jsns
-
     def _extract_fields(self, jsn):
             response = jsn.get('response', '')
             time_stamp = jsn.get('timestamp', None)
@@ -127,28 +142,66 @@ class Client(Thread):
             return response, time_stamp, sender, content
 
     def _handle_message(self, time, sender, content):
-        self._in_queue.put("[" + time + "] " + sender + ": " + content)
+        self._deliver("[" + time + "] " + sender + ": " + content)
 
     def _handle_history(self, time, sender, content):
         for jsn in content:
             self._handle_message(*self._extract_fields(jsn)[1:])
 
-    def _send_payload(self, request, content):
+    def _handle_search(self, time, sender, count):
+        self._deliver("[" + time + "] Found " + str(count) + " messages")
+
+    def _request_older_history(self):
+        if self._history_cursor is None:
+            self._deliver("No older messages")
+        else:
+            self._send_payload("history", self._history_cursor)
+
+    def _request_more_results(self):
+        if self._search is None or self._search[1] is None:
+            self._deliver("No more results")
+        else:
+            self._send_payload("search", self._search[0], before=self._search[1])
+
+    def _echoed(self, content):
+        now = time.time()
+        with self._echo_lock:
+            if not any(sent == content for sent, at in self._unanswered):
+                return
+            while True:                         # Earlier ones are not coming back
+                sent, at = self._unanswered.popleft()
+                if sent == content:
+                    self._round_trips.append(now - at)
+                    return
+
+    def _report_latency(self):
+        if not self._round_trips:
+            self._deliver("No round trips measured" + ("" if self._echo else ", echo is off"))
+            return
+        trips = sorted(self.round_trips())
+        self._deliver("Round trip of the last %d messages: p50 %.1f ms, p99 %.1f ms, max %.1f ms" % (
+            len(trips), trips[len(trips) // 2] * 1000, trips[int(len(trips) * 0.99)] * 1000, trips[-1] * 1000))
+
+    def _send_payload(self, request, content, **fields):
         logging.debug("Sending to server NOW")
-        self._connection.send(json.dumps({"request": request,
-                                          "content": content}))
-
-
-def printer(client):  # To be replaced with GUI
-    while 1:
-        time.sleep(0.1)
-        if client.has_next():
-            print client.get_next()
+        payload = dict(fields, request=request, content=content)
+        if request == "login" and self._binary:
+            payload["encoding"] = Protocol.BINARY
+        if request == "login" and self._compress:
+            payload["compression"] = Protocol.ZLIB
+        if request == "login" and content:
+            self._username = content.strip()
+        if request == "message" and self._echo:
+            with self._echo_lock:
+                self._unanswered.append((content.decode('utf-8') if isinstance(content, bytes) else content,
+                                         time.time()))
+        self._connection.sendall(Protocol.encode(payload))
+
+
+def printer(line):  # To be replaced with GUI
+    print line
 
 if __name__ == '__main__':
-    client = Client('162.243.253.165', 9998)
-    t = Thread(target=printer, args=[client])
-    t.daemon = True
-    t.start()
+    client = Client('162.243.253.165', 9998, echo='--echo' in sys.argv[1:], on_receive=printer)
     while 1:    # To be replaced with GUI
         client.write(raw_input("> "))
@@ -1,3 +1,10 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+from datetime import datetime
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import Protocol                 # Framing shared with the server
 
 
 class MessageParser():
@@ -6,19 +13,57 @@ class MessageParser():
         self.possible_responses = {
             'error': self.parse_error,
             'info': self.parse_info,
-	    # More key:values pairs are needed	
+            'message': self.parse_message,
+            'history': self.parse_history,
+            'search': self.parse_search,
         }
+        self._decoder = Protocol.StreamDecoder()
+
+    def feed(self, data):
+        """
+        Takes the raw bytes of one recv() and returns the parsed result of every
+        frame they complete, JSON or binary. Partial frames are kept until the
+        next call.
+        """
+        results = []
+        for payload in self._decoder.feed(data):
+            result = self.parse_payload(payload)
+            if result is not None:
+                results.append(result)
+        return results
 
     def parse(self, payload):
-        payload = # decode the JSON object
+        try:
+            payload = Protocol.decode(payload)
+        except ValueError:
+            return None
+        return self.parse_payload(payload)
 
-        if payload['response'] in self.possible_responses:
+    def parse_payload(self, payload):
+        if payload.get('response') in self.possible_responses:
             return self.possible_responses[payload['response']](payload)
         else:
             # Response not valid
+            return None
 
     def parse_error(self, payload):
-    
+        return "[Server] ERROR: " + payload.get('content', '')
+
     def parse_info(self, payload):
-    
-    # Include more methods for handling the different responses... 
+        return "[Server] INFO: " + payload.get('content', '')
+
+    def parse_message(self, payload):
+        return "[" + self._format_time(payload.get('timestamp')) + "] " + \
+            payload.get('sender', '') + ": " + payload.get('content', '')
+
+    def parse_history(self, payload):
+        return "\n".join(self.parse_message(msg) for msg in payload.get('content', []))
+
+    def parse_search(self, payload):
+        return "[Server] Found %d messages for '%s'" % (payload.get('count', 0), payload.get('query', ''))
+
+    @staticmethod
+    def _format_time(timestamp):
+        if timestamp is None:
+            return 'Unknown'
+        return datetime.fromtimestamp(float(timestamp)).strftime("%H:%M:%S")
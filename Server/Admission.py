@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import time
+import socket
+import calendar
+from collections import deque
+from threading import Thread, Lock, Condition
+
+import Metrics
+import Protocol
+
+"""
+Admission control: which connections a server takes on, and how many
+threads it spends on them.
+
+A connection is refused at accept time, before a handler, an outbox or a
+thread is made for it, when its address is banned, when its address has
+per_ip connections already or when the server has max_connections. The
+client gets one error frame, written without blocking, and is closed.
+
+PoolMixIn takes the place of SocketServer.ThreadingMixIn: handlers run on a
+pool of at most max_threads threads, which are kept and reused instead of
+started per connection. A connection that finds every thread busy waits in
+a queue of `pending` connections; when that is full too it is shed with an
+error frame. A chat handler keeps its thread for as long as its client is
+connected, so max_threads is also the number of clients served at once.
+
+Refusals are counted in connections_refused{reason}. The listen backlog,
+the kernel's queue of connections not accepted yet, is the server's
+request_queue_size; SocketServer's default of 5 resets clients that connect
+at the same moment.
+"""
+
+BANNED, PER_IP, FULL, BUSY = 'banned', 'per_ip', 'full', 'busy'
+REASONS = (BANNED, PER_IP, FULL, BUSY)
+_MESSAGES = {BANNED: "You are banned from this server",
+             PER_IP: "Too many connections from your address",
+             FULL: "The server is full, try again later",
+             BUSY: "The server is busy, try again later"}
+
+DEFAULT_MAX_CONNECTIONS = 10000
+DEFAULT_PER_IP = None           # No cap
+DEFAULT_BACKLOG = 1024
+DEFAULT_MAX_THREADS = 4096
+DEFAULT_PENDING = 128
+
+_refused = dict((reason, Metrics.counter('connections_refused', reason=reason)) for reason in REASONS)
+
+
+class Admission(object):
+    """
+    Counts the connections of a server, in total and per address. banned is
+    a set of addresses; it is shared, not copied, so adding to it bans.
+    None for max_connections or per_ip is no limit.
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, per_ip=DEFAULT_PER_IP, banned=None):
+        self.max_connections = max_connections
+        self.per_ip = per_ip
+        self.banned = banned if banned is not None else set()
+        self._counts = {}       # address : connections
+        self._total = 0
+        self._lock = Lock()
+
+    def admit(self, ip):
+        """Counts a connection from ip and returns None, or returns why it is refused"""
+        if ip in self.banned:
+            return BANNED
+        with self._lock:
+            if self.max_connections is not None and self._total >= self.max_connections:
+                return FULL
+            count = self._counts.get(ip, 0)
+            if self.per_ip is not None and count >= self.per_ip:
+                return PER_IP
+            self._counts[ip] = count + 1
+            self._total += 1
+        return None
+
+    def release(self, ip):
+        with self._lock:
+            count = self._counts.get(ip, 0) - 1
+            if count > 0:
+                self._counts[ip] = count
+            else:
+                self._counts.pop(ip, None)
+            self._total -= 1
+
+    def __len__(self):
+        return self._total
+
+
+def refuse(sock, reason):
+    """Sends the error frame of reason without waiting for the client; the caller closes sock"""
+    _refused[reason].add()
+    frame = Protocol.encode({'content': _MESSAGES[reason], 'sender': "server", 'response': "error",
+                             'timestamp': str(calendar.timegm(time.gmtime()))})
+    try:
+        sock.setblocking(0)
+        sock.send(frame)
+    except socket.error:
+        pass
+
+
+class PoolMixIn:
+    """
+    Mix-in for a SocketServer.TCPServer, in place of ThreadingMixIn. Set
+    admission to an Admission to have connections counted and refused.
+    """
+
+    admission = None
+    max_threads = DEFAULT_MAX_THREADS
+    pending = DEFAULT_PENDING
+    daemon_threads = True
+
+    _pool = None
+
+    def verify_request(self, request, client_address):
+        if self.admission is None:
+            return True
+        reason = self.admission.admit(client_address[0])
+        if reason is None:
+            return True
+        refuse(request, reason)
+        return False            # TCPServer closes it
+
+    def process_request(self, request, client_address):
+        if self._pool is None:
+            self._pool = Condition()
+            self._waiting = deque()     # (request, client_address) not taken by a thread yet
+            self._threads = 0
+            self._idle = 0
+        with self._pool:
+            if self._idle > len(self._waiting):
+                self._waiting.append((request, client_address))
+                self._pool.notify()
+                return
+            if self._threads < self.max_threads:
+                self._threads += 1
+                thread = Thread(target=self._work, args=(request, client_address), name="Handler")
+                thread.daemon = self.daemon_threads
+                thread.start()
+                return
+            if len(self._waiting) < self.pending:
+                self._waiting.append((request, client_address))
+                return
+        refuse(request, BUSY)
+        self._done(request, client_address)
+
+    def _work(self, request, client_address):
+        while True:
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self._done(request, client_address)
+            with self._pool:
+                self._idle += 1
+                while not self._waiting:
+                    self._pool.wait()
+                self._idle -= 1
+                request, client_address = self._waiting.popleft()
+
+    def _done(self, request, client_address):
+        self.shutdown_request(request)
+        if self.admission is not None:
+            self.admission.release(client_address[0])
+
+    def pool_threads(self):
+        """(threads, idle threads, connections waiting for one)"""
+        if self._pool is None:
+            return 0, 0, 0
+        with self._pool:
+            return self._threads, self._idle, len(self._waiting)
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+import os
+import errno
+import socket
+import logging
+from threading import Thread, Lock
+
+import Protocol
+
+"""
+Local pub/sub bus for running the server as several worker processes.
+
+Every worker accepts clients on the same port (SO_REUSEPORT) and connects to
+the Hub, which runs in the supervising process, over a Unix domain socket.
+Events are frames in the wire format of Protocol.py:
+
+    {"event": "hello", "worker": w}         worker -> hub, once
+    {"event": "members", "names": {..}, "rooms": {..}}
+                                            hub -> worker, every user's worker and room
+    {"event": "join", "name": n, "room": r} a user logged in on a worker, or changed room
+    {"event": "leave", "name": n}           a user left a worker
+    {"event": "reject", "name": n}          hub -> worker, n is taken on another worker
+    {"event": "message", "room": r}         followed by one chat message frame of room r
+
+Chat messages are published to the hub, which gives them their order,
+appends them to the room's message log and sends them to every worker, the
+one they came from included. So every worker keeps the same history of every
+room and every client sees the messages in the same order. Joins and leaves
+go to the other workers only; a worker keeps the names and rooms of remote
+users to answer "names" and to refuse taken names at login. Two workers can
+still let the same name in at the same time; the hub keeps the first and
+rejects the second.
+"""
+
+HELLO, MEMBERS, JOIN, LEAVE, REJECT, MESSAGE = 'hello', 'members', 'join', 'leave', 'reject', 'message'
+
+
+def _message_event(room):
+    return Protocol.encode({'event': MESSAGE, 'room': room})
+
+
+def default_path(port):
+    return '/tmp/chat-bus-%d.sock' % port
+
+
+class Hub(object):
+    """
+    The supervisor's end of the bus. Serves every worker from a thread of
+    its own; one lock orders the events.
+    """
+
+    def __init__(self, path, store=None):
+        self.path = path
+        self._store = store     # MessageLog.LogStore the messages are appended to
+        self._lock = Lock()
+        self._workers = {}      # worker : socket
+        self._owners = {}       # username : worker
+        self._rooms = {}        # username : room
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        self.socket.listen(64)
+
+    def start(self):
+        thread = Thread(target=self._accept, name="Hub")
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self.socket.accept()
+            except socket.error:
+                return
+            thread = Thread(target=self._serve, args=(sock,), name="HubWorker")
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, sock):
+        decoder = Protocol.FrameDecoder()
+        worker = None
+        message = None          # Room of the next frame, a chat message
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    if message is not None:
+                        self._message(frame, message)
+                        message = None
+                        continue
+                    event = Protocol.decode(frame)
+                    kind = event.get('event')
+                    if kind == HELLO:
+                        worker = event['worker']
+                        self._hello(worker, sock)
+                    elif kind == JOIN:
+                        self._join(worker, event['name'], event['room'])
+                    elif kind == LEAVE:
+                        self._leave(worker, event['name'])
+                    elif kind == MESSAGE:
+                        message = event['room']
+        except (socket.error, ValueError) as e:
+            logging.error("Bus connection of worker %s failed: %s", worker, e)
+        finally:
+            self._bye(worker)
+            sock.close()
+
+    def _hello(self, worker, sock):
+        with self._lock:
+            self._workers[worker] = sock
+            sock.sendall(Protocol.encode({'event': MEMBERS, 'names': self._owners, 'rooms': self._rooms}))
+        logging.info("Worker %s joined the bus", worker)
+
+    def _join(self, worker, name, room):
+        with self._lock:
+            if self._owners.get(name, worker) != worker:
+                self._send(worker, Protocol.encode({'event': REJECT, 'name': name}))
+                return
+            self._owners[name] = worker
+            self._rooms[name] = room
+            self._publish(Protocol.encode({'event': JOIN, 'name': name, 'worker': worker, 'room': room}), worker)
+
+    def _leave(self, worker, name):
+        with self._lock:
+            if self._owners.get(name) == worker:
+                del self._owners[name]
+                self._rooms.pop(name, None)
+                self._publish(Protocol.encode({'event': LEAVE, 'name': name, 'worker': worker}), worker)
+
+    def _message(self, frame, room):
+        frame += Protocol.DELIMITER
+        with self._lock:
+            if self._store is not None:
+                self._store.log(room).append(frame)
+            self._publish(_message_event(room) + frame)
+
+    def _bye(self, worker):
+        with self._lock:
+            self._workers.pop(worker, None)
+            for name in [name for name, owner in self._owners.items() if owner == worker]:
+                del self._owners[name]
+                self._rooms.pop(name, None)
+                self._publish(Protocol.encode({'event': LEAVE, 'name': name, 'worker': worker}))
+        logging.info("Worker %s left the bus", worker)
+
+    def _publish(self, data, origin=None):
+        for worker in list(self._workers):
+            if worker != origin:
+                self._send(worker, data)
+
+    def _send(self, worker, data):
+        try:
+            self._workers[worker].sendall(data)
+        except socket.error as e:
+            logging.error("Could not reach worker %s: %s", worker, e)
+        except KeyError:
+            pass
+
+
+class Peer(Thread):
+    """
+    A worker's end of the bus. Events from the hub are handed to listener,
+    a ClientHandler class, with schedule(callback, *args) so they run where
+    the server engine wants them (see EventLoopServer.call_from_thread).
+    closed() is called if the hub goes away.
+    """
+
+    def __init__(self, path, worker, listener, schedule, closed):
+        super(Peer, self).__init__(name="Peer")
+        self.daemon = True
+        self.worker = worker
+        self.remote = {}        # username : worker, for the users of the other workers
+        self.rooms = {}         # username : room, for the same users
+        self._listener = listener
+        self._schedule = schedule
+        self._closed = closed
+        self._lock = Lock()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._send(Protocol.encode({'event': HELLO, 'worker': worker}))
+
+    def claim(self, name, room):
+        """Announces that name logged in here, or that it moved to room"""
+        self._send(Protocol.encode({'event': JOIN, 'name': name, 'room': room}))
+
+    def release(self, name):
+        self._send(Protocol.encode({'event': LEAVE, 'name': name}))
+
+    def publish(self, frame, room):
+        """Sends a chat message frame of room to every worker, this one included"""
+        self._send(_message_event(room) + frame)
+
+    def names(self, room):
+        """The remote users in room"""
+        rooms = self.rooms
+        return [name for name in list(self.remote) if rooms.get(name) == room]
+
+    def run(self):
+        decoder = Protocol.FrameDecoder()
+        message = None
+        try:
+            while True:
+                data = self._sock.recv(65536)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    if message is not None:
+                        self._schedule(self._listener.bus_message, frame + Protocol.DELIMITER, message)
+                        message = None
+                        continue
+                    event = Protocol.decode(frame)
+                    kind = event.get('event')
+                    if kind == MESSAGE:
+                        message = event['room']
+                    elif kind == MEMBERS:
+                        self.remote = dict((name, worker) for name, worker in event['names'].items()
+                                           if worker != self.worker)
+                        self.rooms = dict((name, room) for name, room in event['rooms'].items()
+                                          if name in self.remote)
+                    elif kind == JOIN:
+                        self.remote[event['name']] = event['worker']
+                        self.rooms[event['name']] = event['room']
+                    elif kind == LEAVE:
+                        if self.remote.get(event['name']) == event['worker']:
+                            del self.remote[event['name']]
+                            self.rooms.pop(event['name'], None)
+                    elif kind == REJECT:
+                        self._schedule(self._listener.bus_reject, event['name'])
+        except (socket.error, ValueError) as e:
+            logging.error("Bus connection failed: %s", e)
+        logging.error("Lost the bus, worker %s stops", self.worker)
+        self._closed()
+
+    def _send(self, data):
+        with self._lock:
+            self._sock.sendall(data)
@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import heapq
+import fcntl
+import socket
+import select
+import errno
+import logging
+from collections import deque
+
+import Admission
+import Metrics
+import Outbox
+
+"""
+Single threaded server engine. Every client is served from one epoll (or
+select, where epoll is missing) loop, so connected clients cost a socket and a
+handler object instead of a thread each.
+
+The loop drives the same ClientHandler classes as ThreadedTCPServer. Handlers
+are created with setup() only; each chunk read from the socket is passed to
+handler.handle_received(), and handler.send()/handler.close() are redirected to
+the connection's Outbox so no handler ever blocks on a socket. Outboxes written
+to while handling a batch of events are flushed once the batch is done, or,
+if the Outbox's coalescing window is still open, when it closes.
+
+Other threads must not touch handlers directly; they hand work to the loop
+with call_from_thread(), which wakes it up through a pipe.
+
+Connections are admitted as they are accepted, like ThreadedTCPServer does
+(see Admission.py), before anything is allocated for them.
+"""
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+_writes = Metrics.counter('socket_writes')
+
+
+class _EpollPoller(object):
+    READ, WRITE, ERROR = 1, 4, 8 | 16     # EPOLLIN, EPOLLOUT, EPOLLERR | EPOLLHUP
+
+    def __init__(self):
+        self._epoll = select.epoll()
+
+    def register(self, fd, events):
+        self._epoll.register(fd, events)
+
+    def modify(self, fd, events):
+        self._epoll.modify(fd, events)
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout):
+        return self._epoll.poll(timeout)
+
+
+class _SelectPoller(object):
+    READ, WRITE, ERROR = 1, 4, 8
+
+    def __init__(self):
+        self._fds = {}
+
+    def register(self, fd, events):
+        self._fds[fd] = events
+
+    def modify(self, fd, events):
+        self._fds[fd] = events
+
+    def unregister(self, fd):
+        self._fds.pop(fd, None)
+
+    def poll(self, timeout):
+        readers = [fd for fd, ev in self._fds.items() if ev & self.READ]
+        writers = [fd for fd, ev in self._fds.items() if ev & self.WRITE]
+        r, w, x = select.select(readers, writers, readers, timeout)
+        events = {}
+        for fd in r:
+            events[fd] = events.get(fd, 0) | self.READ
+        for fd in w:
+            events[fd] = events.get(fd, 0) | self.WRITE
+        for fd in x:
+            events[fd] = events.get(fd, 0) | self.ERROR
+        return events.items()
+
+
+Poller = _EpollPoller if hasattr(select, 'epoll') else _SelectPoller
+
+
+class Connection(object):
+    """
+    Loop-side state of one client: the socket, its handler, the frames that are
+    waiting to be written and the unsent rest of the last write.
+    """
+
+    def __init__(self, sock, address, outbox):
+        self.sock = sock
+        self.address = address
+        self.handler = None
+        self.outbox = outbox
+        self.pending = deque()  # Taken from the outbox, not yet (fully) written
+        self.dirty = False
+        self.held = False       # Waits for its Outbox's window to be flushed
+        self.want_write = False
+        self.closing = False
+        self.closed = False
+
+
+def event_handler(handler_class):
+    """
+    Returns a subclass of handler_class that can be driven by EventLoopServer.
+    """
+
+    class EventHandler(handler_class):
+
+        def __init__(self, request, client_address, server):
+            self.request = request
+            self.client_address = client_address
+            self.server = server
+            self.event_connection = server.connection_for(request)
+            self.setup()
+
+        def _new_outbox(self):
+            return self.event_connection.outbox
+
+        def queue(self, data, force=False):
+            self.server.write(self.event_connection, data, force)
+
+        def close(self):
+            self.server.close_after_flush(self.event_connection)
+
+    EventHandler.__name__ = 'Event' + handler_class.__name__
+    return EventHandler
+
+
+class EventLoopServer(object):
+    """
+    Drop-in replacement for ThreadedTCPServer: EventLoopServer(address, ClientHandler).serve_forever()
+    """
+
+    request_queue_size = Admission.DEFAULT_BACKLOG
+    poll_interval = 0.5
+    reuse_port = False      # Let several processes accept on the same port
+    admission = None        # Admission.Admission, if connections are to be counted and refused
+    listener = None         # A listening socket to take over instead of binding one, see Handoff.py
+
+    def __init__(self, server_address, handler_class):
+        self.server_address = server_address
+        self.handler_class = event_handler(handler_class)
+        if self.listener is not None:
+            self.socket = self.listener
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.socket.bind(server_address)
+            self.socket.listen(self.request_queue_size)
+        self.server_address = self.socket.getsockname()
+        self.socket.setblocking(0)
+        self._poller = Poller()
+        self._poller.register(self.socket.fileno(), Poller.READ)
+        self._wakeup, self._waker = os.pipe()
+        for fd in (self._wakeup, self._waker):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._poller.register(self._wakeup, Poller.READ)
+        self._calls = deque()   # (callback, args) handed over by other threads
+        self._connections = {}  # fd : Connection
+        self._dirty = []        # Connections written to during this batch of events
+        self._held = []         # Heap of (deadline, fd, Connection) waiting for their window
+        self._running = False
+
+    def serve_forever(self):
+        self._running = True
+        while self._running:
+            timeout = self.poll_interval
+            if self._held:
+                timeout = max(0, min(timeout, self._held[0][0] - time.time()))
+            try:
+                events = self._poller.poll(timeout)
+            except (select.error, IOError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self.socket.fileno():
+                    self._accept()
+                    continue
+                if fd == self._wakeup:
+                    self._run_calls()
+                    continue
+                conn = self._connections.get(fd)
+                if conn is None:
+                    continue
+                if event & (Poller.READ | Poller.ERROR):
+                    self._read(conn)
+                if event & Poller.WRITE and not conn.closed:
+                    self._flush(conn)
+            self._flush_dirty()
+            if self._held:
+                self._flush_held()
+
+    def shutdown(self):
+        self._running = False
+
+    def stop_accepting(self):
+        """Leaves new connections to the listen backlog; the loop goes on serving the others"""
+        self.call_from_thread(self._poller.unregister, self.socket.fileno())
+
+    def server_close(self):
+        for conn in list(self._connections.values()):
+            self._drop(conn)
+        self.socket.close()
+        os.close(self._wakeup)
+        os.close(self._waker)
+
+    def call_from_thread(self, callback, *args):
+        """Runs callback(*args) on the loop's thread. Safe to call from any thread"""
+        self._calls.append((callback, args))
+        try:
+            os.write(self._waker, b'x')
+        except OSError as e:
+            if e.errno not in _WOULD_BLOCK:     # A full pipe wakes the loop up just as well
+                raise
+
+    def connection_for(self, sock):
+        return self._connections[sock.fileno()]
+
+    def write(self, conn, data, force=False):
+        if conn.closed or conn.closing:
+            return
+        if not conn.outbox.put(data, force):
+            logging.debug("Disconnecting slow client %s:%s", *conn.address)
+            conn.outbox.abort()
+            self._drop(conn)
+            return
+        if not conn.dirty:
+            conn.dirty = True
+            self._dirty.append(conn)
+
+    def close_after_flush(self, conn):
+        if conn.closed:
+            return
+        conn.closing = True
+        conn.outbox.close()
+        if not conn.dirty:
+            conn.dirty = True
+            self._dirty.append(conn)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in _WOULD_BLOCK:
+                    return
+                logging.debug("Accept failed: %s", e)
+                return
+            if self.admission is not None:
+                reason = self.admission.admit(address[0])
+                if reason is not None:
+                    Admission.refuse(sock, reason)
+                    sock.close()
+                    continue
+            sock.setblocking(0)
+            outbox = Outbox.Outbox(getattr(self.handler_class, 'outbox_limit', Outbox.DEFAULT_LIMIT),
+                                   getattr(self.handler_class, 'slow_consumer_policy', Outbox.DROP_OLDEST),
+                                   getattr(self.handler_class, 'coalesce_window', Outbox.DEFAULT_WINDOW),
+                                   getattr(self.handler_class, 'coalesce_bytes', Outbox.DEFAULT_BUDGET))
+            conn = Connection(sock, address, outbox)
+            self._connections[sock.fileno()] = conn
+            self._poller.register(sock.fileno(), Poller.READ)
+            conn.handler = self.handler_class(sock, address, self)
+
+    def _run_calls(self):
+        try:
+            while os.read(self._wakeup, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in _WOULD_BLOCK:
+                raise
+        while self._calls:
+            callback, args = self._calls.popleft()
+            callback(*args)
+
+    def _read(self, conn):
+        if conn.closing:
+            return
+        try:
+            data = conn.sock.recv(4096)
+        except socket.error as e:
+            if e.args[0] in _WOULD_BLOCK:
+                return
+            logging.debug("Client disconnected %s", e)
+            data = b''
+        if not data:
+            self._drop(conn)
+            return
+        try:
+            keep = conn.handler.handle_received(data)
+        except Exception:
+            # One client's failed request must not take the loop, and every other client, down with it
+            logging.exception("Dropping %s:%s after a request failed", *conn.address)
+            self._drop(conn)
+            return
+        if not keep:
+            self.close_after_flush(conn)
+
+    def _flush_dirty(self):
+        dirty, self._dirty = self._dirty, []
+        now = time.time()
+        for conn in dirty:
+            conn.dirty = False
+            if conn.closed:
+                continue
+            delay = 0 if conn.closing else conn.outbox.hold(now)
+            if not delay:
+                self._flush(conn)
+            elif not conn.held:
+                conn.held = True
+                heapq.heappush(self._held, (now + delay, conn.sock.fileno(), conn))
+
+    def _flush_held(self):
+        held, now = self._held, time.time()
+        while held and held[0][0] <= now:
+            conn = heapq.heappop(held)[2]
+            conn.held = False
+            if not conn.closed:
+                self._flush(conn)
+
+    def _flush(self, conn):
+        fd = conn.sock.fileno()
+        pending = conn.pending
+        try:
+            while True:
+                if not pending:
+                    items = conn.outbox.take()
+                    if not items:
+                        break
+                    pending.extend(memoryview(chunk) if isinstance(chunk, bytes) else chunk
+                                   for chunk in Outbox.chunks(items))
+                chunk = pending[0]
+                _writes.add()
+                if isinstance(chunk, memoryview):
+                    sent = conn.sock.send(chunk)
+                    pending[0] = chunk[sent:]
+                else:
+                    chunk.send(conn.sock)
+                if not len(pending[0]):
+                    pending.popleft()
+        except (socket.error, OSError) as e:
+            if e.args[0] not in _WOULD_BLOCK:
+                logging.debug("Closing dead socket: %s", e)
+                self._drop(conn)
+                return
+        if pending:
+            if not conn.want_write:
+                conn.want_write = True
+                self._poller.modify(fd, Poller.READ | Poller.WRITE)
+        elif conn.closing:
+            self._drop(conn)
+        elif conn.want_write:
+            conn.want_write = False
+            self._poller.modify(fd, Poller.READ)
+
+    def _drop(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        Outbox.release(conn.pending)
+        conn.pending.clear()
+        conn.outbox.abort()
+        fd = conn.sock.fileno()
+        self._connections.pop(fd, None)
+        try:
+            self._poller.unregister(fd)
+        except (KeyError, IOError, ValueError):
+            pass
+        conn.handler.finish()
+        conn.sock.close()
+        if self.admission is not None:
+            self.admission.release(conn.address[0])
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import fcntl
+import errno
+import socket
+import signal
+import logging
+
+"""
+Handing the listening socket over to a new server process, so a server can
+be restarted (a new version, say) without refusing a single connection.
+
+The running server, on SIGNAL, starts its successor: the same command line,
+with the listening socket as an open file descriptor whose number is in
+LISTEN_FD, and the reading end of a pipe in WAIT_FD. Then it stops
+accepting, lets its clients drain, saves its snapshot and exits. The
+successor blocks in wait_for_predecessor() until the pipe reaches its end,
+which is when the old process is gone, then loads the snapshot and starts
+accepting on the inherited socket.
+
+The socket stays open and listening the whole time, in one process or the
+other, so a client that connects in between is queued in the listen backlog
+(see Admission.py) and accepted by the successor, instead of being refused.
+It only waits for as long as the old process drains and the new one loads
+its state, which is what snapshots keep short.
+
+Nothing else is inherited: the successor closes every other descriptor
+before it runs, so the old process's clients see their connections close
+when it exits.
+"""
+
+LISTEN_FD = 'CHAT_LISTEN_FD'
+WAIT_FD = 'CHAT_WAIT_FD'
+SIGNAL = signal.SIGUSR2
+
+
+def inherited_socket():
+    """The listening socket a predecessor handed over, None if there is none"""
+    fd = os.environ.pop(LISTEN_FD, None)
+    if fd is None:
+        return None
+    listener = socket.fromfd(int(fd), socket.AF_INET, socket.SOCK_STREAM)
+    os.close(int(fd))           # fromfd made a copy
+    return listener
+
+
+def wait_for_predecessor():
+    """Blocks until the server that started this one has exited; returns at once if there is none"""
+    fd = os.environ.pop(WAIT_FD, None)
+    if fd is None:
+        return
+    logging.info("Waiting for the previous server to drain")
+    while True:
+        try:
+            if not os.read(int(fd), 4096):
+                break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    os.close(int(fd))
+
+
+def start_successor(listener):
+    """
+    Starts this server again with listener handed over, and returns the pid
+    of the new process. It waits until this one has exited.
+    """
+    wait, release = os.pipe()
+    fcntl.fcntl(release, fcntl.F_SETFD, fcntl.fcntl(release, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    keep = sorted((listener.fileno(), wait))
+    env = dict(os.environ)
+    env[LISTEN_FD], env[WAIT_FD] = str(listener.fileno()), str(wait)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.closerange(3, keep[0])
+            os.closerange(keep[0] + 1, keep[1])
+            os.closerange(keep[1] + 1, os.sysconf('SC_OPEN_MAX'))
+            os.execve(sys.executable, [sys.executable] + sys.argv, env)
+        finally:
+            os._exit(127)
+    os.close(wait)
+    logging.info("Started server %d to take over", pid)
+    return pid
+
+
+def on_signal(callback):
+    """Calls callback() on the main thread when SIGNAL arrives"""
+    signal.signal(SIGNAL, lambda number, frame: callback())
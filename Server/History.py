@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+import re
+from array import array
+from threading import Lock
+from collections import deque
+
+import Protocol
+
+"""
+Bounded, paged room history.
+
+A RoomHistory keeps the last `size` messages of one room in a ring buffer.
+Every appended message gets the next index of the room (0, 1, 2, ...), and
+clients page backwards through the history with a cursor: "give me at most
+`limit` messages older than index `before`". Each page tells the client which
+cursor fetches the page before it, or None when nothing older is kept.
+
+Only the encoded frame of a message is kept. A DurableHistory also appends
+every frame to the room's MessageLog; its ring buffer then only caches the
+newest frames, and older pages are read from the log. replay() gives the
+same page as page() but in the form it is written to a client: bytes for
+cached frames, MessageLog.Regions for pages that are streamed from the log
+without being read into memory.
+
+A CompactHistory keeps the same messages in less memory: instead of a
+frame per message it keeps blocks of BLOCK messages as columns, with the
+sender as an id of one shared Interner, the timestamp as an integer and the
+content as UTF-8 bytes in one buffer per block, and encodes the frames
+again when they are paged. That costs CPU per replayed message, so it is
+for servers that keep many messages in memory. A message whose frame would
+not come out the same again (other fields, a timestamp that is not plain
+seconds or "YYYY-MM-DD HH:MM:SS", content that is not text) is kept whole.
+
+The index of a message is its sequence number in the room. since() gives
+a reconnecting client just the messages after the last one it saw, as long
+as they are all still kept and few enough to send at once.
+"""
+
+DEFAULT_SIZE = 1000     # Messages kept per room
+DEFAULT_PAGE = 50       # Messages sent on join / per page
+MAX_PAGE = 500
+BLOCK = 256             # Messages per block of a CompactHistory
+
+senders = Protocol.Interner()   # Sender names of every CompactHistory
+
+_RAW, _SECONDS, _DATETIME = 0, 1, 2     # How a record's timestamp is kept; _RAW keeps the frame itself
+_STAMP = 3
+_SEQ = 4                                # The frame has its index as "seq"
+_FIELDS = frozenset(['content', 'sender', 'response', 'timestamp', 'seq'])
+_SECONDS_TEXT = re.compile(r'^[1-9][0-9]{0,17}$')
+_DATETIME_TEXT = re.compile(r'^[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}$')
+_TEXT = type(u'')
+
+
+class RoomHistory(object):
+
+    def __init__(self, size=DEFAULT_SIZE, start=0, frames=()):
+        if size < 1:
+            raise ValueError("History size must be positive")
+        self.size = size
+        self._first = start     # Index of the first message this history got
+        self._next = start      # Index the next appended message gets
+        self._lock = Lock()
+        self._clear()
+        for frame in frames:
+            self._store(frame)
+
+    def append(self, message):
+        """Stores message, evicting the oldest one if the room is full. Returns its index"""
+        return self.append_frame(message.frame)
+
+    def append_frame(self, frame):
+        """Same as append, for a message that is already encoded"""
+        with self._lock:
+            return self._store(frame)
+
+    def page(self, before=None, limit=DEFAULT_PAGE):
+        """
+        Returns (frames, cursor): the frames of the last `limit` messages older
+        than index `before` (or the newest ones if before is None), oldest
+        first, and the cursor for the page before those.
+        """
+        with self._lock:
+            oldest = self._oldest()
+            end = self._next if before is None else max(oldest, min(before, self._next))
+            start = max(oldest, end - max(0, limit))
+            return self._frames(start, end), (start if start > self._first_kept() else None)
+
+    def replay(self, before=None, limit=DEFAULT_PAGE):
+        """
+        Returns (parts, count, cursor): the page of page(before, limit) as the
+        parts to write to the client, the number of messages and the cursor.
+        """
+        frames, cursor = self.page(before, limit)
+        return [b''.join(frames)], len(frames), cursor
+
+    def since(self, seq, limit=DEFAULT_PAGE):
+        """
+        Returns replay()'s (parts, count, cursor) for the messages after index
+        seq, or None if some of them are no longer kept, seq was never handed
+        out, or there are more than limit of them.
+        """
+        end = self.next_index
+        start = seq + 1
+        if start > end or start < self._first_kept() or end - start > limit:
+            return None
+        return self.replay(end, end - start)
+
+    @property
+    def next_index(self):
+        """Index the next appended message gets"""
+        return self._next
+
+    def __len__(self):
+        return self._next - self._oldest()
+
+    def _oldest(self):
+        """Index of the oldest message in the ring buffer"""
+        return max(self._first, self._next - self.size)
+
+    def _first_kept(self):
+        """Index of the oldest message that can still be paged to"""
+        return self._oldest()
+
+    def _clear(self):
+        self._slots = [None] * self.size
+
+    def _frames(self, start, end):
+        return [self._slots[i % self.size] for i in range(start, end)]
+
+    def _store(self, frame):
+        index = self._next
+        self._slots[index % self.size] = frame
+        self._next = index + 1
+        return index
+
+
+class _Block(object):
+    """BLOCK consecutive messages of a CompactHistory, column by column"""
+
+    __slots__ = ('base', 'kinds', 'senders', 'stamps', 'ends', 'contents', 'raw')
+
+    def __init__(self, base):
+        self.base = base
+        self.kinds = array('B')
+        self.senders = array('I')
+        self.stamps = array('l')
+        self.ends = array('I')          # Where each content ends in contents
+        self.contents = bytearray()
+        self.raw = None                 # Position : frame, of the messages kept whole
+
+    def add(self, kind, sender_id, stamp, content, frame):
+        position = len(self.kinds)
+        self.kinds.append(kind)
+        self.senders.append(sender_id)
+        self.stamps.append(stamp)
+        if content:
+            self.contents += content
+        self.ends.append(len(self.contents))
+        if kind == _RAW:
+            if self.raw is None:
+                self.raw = {}
+            self.raw[position] = frame
+        if position + 1 == BLOCK:
+            self.contents = bytes(self.contents)    # Full: drop the room a bytearray keeps to grow
+
+    def frame(self, position):
+        kind = self.kinds[position]
+        if kind == _RAW:
+            return self.raw[position]
+        content = self.contents[self.ends[position - 1] if position else 0:self.ends[position]].decode('utf-8')
+        return Protocol.Message(senders.name(self.senders[position]), content,
+                                _unpack_stamp(kind & _STAMP, self.stamps[position]),
+                                seq=self.base + position if kind & _SEQ else None).frame
+
+
+class CompactHistory(RoomHistory):
+    """RoomHistory that keeps its messages as compact records instead of frames"""
+
+    def append(self, message):
+        with self._lock:
+            return self._record(message.sender, message.content, message.timestamp, message.response,
+                                message.seq, message.frame)
+
+    def _clear(self):
+        self._blocks = deque()
+
+    def _frames(self, start, end):
+        blocks, first = self._blocks, self._blocks[0].base if self._blocks else start
+        frames = []
+        for i in range(start, end):
+            block = blocks[(i - first) // BLOCK]
+            frames.append(block.frame(i - block.base))
+        return frames
+
+    def _store(self, frame):
+        try:
+            payload = Protocol.decode(frame)
+        except ValueError:
+            payload = {}
+        if not _FIELDS.issuperset(payload):
+            payload = {}
+        return self._record(payload.get('sender'), payload.get('content'), payload.get('timestamp'),
+                            payload.get('response'), payload.get('seq'), frame)
+
+    def _record(self, sender, content, timestamp, response, seq, frame):
+        index = self._next
+        kind, stamp = _RAW, 0
+        if response == 'message' and isinstance(sender, _TEXT) and isinstance(content, _TEXT) and \
+                (seq is None or seq == index):
+            kind, stamp = _pack_stamp(timestamp)
+        if kind == _RAW:
+            sender_id, content = 0, None
+        else:
+            sender_id, content = senders.id(sender), content.encode('utf-8')
+            if seq is not None:
+                kind |= _SEQ
+        blocks = self._blocks
+        if not blocks or len(blocks[-1].kinds) == BLOCK:
+            blocks.append(_Block(blocks[-1].base + BLOCK if blocks else index))
+        blocks[-1].add(kind, sender_id, stamp, content, frame)
+        self._next = index + 1
+        while blocks[0].base + BLOCK <= self._oldest():
+            blocks.popleft()
+        return index
+
+
+def _pack_stamp(timestamp):
+    """(kind, integer) a timestamp is kept as, (_RAW, 0) if it would not turn back into the same text"""
+    if not isinstance(timestamp, (str, _TEXT)):
+        return _RAW, 0
+    if _SECONDS_TEXT.match(timestamp):
+        return _SECONDS, int(timestamp)
+    if _DATETIME_TEXT.match(timestamp):
+        return _DATETIME, int(re.sub(r'[^0-9]', '', timestamp))
+    return _RAW, 0
+
+
+def _unpack_stamp(kind, stamp):
+    if kind == _SECONDS:
+        return str(stamp)
+    digits = '%014d' % stamp
+    return '%s-%s-%s %s:%s:%s' % (digits[:4], digits[4:6], digits[6:8], digits[8:10], digits[10:12], digits[12:])
+
+
+class DurableHistory(RoomHistory):
+    """
+    RoomHistory backed by a MessageLog. Survives restarts: the ring buffer is
+    refilled from the tail of the log when the history is created.
+    """
+
+    def __init__(self, log, size=DEFAULT_SIZE):
+        start, frames = tail(log, size)
+        super(DurableHistory, self).__init__(size, start, frames)
+        self.log = log
+
+    def append_frame(self, frame):
+        with self._lock:
+            self.log.append(frame)
+            return self._store(frame)
+
+    def page(self, before=None, limit=DEFAULT_PAGE):
+        span = self._log_span(before, limit)
+        if span is None:
+            return super(DurableHistory, self).page(before, limit)
+        start, end, cursor = span
+        return self.log.read(start, end), cursor
+
+    def replay(self, before=None, limit=DEFAULT_PAGE):
+        span = self._log_span(before, limit)
+        if span is None:
+            return super(DurableHistory, self).replay(before, limit)
+        start, end, cursor = span
+        return self.log.regions(start, end), end - start, cursor
+
+    def _first_kept(self):
+        return self.log.first_index
+
+    def _log_span(self, before, limit):
+        """None if the page is in the ring buffer, else (start, end, cursor) of it in the log"""
+        with self._lock:
+            end = self._next if before is None else min(before, self._next)
+            if end - max(0, limit) >= self._oldest():
+                return None
+        oldest = self.log.first_index
+        end = max(end, oldest)
+        start = max(oldest, end - max(0, limit))
+        return start, end, (start if start > oldest else None)
+
+    def __len__(self):
+        return self._next - self.log.first_index
+
+
+def tail(log, size):
+    """
+    (start, frames): the index and frames of the newest `size` messages of a
+    MessageLog. A RoomHistory(size, start, frames) holds the same messages as
+    a DurableHistory of the log, without writing to it.
+    """
+    start = max(log.first_index, log.next_index - size)
+    return start, log.read(start, log.next_index)
+
+
+def parse_cursor(content, default_limit=DEFAULT_PAGE):
+    """
+    Reads the cursor of a history request. content is None (newest page), an
+    index, a "before [limit]" string or a {"before": .., "limit": ..} dict.
+    Returns (before, limit); raises ValueError if content makes no sense.
+    """
+    before, limit = None, default_limit
+    if isinstance(content, dict):
+        before, limit = content.get('before'), content.get('limit', default_limit)
+    elif isinstance(content, (int, float)) and not isinstance(content, bool):
+        before = content
+    elif content is not None:
+        if not hasattr(content, 'split'):
+            raise ValueError("Invalid history cursor")
+        words = content.split()
+        if len(words) > 2:
+            raise ValueError("Expected 'before [limit]'")
+        if words:
+            before = words[0]
+        if len(words) == 2:
+            limit = words[1]
+    try:
+        if before is not None:
+            before = int(before)
+        return before, min(max(int(limit), 0), MAX_PAGE)
+    except (TypeError, ValueError, OverflowError):     # OverflowError: int() of an infinite JSON number
+        raise ValueError("Invalid history cursor")
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import logging
+from Queue import Queue, Full
+from threading import Thread, Lock
+
+import Metrics
+
+"""
+Logging that stays off the request path.
+
+setup() points the root logger at a QueueHandler: a call like
+logging.debug("Sending %s", frame) only checks the level and puts the record
+on a bounded queue. A Listener thread takes the records off, formats them
+and writes them to the file, so neither the string formatting nor the disk
+write happens on the thread that serves clients. When the queue is full,
+records are dropped and counted (log_records_dropped) rather than blocking.
+
+Lines logged once per chat message go through `traffic`. At DEBUG they
+would dominate the log under load, so it lets at most `traffic_rate` of them
+through per second and counts the rest (log_records_suppressed). Those are
+dropped before a LogRecord is even made, which is most of what a logging call
+costs. For the same reason setup() turns off the caller, thread and process
+lookups that every record would otherwise do; FORMAT does not use them.
+
+The level and the traffic rate come from the command line or from the
+CHAT_LOG_LEVEL and CHAT_LOG_TRAFFIC_RATE environment variables. The level is
+INFO unless one of them asks for DEBUG, so a server only logs every frame
+when told to.
+"""
+
+DEFAULT_LEVEL = os.environ.get('CHAT_LOG_LEVEL', 'INFO')
+DEFAULT_TRAFFIC_RATE = float(os.environ.get('CHAT_LOG_TRAFFIC_RATE', 100))   # Records per second
+QUEUE_SIZE = 10000
+FORMAT = '%(levelname)s: %(message)s'
+
+_dropped = Metrics.counter('log_records_dropped')
+_suppressed = Metrics.counter('log_records_suppressed')
+_listener = None
+
+
+class QueueHandler(logging.Handler):
+    """Hands records to a Listener; never formats, never blocks"""
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def createLock(self):
+        self.lock = None        # The queue has a lock of its own
+
+    def handle(self, record):
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            _dropped.add()
+
+
+class Listener(Thread):
+    """Formats and writes the records put on its queue by a QueueHandler"""
+
+    def __init__(self, queue, handler):
+        super(Listener, self).__init__(name="Log")
+        self.daemon = True
+        self.queue = queue
+        self.handler = handler
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self.handler.handle(record)
+            except Exception:
+                self.handler.handleError(record)
+        self.handler.close()
+
+    def stop(self):
+        """Writes what is queued, then ends the thread"""
+        self.queue.put(None)
+        self.join()
+
+
+class RateLimited(object):
+    """
+    Wraps a logger so that its debug() lets `rate` records per second
+    through, in bursts of up to `rate` (a token bucket); None means no limit.
+    """
+
+    def __init__(self, logger, rate=None):
+        self.logger = logger
+        self.rate = rate
+        self._tokens = rate
+        self._last = time.time()
+        self._lock = Lock()
+
+    def debug(self, msg, *args):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        if self.rate is not None and not self._take():
+            _suppressed.add()
+            return
+        self.logger.debug(msg, *args)
+
+    def _take(self):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+traffic = RateLimited(logging.getLogger('traffic'))
+
+
+def setup(filename='server.log', level=DEFAULT_LEVEL, traffic_rate=DEFAULT_TRAFFIC_RATE):
+    """
+    Sends every record of the process to filename through a Listener thread,
+    which is returned; stop() it on the way out so the tail is written.
+    A negative traffic_rate lets every per message record through.
+    """
+    logging._srcfile = None
+    logging.logThreads = logging.logProcesses = logging.logMultiprocessing = 0
+    logging.getLogger().setLevel(level.upper() if hasattr(level, 'upper') else level)
+    traffic.rate = traffic._tokens = traffic_rate if traffic_rate is not None and traffic_rate >= 0 else None
+    return _start(filename)
+
+
+def restart():
+    """
+    Starts a new Listener in a forked worker process, where the parent's
+    thread does not exist. Records of the worker go to the same file.
+    """
+    if _listener is None:
+        return None
+    return _start(_listener.handler.baseFilename)
+
+
+def _start(filename):
+    global _listener
+    queue = Queue(QUEUE_SIZE)
+    handler = logging.FileHandler(filename)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(QueueHandler(queue))
+    _listener = Listener(queue, handler)
+    _listener.start()
+    return _listener
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import time
+import mmap
+import errno
+import struct
+import logging
+import binascii
+from threading import Thread, Lock, Event
+
+"""
+Durable, append-only message log.
+
+Every room has its own directory of segments. A segment is a pair of files
+named after the index of its first message:
+
+    00000000000000000000.log    the message frames, back to back, exactly as
+                                they are sent to clients
+    00000000000000000000.idx    one fixed size entry (offset, length) per frame
+
+Reads go through mmap, so fetching a page of old history touches only the
+pages it needs instead of loading the segment. History replay does not even
+do that: regions() hands out Regions, byte ranges of a segment that are
+written to the client's socket straight from the page cache. Appends go to the page cache
+right away and a single Committer thread fsyncs every dirty segment each
+commit_interval, so one fsync covers every message written in that window
+(group commit) instead of costing one per message.
+
+Retention drops whole segments, oldest first, once a room's log grows past
+retention_bytes or a segment is older than retention_age seconds. Chat
+messages have no keys to compact on, so this is the only compaction done.
+"""
+
+DEFAULT_SEGMENT_BYTES = 64 << 20
+DEFAULT_COMMIT_INTERVAL = 0.005  # Seconds between group commits
+
+_ENTRY = struct.Struct('<II')   # Offset and length of a frame in its segment
+_SEGMENT_NAME = re.compile(r'^(\d{20})\.log$')
+
+_sendfile = getattr(os, 'sendfile', None)   # Python 3 only
+try:
+    _view = buffer                          # Python 2: a slice of obj without copying it
+except NameError:
+    def _view(obj, offset, size):
+        return memoryview(obj)[offset:offset + size]
+
+
+class Segment(object):
+
+    def __init__(self, directory, base):
+        self.base = base
+        self.log_path = os.path.join(directory, '%020d.log' % base)
+        self.index_path = os.path.join(directory, '%020d.idx' % base)
+        flags = os.O_RDWR | os.O_CREAT | os.O_APPEND
+        self._log_fd = os.open(self.log_path, flags, 0o644)
+        self._index_fd = os.open(self.index_path, flags, 0o644)
+        self.size = os.fstat(self._log_fd).st_size
+        self.count = os.fstat(self._index_fd).st_size // _ENTRY.size
+        self.dirty = False
+        self._log_map = None
+        self._index_map = None
+        self._recover()
+
+    def append(self, frame):
+        os.write(self._log_fd, frame)
+        os.write(self._index_fd, _ENTRY.pack(self.size, len(frame)))
+        self.size += len(frame)
+        self.count += 1
+        self.dirty = True
+
+    def entry(self, i):
+        """(offset, length) of the i'th frame of this segment"""
+        index = self._map('_index_map', self._index_fd, self.count * _ENTRY.size)
+        return _ENTRY.unpack_from(index, i * _ENTRY.size)
+
+    def region(self, start, end):
+        """Region holding the frames start..end-1 of this segment"""
+        first = self.entry(start)[0]
+        offset, length = self.entry(end - 1)
+        return Region(self._log_fd, first, offset + length - first)
+
+    def read(self, start, end):
+        """The frames start..end-1 of this segment"""
+        log = self._map('_log_map', self._log_fd, self.size)
+        frames = []
+        for i in range(start, end):
+            offset, length = self.entry(i)
+            frames.append(log[offset:offset + length])
+        return frames
+
+    def sync(self):
+        self.dirty = False
+        os.fsync(self._log_fd)
+        os.fsync(self._index_fd)
+
+    def duplicate(self):
+        """
+        New descriptors of the segment's files, for syncing it without the
+        log's lock: they stay valid, and name these files, whatever happens
+        to the segment meanwhile. The caller closes them.
+        """
+        return [os.dup(self._log_fd), os.dup(self._index_fd)]
+
+    def modified(self):
+        return os.fstat(self._log_fd).st_mtime
+
+    def close(self):
+        self._unmap()
+        os.close(self._log_fd)
+        os.close(self._index_fd)
+
+    def delete(self):
+        self.close()
+        os.unlink(self.log_path)
+        os.unlink(self.index_path)
+
+    def _map(self, name, fd, size):
+        current = getattr(self, name)
+        if current is None or len(current) < size:
+            # The segment grew since it was mapped
+            if current is not None:
+                current.close()
+            current = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            setattr(self, name, current)
+        return current
+
+    def _unmap(self):
+        for name in ('_log_map', '_index_map'):
+            if getattr(self, name) is not None:
+                getattr(self, name).close()
+                setattr(self, name, None)
+
+    def _recover(self):
+        """
+        Frames are written before their index entry, so after a crash the index
+        may miss the last frames or end in a partial entry, and the log may end
+        in a partial frame. Re-index complete frames and cut off the rest.
+        """
+        os.ftruncate(self._index_fd, self.count * _ENTRY.size)
+        end = 0
+        while self.count:
+            offset, length = self.entry(self.count - 1)
+            if offset + length <= self.size:
+                end = offset + length
+                break
+            self.count -= 1
+            os.ftruncate(self._index_fd, self.count * _ENTRY.size)
+        self._unmap()
+        if end == self.size:
+            return
+        with open(self.log_path, 'rb') as f:
+            f.seek(end)
+            tail = f.read()
+        start = 0
+        stop = tail.find(b'\n')
+        while stop != -1:
+            os.write(self._index_fd, _ENTRY.pack(end + start, stop + 1 - start))
+            self.count += 1
+            start = stop + 1
+            stop = tail.find(b'\n', start)
+        if start < len(tail):
+            logging.info("Dropping %d bytes of a partial frame from %s", len(tail) - start, self.log_path)
+            os.ftruncate(self._log_fd, end + start)
+        self.size = end + start
+
+
+class Region(object):
+    """
+    A byte range of a segment file that is sent to a socket without passing
+    through Python strings: with os.sendfile where there is one, else through
+    slices of an mmap of the range. The region has its own descriptor, so the
+    segment may be deleted while the region is still queued for a client.
+    """
+
+    def __init__(self, fd, offset, length):
+        self._fd = os.dup(fd)
+        self._map = None
+        self.offset = offset
+        self.length = length
+        self.sent = 0
+
+    def __len__(self):
+        return self.length - self.sent
+
+    def send(self, sock):
+        """Sends as much as the socket takes. Returns the number of bytes sent"""
+        if _sendfile is not None:
+            sent = _sendfile(sock.fileno(), self._fd, self.offset + self.sent, self.length - self.sent)
+        else:
+            sent = sock.send(self._slice())
+        self.sent += sent
+        if sent == 0 or self.sent >= self.length:
+            # Done, or the file is shorter than it was (sendfile returns 0 at EOF)
+            self.sent = self.length
+            self.close()
+        return sent
+
+    def sendall(self, sock):
+        """Sends the whole region to a blocking socket"""
+        while self.sent < self.length:
+            self.send(sock)
+
+    def close(self):
+        if self._fd is None:
+            return
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:     # A memoryview of it is still alive; the gc unmaps it
+                pass
+            self._map = None
+        os.close(self._fd)
+        self._fd = None
+
+    def _slice(self):
+        if self._map is None:
+            base = self.offset - self.offset % mmap.ALLOCATIONGRANULARITY
+            self._map = mmap.mmap(self._fd, self.offset + self.length - base, access=mmap.ACCESS_READ,
+                                  offset=base)
+            self._skip = self.offset - base
+        return _view(self._map, self._skip + self.sent, self.length - self.sent)
+
+
+class MessageLog(object):
+    """
+    The log of one room. Every frame appended gets the next message index of
+    the room, and read(start, end) returns the frames with indexes in [start, end).
+    """
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES, retention_bytes=None,
+                 retention_age=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_age = retention_age
+        self._lock = Lock()
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        bases = sorted(int(m.group(1)) for m in map(_SEGMENT_NAME.match, os.listdir(directory)) if m)
+        self._segments = [Segment(directory, base) for base in bases] or [Segment(directory, 0)]
+
+    @property
+    def first_index(self):
+        """Index of the oldest message still kept"""
+        return self._segments[0].base
+
+    @property
+    def next_index(self):
+        """Index the next appended message gets"""
+        active = self._segments[-1]
+        return active.base + active.count
+
+    def size(self):
+        return sum(segment.size for segment in self._segments)
+
+    def append(self, frame):
+        """Appends frame and returns its index. It is durable after the next sync()"""
+        with self._lock:
+            active = self._segments[-1]
+            if active.count and active.size + len(frame) > self.segment_bytes:
+                active = self._roll()
+            index = active.base + active.count
+            active.append(frame)
+            return index
+
+    def read(self, start, end):
+        """The frames with indexes in [start, end), clamped to what is kept"""
+        with self._lock:
+            frames = []
+            for segment, first, last in self._spans(start, end):
+                frames.extend(segment.read(first, last))
+            return frames
+
+    def regions(self, start, end):
+        """Regions holding the frames with indexes in [start, end): one per segment touched"""
+        with self._lock:
+            return [segment.region(first, last) for segment, first, last in self._spans(start, end)]
+
+    def sync(self):
+        """Flushes every segment written to since the last sync to disk"""
+        with self._lock:
+            dirty = [segment for segment in self._segments if segment.dirty]
+            fds = []
+            for segment in dirty:
+                segment.dirty = False
+                fds.extend(segment.duplicate())
+        # Retention may close a segment meanwhile, and its descriptors be reused; these are ours
+        try:
+            for fd in fds:
+                os.fsync(fd)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        return len(dirty)
+
+    def retain(self):
+        """Drops the oldest segments that are past the size or age limits. The active one is kept"""
+        with self._lock:
+            now = time.time()
+            size = sum(segment.size for segment in self._segments)
+            while len(self._segments) > 1:
+                oldest = self._segments[0]
+                too_big = self.retention_bytes is not None and size > self.retention_bytes
+                too_old = self.retention_age is not None and oldest.modified() < now - self.retention_age
+                if not (too_big or too_old):
+                    break
+                size -= oldest.size
+                self._segments.pop(0)
+                oldest.delete()
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                if segment.dirty:
+                    segment.sync()
+                segment.close()
+
+    def _roll(self):
+        active = self._segments[-1]
+        if active.dirty:
+            active.sync()
+        segment = Segment(self.directory, active.base + active.count)
+        self._segments.append(segment)
+        return segment
+
+    def _spans(self, start, end):
+        """(segment, first, last) for every segment holding indexes in [start, end)"""
+        start = max(start, self._segments[0].base)
+        for segment in self._segments:
+            first = max(start, segment.base) - segment.base
+            last = min(end, segment.base + segment.count) - segment.base
+            if first < last:
+                yield segment, first, last
+
+
+def room_directory(room):
+    """Directory name for a room. Anything but plain word characters is hex encoded"""
+    if re.match(r'^[A-Za-z0-9_]+$', room):
+        return room
+    return '%' + binascii.hexlify(room.encode('utf-8')).decode('ascii')
+
+
+def room_name(directory):
+    """The room a directory of room_directory() is for"""
+    if directory.startswith('%'):
+        return binascii.unhexlify(directory[1:]).decode('utf-8')
+    return directory
+
+
+class LogStore(object):
+    """
+    The logs of every room under one directory, and the Committer that
+    syncs them.
+    """
+
+    def __init__(self, directory, commit_interval=DEFAULT_COMMIT_INTERVAL, **log_options):
+        self.directory = directory
+        self._log_options = log_options
+        self._logs = {}
+        self._lock = Lock()
+        self.commits = 0        # fsync rounds that had something to flush
+        self._committer = Committer(self, commit_interval)
+        self._committer.start()
+
+    def log(self, room):
+        with self._lock:
+            if room not in self._logs:
+                self._logs[room] = MessageLog(os.path.join(self.directory, room_directory(room)),
+                                              **self._log_options)
+            return self._logs[room]
+
+    def logs(self):
+        with self._lock:
+            return list(self._logs.values())
+
+    def rooms(self):
+        """Every room that has a log on disk, opened or not"""
+        try:
+            entries = os.listdir(self.directory)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        return [room_name(entry) for entry in entries if os.path.isdir(os.path.join(self.directory, entry))]
+
+    def sync(self):
+        synced = sum(log.sync() for log in self.logs())
+        if synced:
+            self.commits += 1
+        return synced
+
+    def retain(self):
+        for log in self.logs():
+            log.retain()
+
+    def close(self):
+        self._committer.stop()
+        for log in self.logs():
+            log.close()
+
+
+class Committer(Thread):
+    """
+    Group commit: syncs the logs of a LogStore every interval seconds, and
+    applies retention now and then.
+    """
+
+    RETAIN_EVERY = 60.0
+
+    def __init__(self, store, interval):
+        super(Committer, self).__init__(name="Committer")
+        self.daemon = True
+        self._store = store
+        self._interval = interval
+        self._stopped = Event()
+
+    def run(self):
+        retained = time.time()
+        while not self._stopped.wait(self._interval):
+            self._store.sync()
+            if time.time() - retained > self.RETAIN_EVERY:
+                self._store.retain()
+                retained = time.time()
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import logging
+import SocketServer
+from thread import get_ident
+from threading import Thread, Lock
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+"""
+Counters, latency histograms and gauges of a running server.
+
+Counters and histograms are updated where things happen; gauges are
+functions that are only called when the metrics are read, so keeping them
+costs nothing in between. Counters take no lock: every thread adds to a
+slot of its own and reading sums the slots. Everything is process wide and read with
+snapshot() (a dict) or render() (text, one "name{labels} value" line per
+value), which is what the admin "stats" request and the scrape endpoint
+started by serve() return.
+
+Histograms are HDR style: values are kept in microseconds with 32 buckets
+per power of two, so any percentile is within about 3% of the real value,
+whatever the range, and recording one is a few integer operations.
+"""
+
+_SUB_BUCKETS = 32
+_BUCKETS = 31 * _SUB_BUCKETS + 2 * _SUB_BUCKETS     # Up to 2**36 us, about 19 hours
+
+_lock = Lock()
+_counters = {}          # (name, labels) : Counter
+_histograms = {}        # (name, labels) : Histogram
+_gauges = {}            # name : (function, label)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Counter(object):
+
+    def __init__(self):
+        self._slots = {}        # thread id : amount
+
+    def add(self, amount=1):
+        slots = self._slots
+        ident = get_ident()
+        slots[ident] = slots.get(ident, 0) + amount
+
+    def value(self):
+        return sum(self._slots.values())
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.total = 0          # Microseconds
+        self._counts = [0] * _BUCKETS
+        self._lock = Lock()
+
+    def record(self, seconds):
+        value = int(seconds * 1e6)
+        shift = value.bit_length() - 6
+        index = (shift * _SUB_BUCKETS) + (value >> shift) if shift > 0 else value
+        self._lock.acquire()
+        self._counts[min(index, _BUCKETS - 1)] += 1
+        self.total += value
+        self._lock.release()
+
+    def summary(self):
+        """Count, mean, p50, p99, p999 and max of the recorded values, in seconds"""
+        with self._lock:
+            counts = list(self._counts)
+            total = self.total
+        number = sum(counts)
+        result = {'count': number, 'mean': total / 1e6 / number if number else 0.0}
+        for name, fraction in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999), ('max', 1.0)):
+            result[name] = self._percentile(counts, fraction * number)
+        return result
+
+    def _percentile(self, counts, wanted):
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if count and seen >= wanted:
+                return self._value(index) / 1e6
+        return 0.0
+
+    @staticmethod
+    def _value(index):
+        """Highest value that falls in bucket index"""
+        shift = max(0, index // _SUB_BUCKETS - 1)
+        return ((index - shift * _SUB_BUCKETS + 1) << shift) - 1
+
+
+def counter(name, **labels):
+    """The Counter for name and labels; like histogram(), look it up once where it is used often"""
+    key = _key(name, labels)
+    with _lock:
+        if key not in _counters:
+            _counters[key] = Counter()
+        return _counters[key]
+
+
+def count(name, amount=1, **labels):
+    counter(name, **labels).add(amount)
+
+
+def histogram(name, **labels):
+    """
+    The Histogram for name and labels. Look it up once and keep it where it is
+    used often; histogram(..).record(seconds) looks it up every time.
+    """
+    key = _key(name, labels)
+    with _lock:
+        if key not in _histograms:
+            _histograms[key] = Histogram()
+        return _histograms[key]
+
+
+def gauge(name, function, label=None):
+    """
+    Registers function as the source of name. It returns a number, or, when
+    label is given, a dict mapping values of that label to numbers.
+    """
+    with _lock:
+        _gauges[name] = (function, label)
+
+
+def snapshot():
+    """{'counters': .., 'gauges': .., 'histograms': ..}, each keyed by name{labels}"""
+    with _lock:
+        counters = dict(_counters)
+        histograms = dict(_histograms)
+        gauges = dict(_gauges)
+    result = {'counters': dict((_name(*key), c.value()) for key, c in counters.items()),
+              'histograms': dict((_name(*key), h.summary()) for key, h in histograms.items()),
+              'gauges': {}}
+    for name, (function, label) in gauges.items():
+        try:
+            value = function()
+        except Exception as e:
+            logging.debug("Gauge %s failed: %s", name, e)
+            continue
+        if label is None:
+            result['gauges'][name] = value
+        else:
+            for label_value, number in value.items():
+                result['gauges'][_name(name, ((label, label_value),))] = number
+    return result
+
+
+def render():
+    """The snapshot as text, one line per value, sorted by name"""
+    values = snapshot()
+    lines = []
+    for name, value in values['counters'].items() + values['gauges'].items():
+        lines.append("%s %s" % (name, value))
+    for name, summary in values['histograms'].items():
+        base, _, labels = name.partition('{')
+        labels = labels.rstrip('}')
+        for field in ('count', 'mean', 'p50', 'p99', 'p999', 'max'):
+            lines.append("%s_%s%s %s" % (base, field, '{%s}' % labels if labels else '', summary[field]))
+    return "\n".join(sorted(lines)) + "\n"
+
+
+def _name(name, labels):
+    if not labels:
+        return name
+    return "%s{%s}" % (name, ",".join('%s="%s"' % label for label in labels))
+
+
+class _ScrapeHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Scrape from %s: %s", self.client_address[0], format % args)
+
+
+class _ScrapeServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def serve(port, host='127.0.0.1'):
+    """Starts the scrape endpoint: GET http://host:port/ returns render()"""
+    server = _ScrapeServer((host, port), _ScrapeHandler)
+    thread = Thread(target=server.serve_forever, name="Metrics")
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+import time
+import socket
+import logging
+from collections import deque
+from threading import Thread, Condition, Lock
+
+import Metrics
+
+"""
+Outbound buffering. Every connection gets a bounded Outbox; broadcasting to a
+client only appends the frame to its Outbox, and a writer (a Writer thread for
+the threaded engine, the loop itself for the event engine) drains it to the
+socket. A client that stops reading can therefore only hurt itself.
+
+Besides encoded frames (bytes) an Outbox can hold objects that write
+themselves to a socket, like the MessageLog.Regions of a history replay. They
+have a length, send(sock), sendall(sock) and close().
+
+What happens when an Outbox is full is decided by its slow consumer policy:
+
+    drop-oldest  - discard the oldest queued frames until the new one fits
+    disconnect   - refuse the frame and tell the caller to drop the client
+
+Writes are coalesced: once a client has been written to, frames queued for
+it in the next `window` seconds are held and written together when the
+window is over, or as soon as `budget` bytes are queued. So a client in a
+busy room gets one write per window instead of one per message, while the
+first frame after a quiet spell goes out at once; no frame waits longer than
+the window. A window of 0 writes every frame as soon as the writer gets it.
+"""
+
+DROP_OLDEST = 'drop-oldest'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, DISCONNECT)
+
+DEFAULT_LIMIT = 1 << 20         # Bytes queued per client
+DEFAULT_WINDOW = 0.002          # Seconds frames are held to be written together
+DEFAULT_BUDGET = 64 << 10       # Bytes that are written without waiting for the window
+DRAIN_TIMEOUT = 5.0             # Seconds a closing connection gets to flush
+
+_counter_lock = Lock()
+_counters = {'dropped_frames': 0, 'dropped_bytes': 0, 'disconnects': 0}
+_open = set()           # Outboxes that still take frames
+_closed_bytes = [0]     # Bytes ever queued in the outboxes that have been closed
+_writes = Metrics.counter('socket_writes')
+
+
+def _count(name, amount=1):
+    with _counter_lock:
+        _counters[name] += amount
+
+
+def counters():
+    """Returns how often each slow consumer policy has fired since start"""
+    with _counter_lock:
+        return dict(_counters)
+
+
+def queued_bytes():
+    """
+    Bytes queued for all clients since start. Every Outbox counts its own
+    under the lock put() takes anyway, so broadcasting pays nothing extra.
+    """
+    with _counter_lock:
+        return _closed_bytes[0] + sum(outbox.total_bytes for outbox in list(_open))
+
+
+def chunks(items):
+    """
+    Groups items taken from an Outbox for writing: each run of frames is
+    joined into one buffer, other items are passed on as they are.
+    """
+    run = []
+    for item in items:
+        if isinstance(item, bytes):
+            run.append(item)
+            continue
+        if run:
+            yield b''.join(run)
+            run = []
+        yield item
+    if run:
+        yield b''.join(run)
+
+
+def release(items):
+    """Frees what the non-frame items among items hold"""
+    for item in items:
+        if not isinstance(item, (bytes, memoryview)):
+            item.close()
+
+
+class Outbox(object):
+    """
+    Bounded queue of encoded frames waiting to be written to one client.
+    """
+
+    def __init__(self, limit=DEFAULT_LIMIT, policy=DROP_OLDEST, window=DEFAULT_WINDOW, budget=DEFAULT_BUDGET):
+        if policy not in POLICIES:
+            raise ValueError("Unknown slow consumer policy '%s'" % policy)
+        self.limit = limit
+        self.policy = policy
+        self.window = window
+        self.budget = budget
+        self.queued_bytes = 0
+        self.total_bytes = 0    # Ever queued
+        self.dropped = 0        # Frames dropped for being too slow, ever
+        self.closed = False
+        self._frames = deque()
+        self._ready = Condition(Lock())
+        self._last_take = 0.0   # When frames were last taken to be written
+        self._holding = False   # The writer waits for the window to end
+        with _counter_lock:
+            _open.add(self)
+
+    def put(self, frame, force=False):
+        """
+        Queues frame. Returns False if the client has to be disconnected,
+        either because it is too slow or because the outbox is closed. Forced
+        frames (replies the client asked for, like a history replay) are
+        queued even if they take the outbox past its limit.
+        """
+        with self._ready:
+            if self.closed:
+                return False
+            if not force and self.queued_bytes + len(frame) > self.limit:
+                if self.policy == DISCONNECT:
+                    _count('disconnects')
+                    return False
+                self._drop_oldest(len(frame))
+            self._frames.append(frame)
+            self.queued_bytes += len(frame)
+            self.total_bytes += len(frame)
+            if not self._holding or self.queued_bytes >= self.budget:
+                self._ready.notify()
+        return True
+
+    def take(self):
+        """Removes and returns every queued frame without blocking"""
+        with self._ready:
+            return self._take()
+
+    def wait(self):
+        """
+        Blocks until frames are queued and their window is over, then returns
+        them all. Returns an empty list once the outbox is closed and drained.
+        """
+        with self._ready:
+            while not self._frames and not self.closed:
+                self._ready.wait()
+            delay = self.hold(time.time())
+            if delay:
+                self._holding = True
+                deadline = time.time() + delay
+                while delay > 0 and not self.closed and self.queued_bytes < self.budget:
+                    self._ready.wait(delay)
+                    delay = deadline - time.time()
+                self._holding = False
+            return self._take()
+
+    def hold(self, now):
+        """Seconds to wait for more frames before writing the queued ones; 0 to write now"""
+        if not self.window or self.closed or self.queued_bytes >= self.budget:
+            return 0
+        return max(0, self._last_take + self.window - now)
+
+    def close(self):
+        """Refuses new frames; frames already queued are still delivered"""
+        with self._ready:
+            self._close()
+            self._ready.notify()
+
+    def abort(self):
+        """Refuses new frames and discards the queued ones"""
+        with self._ready:
+            self._close()
+            release(self._frames)
+            self._frames.clear()
+            self.queued_bytes = 0
+            self._ready.notify()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def _close(self):
+        if not self.closed:
+            self.closed = True
+            with _counter_lock:
+                _open.discard(self)
+                _closed_bytes[0] += self.total_bytes
+
+    def _take(self):
+        frames = list(self._frames)
+        if frames:
+            self._last_take = time.time()
+        self._frames.clear()
+        self.queued_bytes = 0
+        return frames
+
+    def _drop_oldest(self, room):
+        dropped = 0
+        while self._frames and self.queued_bytes + room > self.limit:
+            frame = self._frames.popleft()
+            self.queued_bytes -= len(frame)
+            dropped += 1
+            _count('dropped_bytes', len(frame))
+            release([frame])
+        self.dropped += dropped
+        _count('dropped_frames', dropped)
+
+
+class Writer(Thread):
+    """
+    Drains an Outbox to a blocking socket. Used by the threaded engine, which
+    would otherwise block the broadcasting thread on every slow recipient.
+    """
+
+    def __init__(self, sock, outbox):
+        super(Writer, self).__init__(name="Writer")
+        self.daemon = True
+        self._sock = sock
+        self._outbox = outbox
+
+    def run(self):
+        while True:
+            items = self._outbox.wait()
+            if not items:
+                break
+            try:
+                for chunk in chunks(items):
+                    _writes.add()
+                    if isinstance(chunk, bytes):
+                        self._sock.sendall(chunk)
+                    else:
+                        chunk.sendall(self._sock)
+            except (socket.error, OSError) as e:
+                logging.debug("Closing dead socket: %s", e)
+                release(items)
+                self._outbox.abort()
+                break
+        try:
+            # Wakes up the reading side so the connection is torn down
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import gc
+import os
+import sys
+import time
+import errno
+import signal
+import logging
+import threading
+from thread import get_ident
+from collections import defaultdict
+from threading import Thread, Lock
+
+try:
+    import tracemalloc          # Python 3.4 and later
+except ImportError:
+    tracemalloc = None
+
+"""
+On-demand profiling of a running server, started by an admin's "profile"
+request or by SIGNAL, without a restart.
+
+A Profile is a thread that, for `seconds`, takes a sample every `interval`
+of what every other thread of the process is doing, from
+sys._current_frames(): the handler threads of the threaded engine as well
+as the event loop, the writers and the rest. Nothing in the request path
+knows about it. The command a thread is busy with is read off its stack,
+as the outermost handle_<command> frame, so the per command figures cost
+ClientHandler.handle nothing either, profiling or not.
+
+Samples count wall clock time: a thread blocked in recv, on a lock or in a
+poll counts as much as one running. A command that waits on a room's lock
+shows up in that command, at the line that takes the lock.
+
+Two reports are written to `directory`:
+
+    profile-<time>-<pid>.txt    samples per thread name, per command with
+                                the functions it was in, and per function,
+                                on top of the stack (self) and anywhere in
+                                it (total)
+    memory-<time>-<pid>.txt     what was allocated meanwhile, by line, from
+                                a tracemalloc snapshot diff; where
+                                tracemalloc is not available (Python 2) the
+                                growth of the number of objects by type,
+                                from the gc
+
+Taking a sample holds the interpreter lock for about 20 us per thread, 20
+ms with a thousand threads. So samples are taken further apart than
+`interval` when need be, for the profile to take at most OVERHEAD of the
+time; the report says how far apart they were. One profile is taken at a
+time.
+"""
+
+DEFAULT_SECONDS = 10.0
+MAX_SECONDS = 300.0
+DEFAULT_INTERVAL = 0.01         # Seconds between samples, at least
+OVERHEAD = 0.1                  # Share of the time spent taking samples, at most
+DIRECTORY = 'profiles'
+SIGNAL = signal.SIGUSR1
+TOP = 30                        # Lines per table
+TRACE_FRAMES = 1                # Frames tracemalloc keeps per allocation
+
+_running = Lock()               # Held while a profile is taken
+
+
+def start(seconds=DEFAULT_SECONDS, directory=DIRECTORY, commands=None, done=None):
+    """
+    Starts a Profile and returns it, or None if one is being taken already.
+    commands are the names of the handle_<command> functions to count
+    commands by, every handle_ function if None. done(profile) is called
+    on the profile's thread once the reports are written.
+    """
+    if not _running.acquire(False):
+        return None
+    try:
+        profile = Profile(seconds, directory, commands, done)
+        profile.start()
+    except Exception:
+        _running.release()
+        raise
+    return profile
+
+
+def on_signal(**options):
+    """Starts a profile with options, see start(), when SIGNAL arrives"""
+    signal.signal(SIGNAL, lambda number, frame: start(**options))
+
+
+def _label(code):
+    return "%s:%d(%s)" % (os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+
+
+class Profile(Thread):
+
+    def __init__(self, seconds=DEFAULT_SECONDS, directory=DIRECTORY, commands=None, done=None,
+                 interval=DEFAULT_INTERVAL):
+        super(Profile, self).__init__(name="Profile")
+        self.daemon = True
+        self.seconds = seconds
+        self.interval = interval
+        stamp = "%s-%d" % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+        self.path = os.path.join(directory, 'profile-%s.txt' % stamp)
+        self.memory_path = os.path.join(directory, 'memory-%s.txt' % stamp)
+        self._commands = frozenset(commands) if commands is not None else None
+        self._done = done
+        self.samples = 0
+        self._threads = defaultdict(int)        # thread name : samples
+        self._self = defaultdict(int)           # code : samples on top of the stack
+        self._total = defaultdict(int)          # code : samples anywhere in the stack
+        self._by_command = defaultdict(lambda: defaultdict(int))   # command : code on top : samples
+        self._names = {}                        # thread ident : name
+        self._command_of = {}                   # code : the command it handles, or None
+
+    def run(self):
+        try:
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.')
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            memory = _Allocations()
+            started = time.time()
+            self._sample()
+            with open(self.memory_path, 'w') as f:
+                f.write('\n'.join(memory.report()) + '\n')
+            with open(self.path, 'w') as f:
+                f.write('\n'.join(self._report(started)) + '\n')
+            logging.info("Profile written to %s and %s", self.path, self.memory_path)
+        except Exception:
+            logging.exception("Profiling failed")
+        finally:
+            _running.release()
+        if self._done is not None:
+            self._done(self)
+
+    def _sample(self):
+        own = get_ident()
+        deadline = time.time() + self.seconds
+        while True:
+            started = time.time()
+            if started >= deadline:
+                break
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self._add(ident, frame)
+            self.samples += 1
+            time.sleep(max(self.interval, (time.time() - started) * (1 - OVERHEAD) / OVERHEAD))
+
+    def _add(self, ident, frame):
+        name = self._names.get(ident)
+        if name is None:
+            self._names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            name = self._names.get(ident, "?")
+        self._threads[name] += 1
+        top, command, seen = frame.f_code, None, set()
+        total, command_of = self._total, self._command_of
+        while frame is not None:
+            code = frame.f_code
+            if code not in seen:
+                seen.add(code)
+                total[code] += 1
+            if code not in command_of:
+                name = code.co_name
+                command_of[code] = name[7:] if name.startswith('handle_') and (
+                    self._commands is None or name[7:] in self._commands) else None
+            command = command_of[code] or command
+            frame = frame.f_back
+        self._self[top] += 1
+        if command is not None:
+            self._by_command[command][top] += 1
+
+    def _report(self, started):
+        total = sum(self._threads.values()) or 1
+
+        def percent(count):
+            return 100.0 * count / total
+        lines = ["Profile of %.1f s from %s: %d samples, %.0f ms apart, of %d threads on average" % (
+                     self.seconds, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started)), self.samples,
+                     self.seconds * 1000 / max(self.samples, 1), total / max(self.samples, 1)),
+                 "Percentages are of every sample of every thread, waiting ones included.", "",
+                 "%-40s %10s %8s" % ("thread", "samples", "%")]
+        for name, count in sorted(self._threads.items(), key=lambda item: -item[1])[:TOP]:
+            lines.append("%-40s %10d %7.1f%%" % (name, count, percent(count)))
+        lines += ["", "%-40s %10s %8s" % ("command, then where it was", "samples", "%")]
+        commands = sorted(self._by_command.items(), key=lambda item: -sum(item[1].values()))
+        for command, tops in commands:
+            count = sum(tops.values())
+            lines.append("%-40s %10d %7.1f%%" % (command, count, percent(count)))
+            for code, count in sorted(tops.items(), key=lambda item: -item[1])[:5]:
+                lines.append("    %-60s %7.1f%%" % (_label(code), percent(count)))
+        if not commands:
+            lines.append("(no thread was handling a command)")
+        lines += ["", "%-64s %8s %8s" % ("function", "self", "total")]
+        for code, count in sorted(self._self.items(), key=lambda item: -item[1])[:TOP]:
+            lines.append("%-64s %7.1f%% %7.1f%%" % (_label(code), percent(count), percent(self._total[code])))
+        lines += ["", "%-64s %8s %8s" % ("function, by total", "self", "total")]
+        for code, count in sorted(self._total.items(), key=lambda item: -item[1])[:TOP]:
+            lines.append("%-64s %7.1f%% %7.1f%%" % (_label(code), percent(self._self.get(code, 0)),
+                                                    percent(count)))
+        return lines
+
+
+def _object_counts():
+    counts = defaultdict(int)
+    for obj in gc.get_objects():
+        counts[type(obj).__name__] += 1
+    return counts
+
+
+class _Allocations(object):
+    """What was allocated between its creation and report()"""
+
+    def __init__(self):
+        if tracemalloc is None:
+            self._before = _object_counts()
+            return
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start(TRACE_FRAMES)
+        self._before = tracemalloc.take_snapshot()
+
+    def report(self):
+        if tracemalloc is None:
+            after = _object_counts()
+            growth = sorted(((after[name] - self._before.get(name, 0), name) for name in after), reverse=True)
+            lines = ["tracemalloc is not available on Python %d.%d; objects the gc tracks, by type:" %
+                     sys.version_info[:2], "", "%-40s %12s %12s" % ("type", "objects", "growth")]
+            return lines + ["%-40s %12d %+12d" % (name, after[name], change) for change, name in growth[:TOP]]
+        stats = tracemalloc.take_snapshot().compare_to(self._before, 'lineno')
+        if self._started:
+            tracemalloc.stop()
+        return ["Allocations by line, tracemalloc snapshot diff:", ""] + [str(stat) for stat in stats[:TOP]]
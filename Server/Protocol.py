@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+import json
+import zlib
+import struct
+from threading import Lock
+
+"""
+Wire format shared by the server and the clients.
+
+Every payload is one JSON object followed by a newline. json.dumps escapes
+newlines inside strings, so a raw newline can only ever end a frame. This
+module works on both Python 2 (server, Client.py) and Python 3 (ChatClient.py).
+
+History is sent as a "history" frame with an empty content list and a "count",
+followed by "count" ordinary "message" frames. That lets the server replay the
+frames it stored when the messages were first broadcast instead of encoding
+the whole history again. The frame also carries "before", the cursor the page
+was requested with (None for the newest page), and "next", the cursor to send
+in a "history" request to get the page before it (None at the oldest message).
+Where messages carry a "seq", their index in the room's history, a header
+with "after" instead answers a resume: its messages are the ones after that
+seq, to be added to what the client shows rather than replace it. The answer
+to a "search" request is a "search" frame like it, with the "query", and the
+messages found.
+
+A client can ask for the compact binary encoding by adding
+"encoding": "binary" to its login request; every frame the server sends it
+from then on, the answer to that login included, is binary. Requests stay
+JSON. A binary frame is a struct-packed header followed by a UTF-8 body:
+
+    kind        1 byte      MESSAGE, INFO, ERROR, HISTORY, SEARCH, SENDER or SEQ
+    sender      4 bytes     id of the sender, 0 for the server
+    timestamp   4 bytes     seconds since the epoch
+    length      4 bytes     of the body
+
+The body is the content, except for HISTORY and SEARCH, whose body is the JSON
+object {"count": .., "before": .., "next": ..} (and "query"). Sender names are interned: the first
+time a connection gets a frame from a sender, it is preceded by a SENDER
+frame whose body is the name for that id. A message with a "seq" is
+preceded by a SEQ frame whose body is that seq in decimal, so binary clients
+can resume too. The kind byte is never "{", so a StreamDecoder tells both
+encodings apart frame by frame.
+
+Independently of the encoding, a login request with "compression": "zlib"
+turns on compression for the connection. The server then keeps one zlib
+stream per connection, so what it learned from earlier frames (sender names,
+JSON keys, common words) compresses the later ones. Writes of at least
+COMPRESS_THRESHOLD bytes go out as a COMPRESSED frame, a binary header whose
+body is the next piece of that stream, flushed so it decompresses to whole
+frames; shorter writes, like most single chat messages, go out as they are.
+"""
+
+DELIMITER = b'\n'
+MAX_FRAME_SIZE = 1 << 20
+
+JSON, BINARY = 'json', 'binary'
+ENCODINGS = (JSON, BINARY)
+
+ZLIB = 'zlib'
+COMPRESSIONS = (ZLIB,)
+COMPRESS_THRESHOLD = 512        # Bytes; shorter writes are not compressed
+
+MESSAGE, INFO, ERROR, HISTORY, SENDER, COMPRESSED, SEARCH, SEQ = 1, 2, 3, 4, 5, 6, 7, 8
+KINDS = {'message': MESSAGE, 'info': INFO, 'error': ERROR, 'history': HISTORY, 'search': SEARCH}
+RESPONSES = dict((kind, response) for response, kind in KINDS.items())
+SERVER_ID = 0
+
+_HEADER = struct.Struct('!BIII')
+_JSON_START = frozenset(bytearray(b'{ \t\r\n'))    # First bytes of a JSON frame
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def encode(payload):
+    """Serializes payload (a dict) to one frame, ready to be written to a socket"""
+    return json.dumps(payload).encode('utf-8') + DELIMITER
+
+
+def decode(frame):
+    """Parses one frame as returned by FrameDecoder.feed. Raises ValueError on invalid JSON"""
+    return json.loads(frame.decode('utf-8'))
+
+
+class Message(object):
+    """
+    A chat message as the server keeps it: encoded to a frame once, when it is
+    received, and that same frame is broadcast, stored and replayed.
+    """
+
+    def __init__(self, sender, content, timestamp, response='message', seq=None):
+        self.sender = sender
+        self.content = content
+        self.timestamp = timestamp
+        self.response = response
+        self.seq = seq
+        payload = {'content': content, 'sender': sender, 'response': response, 'timestamp': timestamp}
+        if seq is not None:
+            payload['seq'] = seq
+        self.frame = encode(payload)
+        self._binary = None
+
+    @classmethod
+    def from_frame(cls, frame):
+        """The Message a stored or relayed JSON frame was encoded from"""
+        payload = decode(frame)
+        return cls(payload.get('sender'), payload.get('content'), payload.get('timestamp'),
+                   payload.get('response', 'message'), payload.get('seq'))
+
+    def binary(self, sender_id):
+        """The message as a binary frame, behind the SEQ frame of its seq, with sender_id from the server's Interner"""
+        if self._binary is None:
+            self._binary = encode_binary(KINDS[self.response], sender_id, self.timestamp, self.content)
+            if self.seq is not None:
+                self._binary = encode_binary(SEQ, SERVER_ID, 0, u"%d" % self.seq) + self._binary
+        return self._binary
+
+
+def encode_binary(kind, sender_id, timestamp, body):
+    """One binary frame; body is a unicode string, or a dict for HISTORY"""
+    if isinstance(body, dict):
+        body = json.dumps(body)
+    body = (body or u'').encode('utf-8')
+    return _HEADER.pack(kind, sender_id, int(timestamp or 0), len(body)) + body
+
+
+class Compressor(object):
+    """
+    The server's end of a compressed connection. Not thread safe: the pieces
+    must be written in the order they were made, so callers serialize
+    wrap() and the write that follows it.
+    """
+
+    def __init__(self, threshold=COMPRESS_THRESHOLD, level=6):
+        self.threshold = threshold
+        self._zlib = zlib.compressobj(level)
+
+    def wrap(self, data):
+        """data, or a COMPRESSED frame holding it if it is at least threshold bytes"""
+        if len(data) < self.threshold:
+            return data
+        body = self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+        return _HEADER.pack(COMPRESSED, SERVER_ID, 0, len(body)) + body
+
+
+class Interner(object):
+    """Gives every sender name a small integer id, the same one for good"""
+
+    def __init__(self):
+        self._ids = {}
+        self._names = []        # id - 1 : name, one shared object per name
+        self._lock = Lock()
+
+    def id(self, name):
+        try:
+            return self._ids[name]
+        except KeyError:
+            with self._lock:
+                if name not in self._ids:
+                    self._names.append(name)
+                    self._ids[name] = len(self._names)
+                return self._ids[name]
+
+    def name(self, sender_id):
+        return self._names[sender_id - 1]
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class FrameDecoder(object):
+    """
+    Incremental decoder for one connection. Feed it whatever recv() returned;
+    it returns every frame completed by that data and keeps the partial tail
+    for the next call. Bytes are only scanned for a delimiter once.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self._buffer = bytearray()
+        self._scanned = 0
+        self._max_frame_size = max_frame_size
+
+    def feed(self, data):
+        """Returns a list with the raw bytes of every frame completed by data"""
+        buf = self._buffer
+        buf += data
+        frames = []
+        start = 0
+        end = buf.find(DELIMITER, self._scanned)
+        while end != -1:
+            frame = bytes(buf[start:end])
+            if frame.strip():
+                frames.append(frame)
+            start = end + 1
+            end = buf.find(DELIMITER, start)
+        if start:
+            del buf[:start]
+        self._scanned = len(buf)
+        if self._scanned > self._max_frame_size:
+            raise ProtocolError("Frame exceeds %d bytes" % self._max_frame_size)
+        return frames
+
+    def pending(self):
+        """Number of buffered bytes that do not yet form a complete frame"""
+        return len(self._buffer)
+
+
+class StreamDecoder(object):
+    """
+    Client side decoder that takes both JSON and binary frames, in any mix.
+    feed() returns the payload dict of every frame completed by data; binary
+    frames are turned into the same dicts JSON frames decode to, with the
+    timestamp as a string, and the seq of a SEQ frame on the frame after it.
+    COMPRESSED frames are inflated and decoded in turn. Frames that cannot be
+    parsed are skipped.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, senders=None):
+        self._buffer = bytearray()
+        self._max_frame_size = max_frame_size
+        self._senders = {SERVER_ID: u"server"} if senders is None else senders
+        self._inflate = None    # zlib stream and decoder of its frames, once compressed frames arrive
+        self._inner = None
+        self._seq = None        # From a SEQ frame, for the frame after it
+
+    def feed(self, data):
+        buf = self._buffer
+        buf += data
+        payloads = []
+        start = 0
+        while start < len(buf):
+            if buf[start] in _JSON_START:
+                end = buf.find(DELIMITER, start)
+                if end == -1:
+                    break
+                frame = bytes(buf[start:end])
+                start = end + 1
+                if frame.strip():
+                    try:
+                        payloads.append(decode(frame))
+                    except ValueError:
+                        pass
+                continue
+            if len(buf) - start < _HEADER.size:
+                break
+            kind, sender, timestamp, length = _HEADER.unpack_from(bytes(buf[start:start + _HEADER.size]))
+            if length > self._max_frame_size:
+                raise ProtocolError("Frame exceeds %d bytes" % self._max_frame_size)
+            end = start + _HEADER.size + length
+            if len(buf) < end:
+                break
+            body = bytes(buf[start + _HEADER.size:end])
+            start = end
+            if kind == COMPRESSED:
+                if self._inflate is None:
+                    self._inflate = zlib.decompressobj()
+                    self._inner = StreamDecoder(self._max_frame_size, self._senders)
+                try:
+                    payloads.extend(self._inner.feed(self._inflate.decompress(body)))
+                except zlib.error as e:
+                    raise ProtocolError("Corrupt compressed frame: %s" % e)
+                continue
+            body = body.decode('utf-8')
+            if kind == SENDER:
+                self._senders[sender] = body
+                continue
+            if kind == SEQ:
+                try:
+                    self._seq = int(body)
+                except ValueError:
+                    self._seq = None
+                continue
+            payload = {'response': RESPONSES.get(kind), 'sender': self._senders.get(sender, u""),
+                       'timestamp': str(timestamp)}
+            if self._seq is not None:
+                payload['seq'], self._seq = self._seq, None
+            if kind in (HISTORY, SEARCH):
+                payload.update(json.loads(body))
+                payload['content'] = []
+            else:
+                payload['content'] = body
+            payloads.append(payload)
+        if start:
+            del buf[:start]
+        if len(buf) > self._max_frame_size + _HEADER.size:
+            raise ProtocolError("Frame exceeds %d bytes" % self._max_frame_size)
+        return payloads
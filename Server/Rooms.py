@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+from threading import Lock
+
+import Protocol
+
+"""
+Chatrooms of Server.py.
+
+Every client is in exactly one Room, "all" after login. A room has its own
+members and its own history, so a message costs one append and one send per
+member of its room, whatever the number of clients on the server.
+
+A room's lock guards its members and the order of its history. Messages
+are queued for the members after the lock is released, from a snapshot of
+the members: holding it for the whole fan-out would serialize every sender
+of a busy room behind it. Like before rooms, two messages sent at the same
+moment may therefore reach two members in different orders; the history
+has the one order. A client never holds two room locks at once.
+
+Rooms are made on first use and kept, with their history, for as long as the
+server runs, empty or not. Names are alphanumeric, like usernames, which also
+keeps them usable as directory names of the message log.
+
+A room may have a Search.RoomIndex. A message is queued for it under the
+lock, so it is indexed in the order of the history, and indexed after the
+members have it. A new room indexes the messages of its history the index
+does not have yet: all of them, log included, unless the index was restored
+from a snapshot.
+"""
+
+DEFAULT = u"all"        # The room every client is in after login
+REPLAY = 4096           # Messages read from the history at once to index them
+
+
+def valid_name(name):
+    return bool(name) and name.isalnum()
+
+
+class Room(object):
+
+    def __init__(self, name, history, index=None):
+        self.name = name
+        self.history = history
+        self.index = index      # Search.RoomIndex, if messages are searchable
+        self.members = {}       # username : ClientHandler
+        self.lock = Lock()
+        if index is not None:
+            self._index_history()
+
+    def join(self, username, client):
+        with self.lock:
+            self.members[username] = client
+
+    def leave(self, username, client):
+        """Removes username, unless another client took its place already"""
+        with self.lock:
+            if self.members.get(username) is client:
+                del self.members[username]
+
+    def names(self):
+        with self.lock:
+            return list(self.members)
+
+    def broadcast(self, message, trace=None):
+        """
+        Appends a Protocol.Message to the history and queues it for every
+        member, with a Trace.Stamp behind it if the message is traced.
+        """
+        with self.lock:
+            self._index(self.history.append(message), message.content)
+            members = list(self.members.values())
+        for client in members:
+            client.send_message(message)
+            if trace is not None:
+                client.queue(trace.enqueued(), True)
+        if self.index is not None:
+            self.index.catch_up()
+
+    def broadcast_frame(self, frame):
+        """Same as broadcast, for a message that is already encoded as JSON"""
+        message = Protocol.Message.from_frame(frame) if self.index is not None else None
+        with self.lock:
+            self._index(self.history.append_frame(frame), message and message.content)
+            members = list(self.members.values())
+        for client in members:
+            if client.binary:
+                message = message or Protocol.Message.from_frame(frame)
+                client.send_message(message)
+            else:
+                client.send(frame)
+        if self.index is not None:
+            self.index.catch_up()
+
+    def search(self, query, before=None, limit=50):
+        """Search.RoomIndex.search, with the frames of the messages found instead of their indexes"""
+        first = self.history.next_index - len(self.history)
+        indexes, cursor = self.index.search(query, before, limit, first)
+        frames = []
+        for i in indexes:
+            frames.extend(self.history.page(i + 1, 1)[0])
+        return frames, cursor
+
+    def _index_history(self):
+        first, end = self.history.next_index - len(self.history), self.history.next_index
+        if self.index.end is not None and self.index.end > end:
+            self.index.clear()  # Of messages this history does not have
+        start = max(first, self.index.end or 0)
+        while start < end:
+            stop = min(start + REPLAY, end)
+            frames, _ = self.history.page(stop, stop - start)
+            for i, frame in enumerate(frames, start):
+                self.index.add(i, Protocol.decode(frame).get('content'), first)
+            self.index.catch_up()
+            start = stop
+
+    def _index(self, i, text):
+        if self.index is not None:
+            self.index.add(i, text, self.history.next_index - len(self.history))
+
+
+class Rooms(object):
+    """
+    Every room of the server, made on first use with history_factory(name),
+    and index_factory(name) for its Search.RoomIndex if there is one.
+    """
+
+    def __init__(self, history_factory, index_factory=None):
+        self._history_factory = history_factory
+        self._index_factory = index_factory
+        self._rooms = {}
+        self._lock = Lock()
+
+    def get(self, name):
+        room = self._rooms.get(name)
+        if room is None:
+            with self._lock:
+                room = self._rooms.get(name)
+                if room is None:
+                    room = self._rooms[name] = Room(name, self._history_factory(name),
+                                                    self._index_factory(name) if self._index_factory else None)
+        return room
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._rooms.values()))
+
+    def __len__(self):
+        return len(self._rooms)
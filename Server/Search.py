@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+import re
+import sys
+import heapq
+import bisect
+import struct
+from array import array
+from collections import deque
+from threading import Lock
+
+"""
+Full text search over the history of a room.
+
+A RoomIndex maps every word of a room's messages to the indexes of the
+messages it occurs in, the same indexes history cursors are made of. It is
+kept in segments of at most SEGMENT consecutive messages; a segment has a
+dict of term : array of offsets from its first index, 2 bytes a posting,
+and a list of its terms, sorted when a prefix query needs it.
+
+Messages are added as they are stored, in the order of their indexes, so
+every array is sorted. add() only queues a message, which is cheap enough
+to do under the room's lock; finding its words and indexing them is left
+to catch_up(), after the message went out to the room, or to the next
+search.
+
+A query is words that must all occur in a message; a word ending in "*"
+matches every term it is the start of. Matches are found newest first: the
+word with the fewest postings gives the candidates, walked backwards from
+the cursor, and every other word is looked up in its arrays with bisect.
+A page costs lookups in the order of the postings it skips, not of the
+room's history, and it never builds a list of every match.
+
+Memory is bounded by max_bytes, an estimate that counts the postings and,
+per term of a segment, the term and TERM_BYTES for the dict entry, list
+slot and array that hold it. When it is over, the oldest segment is dropped
+and its messages can no longer be found; search results from messages the
+history no longer keeps are skipped. Segments are also closed early at a
+quarter of max_bytes, so a drop never takes more than that. The estimate
+is of the objects themselves; interleaved with the short-lived objects of
+the messages, the resident memory they take can be twice as much
+(Benchmarks/SearchIndex.py measures both).
+
+A room indexes its whole history when it is made, the message log
+included, which takes time in the order of the history's length. dump()
+and load() save and restore an index as bytes instead, for Snapshot.py:
+per segment its terms as one NUL separated UTF-8 string, the number of
+postings of every term, and every term's offsets back to back, as
+little-endian arrays that are written and read whole. A room restored from
+a snapshot indexes only the messages after end.
+"""
+
+SEGMENT = 1 << 16               # Messages per segment; offsets are unsigned shorts
+DEFAULT_MEMORY = 32 << 20       # Estimated bytes of index per room
+MAX_TERM = 32                   # Characters of a term; longer words are cut in several
+MAX_WORDS = 8                   # Words of a query
+MAX_EXPANSION = 256             # Terms a prefix may match in one segment
+TERM_BYTES = 120                # Per term of a segment, besides the term itself
+
+_WORD = re.compile(r'\w{1,%d}' % MAX_TERM, re.UNICODE)
+_TEXT = type(u'')
+_SEGMENT = struct.Struct('<QQII')   # base, end, terms and postings of a dumped segment
+
+
+def _to_bytes(values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+
+
+def _from_bytes(typecode, data):
+    values = array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def terms(text):
+    """The distinct terms of a message's content"""
+    if not isinstance(text, _TEXT):
+        return ()
+    return set(_WORD.findall(text.lower()))
+
+
+def parse_query(query):
+    """
+    A query as a list of (term, is_prefix), from a string of words where a
+    trailing "*" makes a word a prefix. Raises ValueError if it has no words,
+    or more than MAX_WORDS.
+    """
+    if not isinstance(query, _TEXT):
+        raise ValueError("Usage: search(words), a word ending in * matches the start of words")
+    parsed = set()
+    for part in query.lower().split():
+        words = _WORD.findall(part)
+        for i, word in enumerate(words):
+            parsed.add((word, part.endswith('*') and i == len(words) - 1))
+    if not parsed:
+        raise ValueError("Nothing to search for")
+    if len(parsed) > MAX_WORDS:
+        raise ValueError("Search for at most %d words at once" % MAX_WORDS)
+    return sorted(parsed)
+
+
+class _Segment(object):
+
+    __slots__ = ('base', 'end', 'postings', 'terms', 'unsorted', 'count', 'bytes')
+
+    def __init__(self, base):
+        self.base = base        # Index of the first message
+        self.end = base         # Index after the last one added
+        self.postings = {}      # term : array of offsets from base
+        self.terms = []
+        self.unsorted = False   # Terms were added to terms since it was sorted
+        self.count = 0          # Postings
+        self.bytes = 0
+
+    def add(self, offset, words):
+        postings = self.postings
+        for word in words:
+            offsets = postings.get(word)
+            if offsets is None:
+                offsets = postings[word] = array('H')
+                self.terms.append(word)
+                self.unsorted = True
+                self.bytes += TERM_BYTES + sys.getsizeof(word)
+            offsets.append(offset)
+        self.count += len(words)
+        self.bytes += 2 * len(words)
+        self.end = self.base + offset + 1
+
+    def matches(self, query, end, low, limit):
+        """Indexes of at most limit matches from below end down to low, newest first"""
+        groups = []
+        for term, prefix in query:
+            arrays = self._arrays(term, prefix)
+            if not arrays:
+                return []
+            groups.append(arrays)
+        groups.sort(key=lambda arrays: sum(len(offsets) for offsets in arrays))
+        end, low = end - self.base, max(0, low - self.base)
+        checks = [_member(arrays, end, low) for arrays in groups[1:]]
+        found = []
+        for offset in _newest_first(groups[0], end, low):
+            if all(check(offset) for check in checks):
+                found.append(self.base + offset)
+                if len(found) == limit:
+                    break
+        return found
+
+    def _arrays(self, term, prefix):
+        if not prefix:
+            offsets = self.postings.get(term)
+            return [offsets] if offsets is not None else []
+        if self.unsorted:
+            self.terms.sort()   # Mostly sorted already, which sort() is quick at
+            self.unsorted = False
+        start = i = bisect.bisect_left(self.terms, term)
+        while i < len(self.terms) and self.terms[i].startswith(term):
+            i += 1
+            if i - start > MAX_EXPANSION:
+                raise ValueError(u"Too many words start with '%s'" % term)
+        return [self.postings[word] for word in self.terms[start:i]]
+
+    def dump(self):
+        if self.unsorted:
+            self.terms.sort()
+            self.unsorted = False
+        counts = array('I', [len(self.postings[term]) for term in self.terms])
+        offsets = array('H')
+        for term in self.terms:
+            offsets.extend(self.postings[term])
+        words = u'\0'.join(self.terms).encode('utf-8')
+        return [_SEGMENT.pack(self.base, self.end, len(self.terms), len(offsets)), _to_bytes(counts),
+                struct.pack('<I', len(words)), words, _to_bytes(offsets)]
+
+    @classmethod
+    def load(cls, data, at):
+        """(segment, offset after it) of the segment dump() wrote at offset at of data"""
+        base, end, count, postings = _SEGMENT.unpack_from(data, at)
+        at += _SEGMENT.size
+        counts = _from_bytes('I', data[at:at + 4 * count])
+        at += 4 * count
+        size, = struct.unpack_from('<I', data, at)
+        at += 4
+        words = data[at:at + size].decode('utf-8').split(u'\0') if count else []
+        at += size
+        offsets = _from_bytes('H', data[at:at + 2 * postings])
+        at += 2 * postings
+        segment = cls(base)
+        segment.end, segment.terms, segment.count = end, words, postings
+        position = 0
+        for word, number in zip(words, counts):
+            segment.postings[word] = offsets[position:position + number]
+            position += number
+            segment.bytes += TERM_BYTES + sys.getsizeof(word)
+        segment.bytes += 2 * postings
+        return segment, at
+
+
+def _newest_first(arrays, end, low):
+    """Offsets in any of arrays, from below end down to low, each once"""
+    if len(arrays) == 1:
+        offsets = arrays[0]
+        i = bisect.bisect_left(offsets, end) - 1
+        while i >= 0 and offsets[i] >= low:
+            yield offsets[i]
+            i -= 1
+        return
+    last = None
+    for negated in heapq.merge(*[(-offset for offset in _newest_first([offsets], end, low)) for offsets in arrays]):
+        if negated != last:
+            last = negated
+            yield -negated
+
+
+def _member(arrays, end, low):
+    """A test for whether an offset is in any of arrays"""
+    if len(arrays) == 1:
+        offsets = arrays[0]
+
+        def contains(offset):
+            i = bisect.bisect_left(offsets, offset)
+            return i < len(offsets) and offsets[i] == offset
+        return contains
+    return frozenset(_newest_first(arrays, end, low)).__contains__
+
+
+class RoomIndex(object):
+    """The inverted index of one room, see the module's docstring"""
+
+    def __init__(self, max_bytes=DEFAULT_MEMORY):
+        if max_bytes < 1:
+            raise ValueError("Search index memory must be positive")
+        self.max_bytes = max_bytes
+        self.bytes = 0          # Estimated, of every segment
+        self.postings = 0
+        self._segments = deque()
+        self._pending = deque()     # (index, text, first) of messages not indexed yet
+        self._lock = Lock()
+
+    def add(self, index, text, first=0):
+        """
+        Queues the content of the message at index, which must be higher than
+        that of any message added before. Segments that end before first, the
+        oldest index the history still keeps, are dropped as new ones start.
+        """
+        self._pending.append((index, text, first))
+
+    def catch_up(self):
+        """Indexes the messages add() queued"""
+        with self._lock:
+            self._catch_up()
+
+    def search(self, query, before=None, limit=50, first=0):
+        """
+        (indexes, cursor): the indexes of the newest `limit` messages older
+        than index before that match a parse_query() query, oldest first,
+        and the cursor of the page before them, None if there is nothing
+        older to look at. first is the oldest index the history keeps.
+        Raises ValueError if a prefix matches too many terms.
+        """
+        found = []
+        with self._lock:
+            self._catch_up()
+            for segment in reversed(self._segments):
+                if len(found) >= limit or segment.end <= first:
+                    break
+                if before is not None and segment.base >= before:
+                    continue
+                end = segment.end if before is None else min(before, segment.end)
+                found.extend(segment.matches(query, end, first, limit - len(found)))
+            oldest = self._segments[0].base if self._segments else 0
+        found.reverse()
+        more = found and len(found) >= limit and found[0] > max(first, oldest)
+        return found, (found[0] if more else None)
+
+    @property
+    def end(self):
+        """Index after the newest message indexed, None if the index is empty"""
+        with self._lock:
+            self._catch_up()
+            return self._segments[-1].end if self._segments else None
+
+    def dump(self):
+        """The index as bytes, for load(). Searches can go on meanwhile, between segments"""
+        with self._lock:
+            self._catch_up()
+            segments = list(self._segments)
+        parts = [struct.pack('<I', len(segments))]
+        for segment in segments:
+            with self._lock:
+                parts.extend(segment.dump())
+        return b''.join(parts)
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+            self._segments.clear()
+            self.bytes = self.postings = 0
+
+    def load(self, data):
+        """Replaces the contents of the index by what dump() returned, within max_bytes"""
+        count, = struct.unpack_from('<I', data)
+        at, segments = 4, deque()
+        for _ in range(count):
+            segment, at = _Segment.load(data, at)
+            segments.append(segment)
+        with self._lock:
+            self._pending.clear()
+            self._segments = segments
+            self.bytes = sum(segment.bytes for segment in segments)
+            self.postings = sum(segment.count for segment in segments)
+            while self.bytes > self.max_bytes and len(segments) > 1:
+                self._drop()
+
+    @property
+    def oldest(self):
+        """Index of the oldest message that can be found, None if the index is empty"""
+        with self._lock:
+            self._catch_up()
+            return self._segments[0].base if self._segments else None
+
+    def _catch_up(self):
+        pending, segments = self._pending, self._segments
+        while pending:
+            index, text, first = pending.popleft()
+            if not segments or index - segments[-1].base >= SEGMENT or segments[-1].bytes >= self.max_bytes // 4:
+                while segments and segments[0].end <= first:
+                    self._drop()
+                segments.append(_Segment(index))
+            segment = segments[-1]
+            words = terms(text)
+            before = segment.bytes
+            segment.add(index - segment.base, words)
+            self.bytes += segment.bytes - before
+            self.postings += len(words)
+            while self.bytes > self.max_bytes and len(segments) > 1:
+                self._drop()
+
+    def _drop(self):
+        segment = self._segments.popleft()
+        self.bytes -= segment.bytes
+        self.postings -= segment.count
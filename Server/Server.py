@@ -1,13 +1,32 @@
 # -*- coding: utf-8 -*-
 import SocketServer
+import os
 import socket
-import json
 import logging
+import argparse
 
 import time
 import calendar
+import hashlib
+import multiprocessing
+from threading import Lock, Thread
 
-logging.basicConfig(filename='server.log', format='%(levelname)s: %(message)s', level=logging.DEBUG)
+import Admission
+import Bus
+import EventServer
+import Handoff
+import History
+import Log
+import MessageLog
+import Metrics
+import Outbox
+import Profiler
+import Protocol
+import Rooms
+import Search
+import Snapshot
+import Throttle
+import Trace
 
 """
 Variables and functions that must be used by all the ClientHandler objects
@@ -24,94 +43,306 @@ class ClientHandler(SocketServer.BaseRequestHandler):
     logic for the server, you must write it outside this class
     """
 
-    _history = []
+    _rooms = Rooms.Rooms(lambda room: History.RoomHistory())
     _client_list = {}
+    _bus = None             # Bus.Peer when this is one worker of several
+    _senders = Protocol.Interner()      # Sender ids of the binary encoding
+    _command_latency = dict((command, Metrics.histogram('command_seconds', command=command))
+                            for command in ('login', 'logout', 'message', 'names', 'help', 'history', 'stats',
+                                             'chatroom', 'limit', 'search', 'profile'))
+    _throttled = dict((command, Metrics.counter('requests_throttled', command=command))
+                      for command in _command_latency)
+    _text_commands = frozenset(('login', 'message', 'chatroom', 'limit', 'search'))    # Their content is a string
+    _bytes_in = Metrics.counter('bytes_in')
+    _compressed_in = Metrics.counter('compression_bytes', stage='in')
+    _compressed_out = Metrics.counter('compression_bytes', stage='out')
 
-    def handle(self):
+    admins = {}             # username : md5 of the password, see load_admins()
+    profile_dir = Profiler.DIRECTORY
+
+    history_page = History.DEFAULT_PAGE
+    compress_threshold = Protocol.COMPRESS_THRESHOLD
+
+    outbox_limit = Outbox.DEFAULT_LIMIT
+    slow_consumer_policy = Outbox.DROP_OLDEST
+    coalesce_window = Outbox.DEFAULT_WINDOW
+    coalesce_bytes = Outbox.DEFAULT_BUDGET
+
+    connection_rate = Throttle.CONNECTION_RATE
+    command_rates = Throttle.COMMAND_RATES
+    flood_limit = Throttle.FLOOD_LIMIT
+
+    trace_rate = 0.0        # Share of the messages traced to every recipient, see Trace.py
+
+    def setup(self):
         """
-        This method handles the connection between a client and the server.
+        Per-connection state. Kept out of handle() so that engines which do not
+        give each client its own thread (see EventServer.py) can reuse it.
         """
         self.ip = self.client_address[0]
         self.port = self.client_address[1]
         self.connection = self.request
         self.username = None
+        self.admin = False
+        self.room = None        # Rooms.Room, once logged in
+        self._payload = None    # The request being handled
+        self._received = None   # When the chunk being handled was read, if messages are traced
+        self.binary = False     # Frames are sent in the binary encoding, see Protocol.py
+        self._known_senders = set()     # Sender ids this client got the name of
+        self._drops_seen = 0            # outbox.dropped when _known_senders was last trusted
+        self._compressor = None         # Protocol.Compressor, if the client asked for compression
+        self._compress_lock = None      # Keeps the compressed pieces in stream order
+        self._decoder = Protocol.FrameDecoder()
+        self._limits = Throttle.Limits(self.connection_rate, self.command_rates)
+        self._writer = None
+        self.outbox = self._new_outbox()
         self._commands = {'login': self.handle_login, 'logout': self.handle_logout, 'message': self.handle_message,
-                          'names': self.handle_names, 'help': self.handle_help}
+                          'names': self.handle_names, 'help': self.handle_help, 'history': self.handle_history,
+                          'stats': self.handle_stats, 'chatroom': self.handle_chatroom,
+                          'limit': self.handle_limit, 'search': self.handle_search,
+                          'profile': self.handle_profile}
+        Metrics.count('connections_opened')
 
+    def handle(self):
+        """
+        This method handles the connection between a client and the server.
+        """
+        self._writer = Outbox.Writer(self.connection, self.outbox)
+        self._writer.start()
         while True:
             try:
                 received_string = self.connection.recv(4096)
             except socket.error as e:
-                logging.debug("Client disconnected %s" % e)
-                if self.username is not None:
-                    self._client_list.pop(self)
+                logging.debug("Client disconnected %s", e)
                 break
-            logging.debug("Received string:'%s'" % received_string)
-            logging.debug("Host: '%s', Port: '%s'" % (self.ip, self.port))
-            try:
-                req = json.loads(received_string)
-            except ValueError as e:
-                logging.debug("Could not parse JSON-string: '%s'" % received_string)
-                break
-            command = req.get('request', 'help')
-            content = req.get('content', None)
-            if command not in self._commands:
-                command = 'help'
-            self._commands.get(command)(content)
-            if command == 'logout':
+            if not received_string or not self.handle_received(received_string):
                 break
 
+    def finish(self):
+        Metrics.count('connections_closed')
+        if self._logged_in(self.username) and self._client_list[self.username] is self:
+            self._leave()
+            self._client_list.pop(self.username)
+            if self._bus is not None:
+                self._bus.release(self.username)
+        self.outbox.close()
+        if self._writer is not None:
+            self._writer.join(Outbox.DRAIN_TIMEOUT)
+
+    def handle_received(self, received_string):
+        """
+        Feeds one chunk read from the client to the frame decoder and dispatches
+        every complete request in it. Returns False when the connection should
+        be closed.
+        """
+        Log.traffic.debug("Received string:'%s' from Host: '%s', Port: '%s'", received_string, self.ip, self.port)
+        self._bytes_in.add(len(received_string))
+        if self.trace_rate:
+            self._received = time.time()
+        try:
+            frames = self._decoder.feed(received_string)
+        except Protocol.ProtocolError as e:
+            logging.debug("Dropping client: %s", e)
+            return False
+        for frame in frames:
+            if not self.handle_frame(frame):
+                return False
+        return True
+
+    def handle_frame(self, frame):
+        try:
+            req = Protocol.decode(frame)
+        except ValueError as e:
+            logging.debug("Could not parse JSON-string: '%s'", frame)
+            return False
+        if not isinstance(req, dict):
+            logging.debug("Request is not a JSON object: '%s'", frame)
+            return False
+        command = req.get('request', 'help')
+        content = req.get('content', None)
+        if not isinstance(command, basestring) or command not in self._commands:
+            command = 'help'
+        self._payload = req
+        start = time.time()
+        if not self._limits.allow(command, start):
+            return self._throttle(command)
+        if command in self._text_commands and content is not None and not isinstance(content, basestring):
+            self._send_error(u"The content of {command} must be text".format(command=command))
+            return True
+        self._commands.get(command)(content)
+        self._command_latency[command].record(time.time() - start)
+        return command != 'logout'
+
     def handle_login(self, content):
-        logging.debug("Trying to log in user'%s', from '%s', port '%s'" % (content, self.ip, self.port))
+        logging.debug("Trying to log in user'%s', from '%s', port '%s'", content, self.ip, self.port)
         if content is None:
             self._send_error("You must specify a username")
             return
         content = content.strip()
+        password = self._payload.get('password')
+        encoding = self._payload.get('encoding')
+        if encoding is not None:
+            if encoding not in Protocol.ENCODINGS:
+                self._send_error("Unknown encoding, use one of: {0}".format(", ".join(Protocol.ENCODINGS)))
+                return
+            self.binary = encoding == Protocol.BINARY
+        compression = self._payload.get('compression')
+        if compression is not None:
+            if compression not in Protocol.COMPRESSIONS:
+                self._send_error("Unknown compression, use one of: {0}".format(", ".join(Protocol.COMPRESSIONS)))
+                return
+            self._start_compression()
         if content and content.isalnum():
             if self.username is not None:
                 self._send_error("You're already logged in as {user}".format(user=self.username))
-            elif not self._logged_in(content):
+            elif content in self.admins and not password:
+                self._send_error("{user} is an admin name, but you provided no password".format(user=content))
+            elif content in self.admins and not self._check_password(content, password):
+                self._send_error("Wrong password")
+            elif not self._logged_in(content) and not (self._bus is not None and content in self._bus.remote):
                 self._client_list[content] = self
                 self.username = content
+                self.admin = content in self.admins
+                if self.admin:
+                    self._limits.override(None)
+                self._join(Rooms.DEFAULT)
                 self._send_info("You are now logged in as {user}".format(user=content))
-                self.connection.send(self._create_json("server", "history", self._history))
+                self._send_history(None, self.history_page)
             else:
                 self._send_error("Username already taken!")
         else:
             self._send_error("Invalid username")
 
     def handle_names(self, content):
-        logging.debug("Names requested")
-        logging.debug("Host: '%s', Port: '%s'" % (self.ip, self.port))
-        self._send_info("\n".join(self._client_list.keys()))
+        logging.debug("Names requested by Host: '%s', Port: '%s'", self.ip, self.port)
+        room = self.room or self._rooms.get(Rooms.DEFAULT)
+        names = room.names()
+        if self._bus is not None:
+            names += self._bus.names(room.name)
+        self._send_info("\n".join(names))
 
     def handle_message(self, content):
         if not self._logged_in(self.username):
-            logging.debug("User not logged in tried to send message: '%s'" % content)
+            logging.debug("User not logged in tried to send message: '%s'", content)
             self._send_error("You are not logged in")
             return
-        msg = self._create_json(self.username, "message", content)
-        logging.debug("Trying to send message '%s'" % msg)
-        logging.debug("Host: '%s', Port: '%s'" % (self.ip, self.port))
-        self._history.append(json.loads(msg))
-        for username, client in self._client_list.items():
-            try:
-                client.connection.send(msg)
-            except socket.error as e:
-                logging.debug("Closing dead socket: %s" % e)
-                self._client_list.pop(username)
+        message = Protocol.Message(self.username, content, self._get_utc_timestamp())
+        Log.traffic.debug("Trying to send message '%s' from Host: '%s', Port: '%s'", message.frame, self.ip, self.port)
+        if self._bus is not None:
+            # Stored and broadcast once the hub sends it back, in the same order on every worker
+            self._bus.publish(message.frame, self.room.name)
+            return
+        trace = Trace.sample(self.trace_rate, self.room.name, self._received) if self.trace_rate else None
+        self.room.broadcast(message, trace)
+
+    def handle_history(self, content):
+        if not self._logged_in(self.username):
+            self._send_error("You are not logged in")
+            return
+        try:
+            before, limit = History.parse_cursor(content, self.history_page)
+        except ValueError:
+            self._send_error("Usage: history(before [limit])")
+            return
+        self._send_history(before, limit)
+
+    def handle_chatroom(self, content):
+        if not self._logged_in(self.username):
+            self._send_error("You are not logged in")
+            return
+        if content is None or not Rooms.valid_name(content.strip()):
+            self._send_error("Chatroom names must be alphanumeric")
+            return
+        self._join(content.strip())
+        self._send_info(u"Successfully changed room to {room}".format(room=self.room.name))
+        self._send_history(None, self.history_page)
+
+    def handle_search(self, content):
+        if not self._logged_in(self.username):
+            self._send_error("You are not logged in")
+            return
+        if self.room.index is None:
+            self._send_error("Search is not enabled on this server")
+            return
+        try:
+            before, limit = History.parse_cursor(self._payload, self.history_page)
+        except ValueError:
+            self._send_error("Usage: search(words), with an index 'before' and a 'limit' for older results")
+            return
+        try:
+            frames, cursor = self.room.search(Search.parse_query(content), before, limit)
+        except ValueError as e:
+            self._send_error(u"%s" % e)
+            return
+        header = {'count': len(frames), 'query': content, 'before': before, 'next': cursor}
+        if self.binary:
+            self._send_binary([Protocol.Message.from_frame(frame) for frame in frames],
+                              Protocol.encode_binary(Protocol.SEARCH, Protocol.SERVER_ID, self._get_utc_timestamp(),
+                                                     header), force=True)
+            return
+        header.update({'content': [], 'sender': "server", 'response': "search", 'timestamp': self._get_utc_timestamp()})
+        self.send(Protocol.encode(header) + b''.join(frames), force=True)
 
     def handle_logout(self, content):
         if self.username is not None:
-            logging.debug("Logging out")
-            logging.debug("Host: '%s', Port: '%s'" % (self.ip, self.port))
+            logging.debug("Logging out Host: '%s', Port: '%s'", self.ip, self.port)
             self._send_info("Successfully logged out")
-            self.connection.close()
+            self._leave()
             self._client_list.pop(self.username)
+            if self._bus is not None:
+                self._bus.release(self.username)
+            self.close()
         else:
             logging.debug("Not logged in user tried to log out")
             self._send_error("You are not logged in")
 
+    def handle_stats(self, content):
+        if not self.admin:
+            self._send_error("Only admins may see the server's stats")
+            return
+        self._send_info(Metrics.render())
+
+    def handle_limit(self, content):
+        if not self.admin:
+            self._send_error("Only admins may change limits")
+            return
+        try:
+            username, rate = content.split()
+            rate = Throttle.parse_rate(rate)
+        except (AttributeError, ValueError):
+            self._send_error("Usage: limit(username rate), rate in messages per second or none")
+            return
+        client = self._client_list.get(username)
+        if client is None:
+            self._send_error(u"{user} is not logged in here".format(user=username))
+            return
+        client._limits.override_later(rate)
+        logging.info("Admin %s set the message rate of %s to %s", self.username, username, rate)
+        self._send_info(u"Message rate of {user} set to {rate}".format(user=username,
+                                                                     rate="no limit" if rate is None else rate))
+
+    def handle_profile(self, content):
+        if not self.admin:
+            self._send_error("Only admins may profile the server")
+            return
+        try:
+            seconds = Profiler.DEFAULT_SECONDS if content is None else float(content)
+        except (TypeError, ValueError):
+            seconds = None
+        if seconds is None or not 0 < seconds <= Profiler.MAX_SECONDS:
+            self._send_error("Usage: profile(seconds), at most %d seconds" % Profiler.MAX_SECONDS)
+            return
+
+        def done(profile):
+            self.server.call_from_thread(self._send_info, "Profile written to %s and %s" % (profile.path,
+                                                                                          profile.memory_path))
+        profile = Profiler.start(seconds, self.profile_dir, self._command_latency, done)
+        if profile is None:
+            self._send_error("A profile is being taken already")
+            return
+        logging.info("Admin %s started a profile of %g s", self.username, seconds)
+        self._send_info("Profiling for %g s" % seconds)
+
     def handle_help(self, content):
         self._send_info("""This server supports requests in the following format:
         1. login(username) - attempts to log in with username
@@ -119,59 +350,530 @@ class ClientHandler(SocketServer.BaseRequestHandler):
         3. msg(message) - sends message to everyone in chatroom
         4. names() - lists all users in chatroom
         5. help() - shows help.
+        6. history(before limit) - shows up to limit messages older than before.
+        7. stats() - shows the server's metrics (admins only).
+        8. chatroom(name) - changes to chatroom name, made if it does not exist; "all" after login.
+        9. limit(username rate) - sets the messages per second of username, "none" for no limits (admins only).
+        10. search(words) - finds messages of the chatroom with all words; "word*" matches the start of words.
+        11. profile(seconds) - samples where the server spends its time and writes a report (admins only).
         """)
 
+    def send(self, data, force=False):
+        """
+        Queues data for this client's writer, compressed if the client asked
+        for it; never blocks on the socket.
+        """
+        if self._compressor is None:
+            self.queue(data, force)
+            return
+        with self._compress_lock:
+            wire = self._compressor.wrap(data)
+            self.queue(wire, force)
+        if wire is not data:
+            self._compressed_in.add(len(data))
+            self._compressed_out.add(len(wire))
+
+    def _new_outbox(self):
+        """The Outbox this client's frames wait in; engines that keep their own hook in here"""
+        return Outbox.Outbox(self.outbox_limit, self.slow_consumer_policy, self.coalesce_window, self.coalesce_bytes)
+
+    def queue(self, data, force=False):
+        """Puts data in the outbox as it is; engines hook in here"""
+        if not self.outbox.put(data, force):
+            self.evict()
+
+    def send_message(self, message, force=False):
+        """Queues a Protocol.Message in the encoding this client asked for"""
+        if not self.binary:
+            self.send(message.frame, force)
+            return
+        self._send_binary([message], force=force)
+
+    def close(self):
+        """
+        Closes the connection once everything queued so far has been written.
+        """
+        self.outbox.close()
+
+    def evict(self):
+        logging.debug("Disconnecting slow client '%s', Host: '%s', Port: '%s'", self.username, self.ip, self.port)
+        self.outbox.abort()
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
     def get_connected_clients(self):
         return self._client_list.values()
 
+    @classmethod
+    def bus_message(cls, frame, room):
+        """A chat message of room published on the bus by any worker"""
+        cls._rooms.get(room).broadcast_frame(frame)
+
+    @classmethod
+    def bus_reject(cls, name):
+        """name was claimed on another worker at the same time; the other one keeps it"""
+        client = cls._client_list.pop(name, None)
+        if client is not None:
+            client._leave()
+            client.username = None
+            client._send_error("Username already taken!")
+            client.close()
+
     def _create_json(self, sender, response, content):
-        return json.dumps({'content': content, 'sender': sender,
-                           'response': response,
-                           'timestamp': self._get_utc_timestamp()})
+        return Protocol.encode({'content': content, 'sender': sender,
+                                'response': response,
+                                'timestamp': self._get_utc_timestamp()})
+
+    def _send_binary(self, messages, head=b'', force=False):
+        """
+        Queues head, then messages as binary frames. The outbox may drop the
+        frame that carried a sender's name (see Outbox._drop_oldest), so once
+        it has dropped anything every name is sent again, rather than leave
+        the client with senders it cannot name.
+        """
+        drops = self.outbox.dropped
+        if drops != self._drops_seen:
+            self._known_senders.clear()
+            self._drops_seen = drops
+        data, new_senders = self._binary_frames(messages)
+        self.send(head + data, force)
+        self._known_senders.update(new_senders)
+        if self.outbox.dropped != drops:
+            self._known_senders.clear()     # Ours may have been among them
+
+    def _binary_frames(self, messages):
+        """
+        (data, ids): messages as binary frames, with the name of every sender
+        this client does not know yet ahead of its first message, and the ids
+        of those senders. Mark them as known only once data is queued, so no
+        frame of another thread can overtake the name of its sender.
+        """
+        frames, new_senders = [], set()
+        for message in messages:
+            sender_id = self._senders.id(message.sender)
+            if sender_id not in self._known_senders and sender_id not in new_senders:
+                new_senders.add(sender_id)
+                frames.append(Protocol.encode_binary(Protocol.SENDER, sender_id, 0, message.sender))
+            frames.append(message.binary(sender_id))
+        return b''.join(frames), new_senders
+
+    def _start_compression(self):
+        """
+        Compresses everything sent from now on. A compressed piece cannot be
+        dropped without breaking the stream, so a client too slow for its
+        outbox is disconnected whatever the slow consumer policy.
+        """
+        if self._compressor is not None:
+            return
+        self._compress_lock = Lock()
+        self._compressor = Protocol.Compressor(self.compress_threshold)
+        self.outbox.policy = Outbox.DISCONNECT
+
+    def _create_frame(self, response, content):
+        """A server response in this client's encoding"""
+        if self.binary:
+            return Protocol.encode_binary(Protocol.KINDS[response], Protocol.SERVER_ID,
+                                          self._get_utc_timestamp(), content)
+        return self._create_json("server", response, content)
+
+    def _throttle(self, command):
+        """
+        Refuses a request over the limits. Only the first of a run of refused
+        requests is answered. Returns False once the client is flooding.
+        """
+        self._throttled[command].add()
+        if self._limits.refused == 1:
+            self._send_error("Too many requests, slow down")
+        if self.flood_limit and self._limits.refused >= self.flood_limit:
+            logging.info("Disconnecting flooding client '%s', Host: '%s', Port: '%s'", self.username, self.ip, self.port)
+            Metrics.count('flood_disconnects')
+            return False
+        return True
+
+    def _join(self, name):
+        """Moves this logged in client to the room called name"""
+        self._leave()
+        self.room = self._rooms.get(name)
+        self.room.join(self.username, self)
+        if self._bus is not None:
+            self._bus.claim(self.username, name)
+
+    def _leave(self):
+        if self.room is not None:
+            self.room.leave(self.username, self)
+            self.room = None
+
+    def _check_password(self, username, password):
+        return hashlib.md5((u"%s" % password).encode('utf-8')).hexdigest() == self.admins[username]
 
     def _logged_in(self, username):
         return username is not None and username in self._client_list
 
     def _send_info(self, info):
-        json_string = self._create_json("server", "info", info)
-        logging.debug("Sending info message:'%s'" % json_string)
-        try:
-            self.connection.send(json_string)
-        except socket.error as e:
-            logging.debug("Client disconnected: %s" % e)
+        json_string = self._create_frame("info", info)
+        Log.traffic.debug("Sending info message:'%s'", json_string)
+        self.send(json_string)
+
+    def _send_history(self, before, limit):
+        """
+        Sends the page of at most limit messages older than before. 'before'
+        echoes the request's cursor (None for the newest page) and 'next' is
+        the cursor of the page before this one. JSON clients get the stored
+        frames as they are; binary ones get each message converted. A
+        compressed page goes out as one write, so it is one compressed piece.
+        """
+        if self.binary:
+            frames, cursor = self.room.history.page(before, limit)
+            header = Protocol.encode_binary(Protocol.HISTORY, Protocol.SERVER_ID, self._get_utc_timestamp(),
+                                            {'count': len(frames), 'before': before, 'next': cursor})
+            self._send_binary([Protocol.Message.from_frame(frame) for frame in frames], header, force=True)
+            return
+        if self._compressor is not None:
+            # Log regions are written to the socket as they are, so read the page instead
+            frames, cursor = self.room.history.page(before, limit)
+            parts, count = [b''.join(frames)], len(frames)
+        else:
+            parts, count, cursor = self.room.history.replay(before, limit)
+        header = Protocol.encode({'content': [], 'count': count, 'before': before, 'next': cursor,
+                                  'sender': "server", 'response': "history",
+                                  'timestamp': self._get_utc_timestamp()})
+        if self._compressor is not None:
+            self.send(header + parts[0], force=True)
+            return
+        for part in [header] + parts:
+            self.send(part, force=True)
 
     def _send_error(self, error):
-        json_string = self._create_json("server", "error", error)
-        logging.debug("Sending error message:'%s'" % json_string)
-        try:
-            self.connection.send(json_string)
-        except socket.error as e:
-            logging.debug("Client disconnected: %s" % e)
+        json_string = self._create_frame("error", error)
+        Log.traffic.debug("Sending error message:'%s'", json_string)
+        self.send(json_string)
 
     @staticmethod
     def _get_utc_timestamp():
         return str(calendar.timegm(time.gmtime()))
 
 
-class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+class ThreadedTCPServer(Admission.PoolMixIn, SocketServer.TCPServer):
     """
     This class is present so that each client connected will be ran as a own
-    thread. In that way, all clients will be served by the server.
-
-    No alterations are necessary
+    thread. In that way, all clients will be served by the server. The threads
+    come from a bounded pool and connections are admitted before they get one,
+    see Admission.py.
     """
     allow_reuse_address = True
+    request_queue_size = Admission.DEFAULT_BACKLOG
+    reuse_port = False      # Let several processes accept on the same port
+    listener = None         # A listening socket to take over instead of binding one, see Handoff.py
+
+    def server_bind(self):
+        if self.listener is not None:
+            self.socket.close()
+            self.socket = self.listener
+            self.socket.setblocking(1)
+            self.server_address = self.socket.getsockname()
+            return
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        SocketServer.TCPServer.server_bind(self)
+
+    def server_activate(self):
+        if self.listener is None:
+            SocketServer.TCPServer.server_activate(self)
+
+    def stop_accepting(self):
+        """Leaves new connections to the listen backlog; the handler threads go on serving the others"""
+        self.shutdown()
+
+    def call_from_thread(self, callback, *args):
+        """Every client has a thread of its own anyway, so callback runs right away"""
+        callback(*args)
+
+
+def load_admins(path):
+    """Reads "username md5-of-password" lines, the format of daniel-stuff's .admins"""
+    with open(path) as f:
+        return dict(line.split() for line in f if line.strip())
+
+
+def load_banned(path):
+    """Reads one banned IP address per line"""
+    with open(path) as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def register_server_gauges(server):
+    if server.admission is not None:
+        Metrics.gauge('connections', lambda: len(server.admission))
+    if hasattr(server, 'pool_threads'):
+        Metrics.gauge('handler_threads', lambda: dict(zip(('total', 'idle', 'waiting'), server.pool_threads())),
+                      label='state')
+
+
+def register_gauges():
+    clients = ClientHandler._client_list
+    Metrics.gauge('clients_logged_in', lambda: len(clients))
+    Metrics.gauge('bytes_out', Outbox.queued_bytes)
+    Metrics.gauge('outbox_frames', lambda: sum(len(client.outbox) for client in clients.values()))
+    Metrics.gauge('outbox_bytes', lambda: sum(client.outbox.queued_bytes for client in clients.values()))
+    Metrics.gauge('outbox_max_bytes', lambda: max([client.outbox.queued_bytes for client in clients.values()] or [0]))
+    Metrics.gauge('slow_consumer', Outbox.counters, label='event')
+    Metrics.gauge('rooms', lambda: len(ClientHandler._rooms))
+    Metrics.gauge('history_messages', lambda: dict((room.name, len(room.history)) for room in ClientHandler._rooms),
+                  label='room')
+    Metrics.gauge('search_index_bytes', lambda: dict((room.name, room.index.bytes) for room in ClientHandler._rooms
+                                                     if room.index is not None), label='room')
+    Metrics.gauge('search_postings', lambda: dict((room.name, room.index.postings) for room in ClientHandler._rooms
+                                                  if room.index is not None), label='room')
+
+
+def snapshot_state():
+    """
+    (state, sections) for a Snapshot: every room, its search index and,
+    for a history that has no log, its messages (state has the index of the
+    first one). An index is dumped before its history, so it never holds
+    messages the history does not.
+    """
+    state, sections = {'rooms': {}}, {}
+    for room in ClientHandler._rooms:
+        if room.index is not None:
+            sections['index/' + room.name] = room.index.dump()
+        if isinstance(room.history, History.DurableHistory):
+            state['rooms'][room.name] = None
+            continue
+        end = room.history.next_index
+        frames, _ = room.history.page(end, room.history.size)
+        state['rooms'][room.name] = end - len(frames)
+        sections['history/' + room.name] = b''.join(frames)
+    return state, sections
+
+
+def restored_frames(sections, room):
+    """The frames of room's history in a snapshot, as snapshot_state() joined them"""
+    data = sections.pop('history/' + room, b'')
+    return [frame + Protocol.DELIMITER for frame in data.split(Protocol.DELIMITER)[:-1]]
+
+
+def hand_over(server, snapshotter):
+    """
+    Winds this server down for a new one that takes over its listening
+    socket: stops accepting, starts the new server, closes the clients once
+    they have been sent what is queued for them, takes the last snapshot and
+    stops. See Handoff.py.
+    """
+    server.stop_accepting()
+    Handoff.start_successor(server.socket)
+    for client in list(ClientHandler._client_list.values()):
+        server.call_from_thread(client._send_info, "The server is restarting, log in again")
+        server.call_from_thread(client.close)
+    deadline = time.time() + Outbox.DRAIN_TIMEOUT
+    while ClientHandler._client_list and time.time() < deadline:
+        time.sleep(0.01)
+    if snapshotter is not None:
+        snapshotter.stop()
+        snapshotter.take()
+    server.shutdown()
+
+
+def serve_worker(server_class, address, bus_path, worker, metrics_port=None):
+    """
+    Runs one worker process of a multi-process server: accepts on the shared
+    port and exchanges logins and messages with the others over the bus.
+    """
+    if metrics_port is not None:
+        Metrics.serve(metrics_port + worker)
+    Log.restart()
+    server_class.reuse_port = True
+    server = server_class(address, ClientHandler)
+    register_server_gauges(server)
+    ClientHandler._bus = Bus.Peer(bus_path, worker, ClientHandler, server.call_from_thread, server.shutdown)
+    ClientHandler._bus.start()
+    logging.info("Worker %d running...", worker)
+    server.serve_forever()
+
 
 if __name__ == "__main__":
     """
     This is the main method and is executed when you type "python Server.py"
-    in your terminal.
-
-    No alterations are necessary
+    in your terminal. Use "--engine event" to serve every client from a single
+    event loop instead of one thread per client, and "--workers N" to spread
+    the clients over N processes (see Bus.py). "kill -USR2" a single process
+    server to restart it without refusing a connection (see Handoff.py).
     """
-    HOST, PORT = '', 9998
-    logging.info("Server running...")
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument('--host', default='')
+    parser.add_argument('--port', type=int, default=9998)
+    parser.add_argument('--engine', choices=['threaded', 'event'], default='threaded')
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes accepting clients on the port; more than one needs SO_REUSEPORT (Linux)")
+    parser.add_argument('--bus-path', default=None, help="Unix socket the workers talk over")
+    parser.add_argument('--admins', default=None, help="file of admin names and md5 password hashes")
+    parser.add_argument('--banned', default=None, help="file of IP addresses refused at connect, one per line")
+    parser.add_argument('--max-connections', type=int, default=Admission.DEFAULT_MAX_CONNECTIONS,
+                        help="connections served at once, per worker process")
+    parser.add_argument('--max-per-ip', type=int, default=Admission.DEFAULT_PER_IP,
+                        help="connections one IP address may have open, per worker process")
+    parser.add_argument('--backlog', type=int, default=Admission.DEFAULT_BACKLOG,
+                        help="connections the kernel queues before they are accepted")
+    parser.add_argument('--max-threads', type=int, default=Admission.DEFAULT_MAX_THREADS,
+                        help="handler threads of the threaded engine")
+    parser.add_argument('--pending', type=int, default=Admission.DEFAULT_PENDING,
+                        help="connections that may wait for a handler thread before new ones are refused")
+    parser.add_argument('--log-level', default=Log.DEFAULT_LEVEL, help="DEBUG, INFO, WARNING or ERROR")
+    parser.add_argument('--log-traffic-rate', type=float, default=Log.DEFAULT_TRAFFIC_RATE,
+                        help="per message log records written per second, at most")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve the metrics as text on this local port (worker N uses port + N)")
+    parser.add_argument('--outbox-limit', type=int, default=Outbox.DEFAULT_LIMIT,
+                        help="bytes that may be queued for one client")
+    parser.add_argument('--slow-consumer', choices=Outbox.POLICIES, default=Outbox.DROP_OLDEST,
+                        help="what to do when a client's outbox is full")
+    parser.add_argument('--coalesce-window', type=float, default=Outbox.DEFAULT_WINDOW,
+                        help="seconds frames to a busy client are held to be written together, 0 for none")
+    parser.add_argument('--coalesce-bytes', type=int, default=Outbox.DEFAULT_BUDGET,
+                        help="bytes queued for a client that are written without waiting for the window")
+    parser.add_argument('--history-size', type=int, default=History.DEFAULT_SIZE,
+                        help="messages kept in the history")
+    parser.add_argument('--compact-history', action='store_true',
+                        help="keep in-memory history as compact records, re-encoded when paged (see History.py)")
+    parser.add_argument('--search-memory', type=int, default=Search.DEFAULT_MEMORY >> 20,
+                        help="megabytes of search index per chatroom, 0 to turn search off")
+    parser.add_argument('--history-page', type=int, default=History.DEFAULT_PAGE,
+                        help="messages sent on login and per history request")
+    parser.add_argument('--compress-threshold', type=int, default=Protocol.COMPRESS_THRESHOLD,
+                        help="bytes from which writes to clients that asked for compression are compressed")
+    parser.add_argument('--connection-rate', type=Throttle.parse_rate, default=Throttle.CONNECTION_RATE,
+                        help="requests per second of one connection, \"none\" for no limit")
+    parser.add_argument('--command-rate', action='append', default=[], metavar='COMMAND=RATE',
+                        help="requests per second of one command on one connection, e.g. message=10 or help=none")
+    parser.add_argument('--flood-limit', type=int, default=Throttle.FLOOD_LIMIT,
+                        help="refused requests in a row after which a client is disconnected, 0 for never")
+    parser.add_argument('--data-dir', default='data', help="where the message log is kept")
+    parser.add_argument('--in-memory', action='store_true',
+                        help="keep no message log; history survives a restart as of the last snapshot")
+    parser.add_argument('--segment-bytes', type=int, default=MessageLog.DEFAULT_SEGMENT_BYTES)
+    parser.add_argument('--retention-bytes', type=int, default=None, help="log size kept per room")
+    parser.add_argument('--retention-age', type=float, default=None, help="seconds of log kept per room")
+    parser.add_argument('--commit-interval', type=float, default=MessageLog.DEFAULT_COMMIT_INTERVAL,
+                        help="seconds between fsyncs of the message log")
+    parser.add_argument('--trace-rate', type=float, default=0.0,
+                        help="share of the messages timed to every recipient, with one worker; see Trace.py")
+    parser.add_argument('--profile-dir', default=Profiler.DIRECTORY,
+                        help="where profiles are written, see Profiler.py; \"kill -USR1\" takes one")
+    parser.add_argument('--snapshot', default=None,
+                        help="file the server state is saved to and started from, DATA_DIR/snapshot by default")
+    parser.add_argument('--snapshot-interval', type=float, default=Snapshot.DEFAULT_INTERVAL,
+                        help="seconds between snapshots, 0 for none; one process only (see Snapshot.py)")
+    args = parser.parse_args()
+    try:
+        command_rates = dict(Throttle.COMMAND_RATES, **Throttle.parse_rates(args.command_rate))
+    except ValueError as e:
+        parser.error(str(e))
+    log_listener = Log.setup('server.log', args.log_level, args.log_traffic_rate)
+    listener = Handoff.inherited_socket()
+    Handoff.wait_for_predecessor()
+    started = time.time()
+    state, sections = {'rooms': {}}, {}
+    snapshot_path = args.snapshot or os.path.join(args.data_dir, 'snapshot')
+    snapshots = args.snapshot_interval > 0 and args.workers == 1
+    if snapshots:
+        try:
+            state, sections = Snapshot.load(snapshot_path) or (state, sections)
+        except ValueError as e:
+            logging.warning("%s; starting without it", e)
+    log_store = None
+    memory_history = History.CompactHistory if args.compact_history else History.RoomHistory
+
+    def room_index(room):
+        index = Search.RoomIndex(args.search_memory << 20)
+        data = sections.pop('index/' + room, None)
+        if data is not None:
+            index.load(data)
+        return index
+
+    room_index = room_index if args.search_memory > 0 else None
+    if args.in_memory:
+        ClientHandler._rooms = Rooms.Rooms(lambda room: memory_history(args.history_size,
+                                                                       state['rooms'].get(room) or 0,
+                                                                       restored_frames(sections, room)), room_index)
+    else:
+        log_store = MessageLog.LogStore(args.data_dir, args.commit_interval, segment_bytes=args.segment_bytes,
+                                        retention_bytes=args.retention_bytes, retention_age=args.retention_age)
+        if args.workers > 1:
+            # Only the hub writes the logs; the workers get a copy of their tails and then follow the bus.
+            # A room without a log yet starts out empty, on every worker alike.
+            tails = dict((room, History.tail(log_store.log(room), args.history_size)) for room in log_store.rooms())
+            ClientHandler._rooms = Rooms.Rooms(lambda room: memory_history(args.history_size,
+                                                                           *tails.get(room, (0, ()))), room_index)
+        else:
+            ClientHandler._rooms = Rooms.Rooms(lambda room: History.DurableHistory(log_store.log(room),
+                                                                                   args.history_size), room_index)
+    if args.workers == 1:
+        # Made now rather than on first use, so indexing their history does not hold up a client
+        for room in set(state['rooms']) | set(log_store.rooms() if log_store is not None else ()):
+            ClientHandler._rooms.get(room)
+        logging.info("%d rooms loaded in %.3f s", len(ClientHandler._rooms), time.time() - started)
+    ClientHandler.profile_dir = args.profile_dir
+    Profiler.on_signal(directory=args.profile_dir, commands=ClientHandler._command_latency)
+    ClientHandler.history_page = args.history_page
+    ClientHandler.compress_threshold = args.compress_threshold
+    if args.admins:
+        ClientHandler.admins = load_admins(args.admins)
+    register_gauges()
+    ClientHandler.outbox_limit = args.outbox_limit
+    ClientHandler.slow_consumer_policy = args.slow_consumer
+    ClientHandler.coalesce_window = args.coalesce_window
+    ClientHandler.coalesce_bytes = args.coalesce_bytes
+    ClientHandler.connection_rate = args.connection_rate
+    ClientHandler.command_rates = command_rates
+    ClientHandler.flood_limit = args.flood_limit
+    ClientHandler.trace_rate = args.trace_rate
+    HOST, PORT = args.host, args.port
+    logging.info("Server running with the %s engine...", args.engine)
 
     # Set up and initiate the TCP server
-    server = ThreadedTCPServer((HOST, PORT), ClientHandler)
-    server.serve_forever()
+    server_class = EventServer.EventLoopServer if args.engine == 'event' else ThreadedTCPServer
+    server_class.admission = Admission.Admission(args.max_connections, args.max_per_ip,
+                                                 load_banned(args.banned) if args.banned else None)
+    server_class.request_queue_size = args.backlog
+    server_class.max_threads = args.max_threads
+    server_class.pending = args.pending
+    server_class.listener = listener
+    snapshotter = Snapshot.Snapshotter(snapshot_path, args.snapshot_interval, snapshot_state) if snapshots else None
+    handing_over = []
+    try:
+        if args.workers > 1:
+            hub = Bus.Hub(args.bus_path or Bus.default_path(PORT), log_store)
+            hub.start()
+            workers = [multiprocessing.Process(target=serve_worker, name="Worker-%d" % i,
+                                               args=(server_class, (HOST, PORT), hub.path, i, args.metrics_port))
+                       for i in range(args.workers)]
+            for worker in workers:
+                worker.daemon = True
+                worker.start()
+            try:
+                for worker in workers:
+                    worker.join()
+            finally:
+                hub.close()
+        else:
+            if args.metrics_port is not None:
+                Metrics.serve(args.metrics_port)
+            server = server_class((HOST, PORT), ClientHandler)
+            register_server_gauges(server)
+            if snapshotter is not None:
+                snapshotter.start()
+
+            def start_hand_over():
+                if not handing_over:
+                    handing_over.append(Thread(target=hand_over, args=(server, snapshotter), name="Handoff"))
+                    handing_over[0].start()
+            Handoff.on_signal(start_hand_over)
+            server.serve_forever()
+            for thread in handing_over:
+                thread.join()
+    finally:
+        if log_store is not None:
+            log_store.close()
+        log_listener.stop()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import zlib
+import errno
+import struct
+import logging
+from threading import Thread, Lock, Event
+
+import Metrics
+
+"""
+Snapshots of server state, so a restarted server does not have to rebuild
+it from scratch.
+
+What the message log already keeps durably (the messages) is not in a
+snapshot; what the server would otherwise lose, or have to recompute from
+the whole log, is: bans and resumable sessions, the rooms, the search
+indexes, and the histories of a server without a log. A snapshot records up
+to which message index of a room it holds, and a server that loads one only
+replays the log from there on.
+
+A snapshot file is a header, sections and a CRC32 of all of it:
+
+    "CHSN", version         _HEADER
+    name, body              _SECTION per section: lengths, then the bytes
+
+The "state" section is zlib compressed JSON; every other section is bytes
+the code that wrote it knows how to read, such as a search index as the raw
+arrays it is made of. A file is written next to the old one and renamed over
+it once it has been synced, so a crash leaves either snapshot whole.
+
+A Snapshotter takes one every interval seconds, and when asked to.
+"""
+
+MAGIC = b'CHSN'
+VERSION = 1
+DEFAULT_INTERVAL = 60.0         # Seconds between snapshots
+
+_HEADER = struct.Struct('<4sHI')    # Magic, version, sections
+_SECTION = struct.Struct('<HQ')     # Length of the name, of the body
+_CRC = struct.Struct('<I')
+_STATE = 'state'
+
+_taken = Metrics.counter('snapshots')
+_seconds = Metrics.histogram('snapshot_seconds')
+
+
+def save(path, state, sections=None):
+    """Writes state, anything json can encode, and sections, name : bytes, to path"""
+    sections = dict(sections or {})
+    sections[_STATE] = zlib.compress(json.dumps(state).encode('utf-8'))
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    temporary = path + '.tmp'
+    crc = 0
+    with open(temporary, 'wb') as f:
+        for part in _parts(sections):
+            crc = zlib.crc32(part, crc)
+            f.write(part)
+        f.write(_CRC.pack(crc & 0xffffffff))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temporary, path)
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _parts(sections):
+    yield _HEADER.pack(MAGIC, VERSION, len(sections))
+    for name, body in sorted(sections.items()):
+        name = name.encode('utf-8')
+        yield _SECTION.pack(len(name), len(body)) + name
+        yield body
+
+
+def load(path):
+    """
+    (state, sections) of the snapshot at path, None if there is none. Raises
+    ValueError if it is damaged or of another version.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    if len(data) < _HEADER.size + _CRC.size or _CRC.unpack_from(data, len(data) - _CRC.size)[0] != \
+            zlib.crc32(data[:-_CRC.size]) & 0xffffffff:
+        raise ValueError("Snapshot %s is damaged" % path)
+    magic, version, count = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Snapshot %s is not of version %d" % (path, VERSION))
+    sections, offset = {}, _HEADER.size
+    for _ in range(count):
+        size, length = _SECTION.unpack_from(data, offset)
+        offset += _SECTION.size
+        name = data[offset:offset + size].decode('utf-8')
+        offset += size
+        sections[name] = data[offset:offset + length]
+        offset += length
+    state = json.loads(zlib.decompress(sections.pop(_STATE)).decode('utf-8'))
+    return state, sections
+
+
+class Snapshotter(Thread):
+    """
+    Saves collect()'s (state, sections) to path every interval seconds, and
+    whenever take() is called.
+    """
+
+    def __init__(self, path, interval, collect):
+        super(Snapshotter, self).__init__(name="Snapshotter")
+        self.daemon = True
+        self.path = path
+        self._interval = interval
+        self._collect = collect
+        self._lock = Lock()             # One snapshot at a time
+        self._stopped = Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.take()
+            except Exception:
+                logging.exception("Taking a snapshot failed")
+
+    def take(self):
+        """Saves a snapshot now and returns the seconds it took"""
+        with self._lock:
+            started = time.time()
+            state, sections = self._collect()
+            save(self.path, state, sections)
+            elapsed = time.time() - started
+        _taken.add()
+        _seconds.record(elapsed)
+        logging.info("Snapshot of %d bytes taken in %.3f s", os.path.getsize(self.path), elapsed)
+        return elapsed
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+
+"""
+Request rate limits of a connection.
+
+Every connection has a token bucket for all of its requests and one per
+command. A bucket holds up to BURST seconds worth of its rate and every
+request takes one token from both buckets it goes through, so a client may
+send in bursts but not keep up more than the rate. A request that finds a
+bucket empty is refused before it is dispatched: it costs the server a
+dictionary lookup and some arithmetic, not the work of the command.
+
+A connection is only ever handled by one thread at a time (its own, or the
+event loop's), so the buckets take no lock. Admins are not limited, and the
+admin "limit" request changes the message rate of a connection or lifts
+its limits altogether. It does so from the admin's thread, so the change is
+only queued there (override_later) and the connection's own thread applies
+it before its next request.
+"""
+
+CONNECTION_RATE = 100.0         # Requests per second, all commands together
+COMMAND_RATES = {'message': 25.0, 'login': 5.0, 'logout': 5.0, 'names': 5.0, 'help': 5.0, 'history': 10.0,
+                 'stats': 5.0, 'chatroom': 5.0, 'limit': 5.0, 'search': 5.0, 'profile': 1.0}
+BURST = 2.0                     # Seconds worth of requests a bucket holds
+FLOOD_LIMIT = 500               # Refused requests in a row after which the client is disconnected
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, now):
+        self.rate = rate
+        self._tokens = rate * BURST
+        self._last = now
+
+    def take(self, now):
+        tokens = min(self.rate * BURST, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if tokens < 1:
+            self._tokens = tokens
+            return False
+        self._tokens = tokens - 1
+        return True
+
+
+class Limits(object):
+    """
+    The buckets of one connection. command_rates maps a command to its rate;
+    a command without one only counts against connection_rate. A rate of
+    None is no limit.
+    """
+
+    def __init__(self, connection_rate=CONNECTION_RATE, command_rates=COMMAND_RATES):
+        self.connection_rate = connection_rate
+        self.command_rates = dict(command_rates)
+        self.exempt = False
+        self.refused = 0        # Requests refused since the last one let through
+        self._buckets = {}      # command, or None for the connection : TokenBucket
+        self._overrides = deque()   # Message rates set from other threads, not applied yet
+
+    def allow(self, command, now):
+        while self._overrides:
+            self.override(self._overrides.popleft())
+        if self.exempt:
+            return True
+        if self._take(command, self.command_rates.get(command), now) and \
+                self._take(None, self.connection_rate, now):
+            self.refused = 0
+            return True
+        self.refused += 1
+        return False
+
+    def override(self, message_rate):
+        """Sets the message rate; None lifts every limit of the connection"""
+        self.exempt = message_rate is None
+        self.refused = 0
+        if message_rate is not None:
+            self.command_rates['message'] = message_rate
+            self._buckets.pop('message', None)
+
+    def override_later(self, message_rate):
+        """override(), from any thread: applied before the connection's next request"""
+        self._overrides.append(message_rate)
+
+    def _take(self, key, rate, now):
+        if rate is None:
+            return True
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, now)
+        return bucket.take(now)
+
+
+def parse_rates(specs):
+    """{command: rate} from "command=rate" strings; "none" is no limit. Raises ValueError"""
+    rates = {}
+    for spec in specs:
+        command, _, rate = spec.partition('=')
+        if not command or not rate:
+            raise ValueError("Expected command=rate, got %r" % spec)
+        rates[command] = parse_rate(rate)
+    return rates
+
+
+def parse_rate(rate):
+    """A rate in requests per second, or None for "none"; raises ValueError"""
+    if rate.strip().lower() == 'none':
+        return None
+    rate = float(rate)
+    if rate < 0:
+        raise ValueError("Rates must not be negative")
+    return rate
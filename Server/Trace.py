@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import time
+import random
+from threading import Lock
+
+import Metrics
+
+"""
+Sampled latency of chat messages through the server, from the sender's
+socket to every recipient's.
+
+A share `rate` of the messages gets a Trace, which is stamped on the way:
+
+    received    the chunk the message came in was read from the socket
+    dispatched  its request was parsed and handed to handle_message
+    enqueued    it was put in the Outbox of a recipient, per recipient
+    flushed     it was written to the socket of a recipient, per recipient
+
+The flush is stamped by a Stamp, an empty item queued in the recipient's
+Outbox right behind the message. The writer (an Outbox.Writer or the event
+loop) "writes" it once everything before it has been handed to the socket.
+A Stamp that is dropped with its Outbox records nothing.
+
+The stages go to the histogram trace_seconds{room,stage}, so the stats
+request and the scrape endpoint have their percentiles per room:
+
+    parse       received to dispatched: decoding, throttling
+    fanout      dispatched to enqueued: the room's lock, and the members
+                queued for before this one
+    queue       enqueued to flushed: the coalescing window, waiting for the
+                writer, a socket that does not take more
+    total       received to flushed
+
+Rooms are made by whoever names one, so only the first MAX_ROOMS traced get
+histograms of their own; the messages of every later room are counted
+together, as room OVERFLOW.
+
+Nothing is stamped for messages that are not sampled, and with a rate of 0
+the server does not even take the time a chunk was received.
+"""
+
+STAGES = ('parse', 'fanout', 'queue', 'total')
+MAX_ROOMS = 100         # Rooms with histograms of their own
+OVERFLOW = '*'          # Room label of the messages of every other room
+
+_lock = Lock()
+_rooms = {}             # room : {stage : Metrics.Histogram}
+
+
+def sample(rate, room, received):
+    """A Trace of a message of room received at `received`, for a share `rate` of the calls, else None"""
+    if random.random() >= rate:
+        return None
+    return Trace(room, received)
+
+
+def _histograms(room):
+    histograms = _rooms.get(room)
+    if histograms is None and len(_rooms) >= MAX_ROOMS:
+        histograms = _rooms.get(OVERFLOW)
+    if histograms is None:
+        with _lock:
+            if room not in _rooms and len(_rooms) >= MAX_ROOMS:
+                room = OVERFLOW
+            histograms = _rooms.get(room)
+            if histograms is None:
+                histograms = _rooms[room] = dict((stage, Metrics.histogram('trace_seconds', room=room, stage=stage))
+                                                 for stage in STAGES)
+    return histograms
+
+
+class Trace(object):
+
+    __slots__ = ('received', 'dispatched', '_histograms')
+
+    def __init__(self, room, received):
+        self.dispatched = time.time()
+        self.received = received if received is not None else self.dispatched
+        self._histograms = _histograms(room)
+        self._histograms['parse'].record(self.dispatched - self.received)
+
+    def enqueued(self):
+        """Stamps the message as queued for one more recipient; returns the Stamp to queue behind it"""
+        now = time.time()
+        self._histograms['fanout'].record(now - self.dispatched)
+        return Stamp(self, now)
+
+    def flushed(self, enqueued):
+        now = time.time()
+        self._histograms['queue'].record(now - enqueued)
+        self._histograms['total'].record(now - self.received)
+
+
+class Stamp(object):
+    """An Outbox item of no bytes that stamps its Trace when it is written"""
+
+    __slots__ = ('trace', 'enqueued')
+
+    def __init__(self, trace, enqueued):
+        self.trace = trace
+        self.enqueued = enqueued
+
+    def __len__(self):
+        return 0
+
+    def send(self, sock):
+        self.trace.flushed(self.enqueued)
+
+    sendall = send
+
+    def close(self):
+        pass
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import socket
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import History
+import Outbox
+import Protocol
+import Rooms
+import Server
+
+"""
+A binary client whose outbox drops the frame that named a sender must still
+get that sender's name with their later messages.
+
+Run with "python -m unittest discover Tests" from the top directory.
+"""
+
+
+class Handler(Server.ClientHandler):
+    """A ClientHandler without a thread or a writer: what is queued stays queued, like for a stalled client"""
+
+    _rooms = Rooms.Rooms(lambda room: History.RoomHistory())
+    _client_list = {}
+    outbox_limit = 400
+    slow_consumer_policy = Outbox.DROP_OLDEST
+    coalesce_window = 0
+
+    def __init__(self):
+        self.request, self._peer = socket.socketpair()
+        self.client_address = ('127.0.0.1', 0)
+        self.server = None
+        self.setup()
+
+    def ask(self, request, content, **fields):
+        self.handle_frame(Protocol.encode(dict(fields, request=request, content=content)))
+
+    def received(self):
+        """The payloads of everything queued for this client so far"""
+        decoder = Protocol.StreamDecoder()
+        return decoder.feed(b''.join(Outbox.chunks(self.outbox.take())))
+
+    def close_all(self):
+        self.finish()
+        self.request.close()
+        self._peer.close()
+
+
+class BinarySendersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.slow, self.alice, self.carol = Handler(), Handler(), Handler()
+        self.slow.ask('login', u"slow", encoding=Protocol.BINARY)
+        for handler, name in ((self.alice, u"alice"), (self.carol, u"carol")):
+            handler.ask('login', name)
+            handler._limits.override(None)
+        self.slow.outbox.take()
+
+    def tearDown(self):
+        for handler in (self.slow, self.alice, self.carol):
+            handler.close_all()
+
+    def test_names_survive_dropped_frames(self):
+        self.carol.ask('message', u"first")
+        for i in range(50):
+            self.alice.ask('message', u"filler %d" % i)
+        self.assertGreater(self.slow.outbox.dropped, 0)
+        self.carol.ask('message', u"second")
+        messages = [payload for payload in self.slow.received() if payload.get('response') == 'message']
+        self.assertEqual(messages[-1]['content'], u"second")
+        for payload in messages:
+            self.assertIn(payload['sender'], (u"alice", u"carol"))
+
+
+if __name__ == '__main__':
+    unittest.main()
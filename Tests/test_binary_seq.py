@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import Protocol
+
+"""
+The seq of a message, which a client sends back to resume, must reach
+binary clients like it reaches JSON ones.
+
+Run with "python -m unittest discover Tests" from the top directory.
+"""
+
+
+class BinarySeqTest(unittest.TestCase):
+
+    def setUp(self):
+        self.messages = [Protocol.Message(u"alice", u"hi", u"1457700000", seq=41),
+                         Protocol.Message(u"bob", u"no seq", u"1457700001"),
+                         Protocol.Message(u"alice", u"bye", u"1457700002", seq=2 ** 40)]
+
+    def binary(self):
+        return b''.join(Protocol.encode_binary(Protocol.SENDER, sender_id, 0, name)
+                        for sender_id, name in ((1, u"alice"), (2, u"bob"))) + \
+            b''.join(message.binary(1 if message.sender == u"alice" else 2) for message in self.messages)
+
+    def test_same_payloads_as_json(self):
+        expected = [json.loads(message.frame.decode('utf-8')) for message in self.messages]
+        self.assertEqual(Protocol.StreamDecoder().feed(self.binary()), expected)
+
+    def test_byte_by_byte(self):
+        data, decoder, payloads = self.binary(), Protocol.StreamDecoder(), []
+        for i in range(len(data)):
+            payloads.extend(decoder.feed(data[i:i + 1]))
+        self.assertEqual([payload.get('seq') for payload in payloads], [41, None, 2 ** 40])
+
+    def test_compressed(self):
+        compressor = Protocol.Compressor(threshold=0)
+        payloads = Protocol.StreamDecoder().feed(compressor.wrap(self.binary()))
+        self.assertEqual([payload.get('seq') for payload in payloads], [41, None, 2 ** 40])
+
+
+if __name__ == '__main__':
+    unittest.main()
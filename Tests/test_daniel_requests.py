@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import os
+import imp
+import sys
+import json
+import time
+import socket
+import unittest
+from threading import Thread
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, os.pardir, 'daniel-stuff'))
+import Serve as S
+
+"""
+daniel-stuff's server must answer requests it has no handler of its own
+for, or that are not objects, and end the session of a client whose
+connection ended however it ended.
+
+Run with "python -m unittest discover Tests" from the top directory.
+"""
+
+# Its module is called Server too, like Server/Server.py
+daniel = imp.load_source('DanielServer', os.path.join(HERE, os.pardir, 'daniel-stuff', 'Server.py'))
+
+
+class DanielRequestsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = daniel.ThreadedTCPServer(('127.0.0.1', 0), daniel.ClientHandler)
+        self.loop = Thread(target=self.server.serve_forever)
+        self.loop.start()
+        self.sockets = []
+        self.buffers = {}       # socket : bytes read past the last frame answered
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        self.server.shutdown()
+        self.loop.join()
+        self.server.server_close()
+
+    def connect(self):
+        sock = socket.create_connection(self.server.server_address)
+        sock.settimeout(5)
+        self.sockets.append(sock)
+        return sock
+
+    def send(self, sock, payload):
+        sock.sendall(payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8') + b'\n')
+
+    def answer(self, sock, payload):
+        """The first info or error frame the server answers payload with"""
+        self.send(sock, payload)
+        data = self.buffers.pop(sock, b'')
+        while True:
+            while b'\n' not in data:
+                chunk = sock.recv(4096)
+                self.assertTrue(chunk, "The server closed the connection")
+                data += chunk
+            frame, data = data.split(b'\n', 1)
+            answer = json.loads(frame.decode('utf-8'))
+            if answer.get('response') in ('info', 'error'):
+                self.buffers[sock] = data
+                return answer
+
+    def test_password_request(self):
+        sock = self.connect()
+        self.assertEqual(self.answer(sock, {'request': 'login', 'content': u"pat"})['response'], 'info')
+        self.send(sock, {'request': 'password', 'content': u"secret"})
+        self.assertEqual(self.answer(sock, {'request': 'names', 'content': None})['response'], 'info')
+
+    def test_frames_that_are_not_objects(self):
+        sock = self.connect()
+        for frame in (b'[1]\n', b'"login"\n', b'{"request": [1]}\n'):
+            self.assertEqual(self.answer(sock, frame)['response'], 'error')
+
+    def test_session_ends_with_the_connection(self):
+        sock = self.connect()
+        self.assertEqual(self.answer(sock, {'request': 'login', 'content': u"ghost"})['response'], 'info')
+        sock.sendall(b'{"request": "password", "content": "x"}\n[1]\n')
+        sock.close()
+        deadline = time.time() + 5
+        while u"ghost" in S.users and time.time() < deadline:
+            time.sleep(0.01)
+        answer = self.answer(self.connect(), {'request': 'login', 'content': u"ghost"})
+        self.assertEqual(answer['response'], 'info', answer)
+
+
+if __name__ == '__main__':
+    unittest.main()
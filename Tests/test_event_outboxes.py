@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import socket
+import unittest
+from threading import Thread
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import EventServer
+import History
+import Outbox
+import Protocol
+import Rooms
+import Server
+
+"""
+The event engine must keep one Outbox per connection, and let go of it when
+the connection closes.
+
+Run with "python -m unittest discover Tests" from the top directory.
+"""
+
+CLIENTS = 50
+
+
+class Handler(Server.ClientHandler):
+
+    _rooms = Rooms.Rooms(lambda room: History.RoomHistory())
+    _client_list = {}
+
+
+class EventOutboxesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = EventServer.EventLoopServer(('127.0.0.1', 0), Handler)
+        self.loop = Thread(target=self.server.serve_forever)
+        self.loop.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.loop.join()
+        self.server.server_close()
+
+    def test_outboxes_are_released(self):
+        before = len(Outbox._open)
+        for i in range(CLIENTS):
+            sock = socket.create_connection(self.server.server_address)
+            sock.sendall(Protocol.encode({'request': 'login', 'content': u"user%d" % i}))
+            sock.recv(4096)
+            self.assertLessEqual(len(Outbox._open), before + 1)
+            sock.close()
+            deadline = time.time() + 5
+            while self.server._connections and time.time() < deadline:
+                time.sleep(0.01)
+        self.assertEqual(len(Outbox._open), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import History
+
+"""
+History.parse_cursor, which reads whatever a client sent as a history or
+search cursor: every cursor is either read or refused with a ValueError.
+
+Run with "python -m unittest discover Tests" from the top directory.
+"""
+
+
+class ParseCursorTest(unittest.TestCase):
+
+    def test_cursors(self):
+        self.assertEqual(History.parse_cursor(None, 50), (None, 50))
+        self.assertEqual(History.parse_cursor(120, 50), (120, 50))
+        self.assertEqual(History.parse_cursor(u"120 10", 50), (120, 10))
+        self.assertEqual(History.parse_cursor({'before': 120, 'limit': 10}, 50), (120, 10))
+        self.assertEqual(History.parse_cursor({'limit': 10 ** 9}, 50), (None, History.MAX_PAGE))
+        self.assertEqual(History.parse_cursor({'limit': -5}, 50), (None, 0))
+
+    def test_invalid_cursors(self):
+        for content in (json.loads('1e999'), json.loads('-1e999'), float('nan'), u"1e999", u"abc",
+                        u"1 2 3", [1], {'before': [1]}, {'before': 1, 'limit': json.loads('1e999')},
+                        {'before': u"x"}, {'limit': None}):
+            self.assertRaises(ValueError, History.parse_cursor, content, 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import socket
+import unittest
+from threading import Thread
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import EventServer
+import History
+import Protocol
+import Rooms
+import Server
+
+"""
+A malformed or failing request costs its own client at most: the event
+engine, which serves every client from one thread, keeps serving the others.
+
+Run with "python -m unittest discover Tests" from the top directory.
+"""
+
+
+class Handler(Server.ClientHandler):
+
+    _rooms = Rooms.Rooms(lambda room: History.RoomHistory())
+    _client_list = {}
+
+    def handle_names(self, content):
+        raise RuntimeError("A bug in a request handler")
+
+
+class MalformedRequestsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = EventServer.EventLoopServer(('127.0.0.1', 0), Handler)
+        self.loop = Thread(target=self.server.serve_forever)
+        self.loop.start()
+        self.sockets = []
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        self.server.shutdown()
+        self.loop.join()
+        self.server.server_close()
+
+    def connect(self):
+        sock = socket.create_connection(self.server.server_address)
+        sock.settimeout(5)
+        self.sockets.append(sock)
+        return sock
+
+    def answer(self, sock, data):
+        """The first frame the server answers data with, None if it closed the connection"""
+        sock.sendall(data)
+        decoder = Protocol.StreamDecoder()
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                return None
+            payloads = decoder.feed(chunk)
+            if payloads:
+                return payloads[0]
+
+    def assertServed(self):
+        name = u"user%d" % len(self.sockets)
+        answer = self.answer(self.connect(), Protocol.encode({'request': 'login', 'content': name}))
+        self.assertEqual(answer['response'], 'info')
+        self.assertIn(name, answer['content'])
+
+    def test_content_of_the_wrong_type(self):
+        sock = self.connect()
+        for request in ('login', 'chatroom', 'message', 'search', 'limit'):
+            answer = self.answer(sock, Protocol.encode({'request': request, 'content': 1}))
+            self.assertEqual(answer['response'], 'error')
+        self.assertServed()
+
+    def test_frames_that_are_not_requests(self):
+        for frame in (b'[1]\n', b'"login"\n', b'1e999\n', json.dumps({'request': [1]}).encode('utf-8') + b'\n'):
+            self.answer(self.connect(), frame)
+            self.assertServed()
+
+    def test_failing_handler(self):
+        sock = self.connect()
+        self.answer(sock, Protocol.encode({'request': 'login', 'content': u"doomed"}))
+        self.assertIsNone(self.answer(sock, Protocol.encode({'request': 'names', 'content': None})))
+        self.assertServed()
+
+
+if __name__ == '__main__':
+    unittest.main()
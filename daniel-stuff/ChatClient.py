@@ -1,14 +1,23 @@
 from tkinter import *
 from threading import Thread
-from time import sleep
+from time import sleep, monotonic
+import os
+import sys
+import queue
 import socket
-import json
 import tkinter.messagebox
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import Protocol
+
+RETRY = 1.0     # Seconds between attempts to connect
+POLL = 1000     # Milliseconds between info requests, when polling
+DRAIN = 10      # Milliseconds between looks at what the network threads posted, where Tk cannot watch a socket
+
 
 class ChatClient:
 
-    def __init__(self, server):
+    def __init__(self, server, poll = False):
         self.root = Tk()
         self.root.title("ChatClient")
 
@@ -19,8 +28,18 @@ class ChatClient:
         self.set_up_window()
 
         self.connected = False
-        self.trigger_send = False
+        self.outgoing = queue.Queue()   # Requests for the sender, None once the connection is lost
+        self.incoming = queue.Queue()   # (function, args) to run on the UI thread, see post()
+        self.clock = None           # after() id of the next redraw of the minutes logged in
         self.login_name = ""
+        self.history_cursor = None  # Cursor of the next older history page
+        self.older_pending = 0      # Messages of an older history page still to come
+        self.resume_token = None    # From the server's "session" frame; sent back on reconnect
+        self.last_seq = None        # seq of the newest message shown
+        self.poll = poll            # Ask for info every second instead of subscribing to changes
+        self.session = None         # Last "control" snapshot, None when logged out
+        self.room_names = set()     # Users in our chatroom, kept up to date by join/leave events
+        self.login_clock = None     # monotonic() at login, to count the minutes locally
         self.server = server
 
         self.text_window.tag_configure("error", foreground = "red")
@@ -29,49 +48,110 @@ class ChatClient:
 
         self.legal_responses = {"info" : self.handle_info, "message" : self.handle_message,
                 "error" : self.handle_error, "history" : self.handle_history,
-                "control" : self.handle_control}
-
-        self.connect()
-        self.printed_connect_message = False
-        self.periodic()
+                "control" : self.handle_control, "session" : self.handle_session}
+
+        # The network threads block on the socket and on self.outgoing. They
+        # never touch Tk: what they have for the UI waits in self.incoming,
+        # and a byte on self.waker wakes the UI thread up to run it.
+        self.watch_incoming()
+        self.networkThread = Thread(target = self.handle_network)
+        self.networkThread.daemon = True
+        self.networkThread.start()
+        if self.poll:
+            self.poll_info()
         self.root.mainloop()
 
-    def connect(self):
-        self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        #self.connection.settimeout(0.5) Fails: also applies to recv. Without it, might stuck on open
-        try:
-            self.connection.connect(self.server)
-        except:
-            return
-        self.connected = True
+    def watch_incoming(self):
+        """
+        Has Tk's event loop run what is posted as soon as it is. Tk on Windows
+        cannot watch a socket, so there it looks every DRAIN ms instead.
+        """
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        if hasattr(self.root.tk, "createfilehandler"):
+            self.root.tk.createfilehandler(self.wakeup, READABLE, lambda fd, mask : self.run_incoming())
+        else:
+            self.waker = None
+            self.poll_incoming()
 
-        self.senderThread = Thread(target = self.handle_send)
-        self.senderThread.daemon = True
-        self.senderThread.start()
-        self.receiverThread = Thread(target = self.handle_receive)
-        self.receiverThread.daemon = True
-        self.receiverThread.start()
-
-    def periodic(self):
-        self.root.after(1000, self.periodic)
-        if self.connected and not self.printed_connect_message:
-            self.print_message("[CLIENT] Successfully connected to server!")
-            self.printed_connect_message = True
-        elif not self.connected:
-            self.print_message("[CLIENT] Couldn't connect to server. Trying again...")
-            self.connect()
+    def post(self, function, *args):
+        """Has the UI thread run function(*args) as soon as it can; Tk may only be used from that thread"""
+        self.incoming.put((function, args))
+        if self.waker is None:
             return
+        try:
+            self.waker.send(b"x")
+        except BlockingIOError:
+            pass    # Plenty of wake-ups are waiting already
+
+    def poll_incoming(self):
+        self.root.after(DRAIN, self.poll_incoming)
+        self.run_incoming()
 
+    def run_incoming(self):
         try:
-            self.connection.send(json.dumps({"request" : "info", "content" : None}).encode("utf-8"))
-        except BrokenPipeError:
-            self.connected = False
-            self.printed_connect_message = False
+            while self.wakeup.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                function, args = self.incoming.get_nowait()
+            except queue.Empty:
+                return
+            function(*args)
+
+    def handle_network(self):
+        """Connects, and reconnects whenever the connection is lost, then sends what is typed as it comes"""
+        while True:
+            try:
+                connection = socket.create_connection(self.server)
+            except OSError:
+                self.post(self.print_message, "[CLIENT] Couldn't connect to server. Trying again...")
+                sleep(RETRY)
+                continue
+            # Without polling nothing is sent while idle; let the OS notice a dead peer
+            connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # Every request is one small write; do not let Nagle hold it back for an ACK
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            receiver = Thread(target = self.handle_receive, args = (connection,))
+            receiver.daemon = True
+            receiver.start()
+            self.post(self.on_connect)
+
+            # Sent ahead of anything typed while disconnected
+            try:
+                if not self.poll:
+                    connection.sendall(Protocol.encode({"request" : "subscribe", "content" : None}))
+                if self.resume_token is not None:
+                    # Back after a dropped connection: get only the messages missed since
+                    # the last one shown. A new token comes with the answer.
+                    connection.sendall(Protocol.encode({"request" : "resume", "content" : self.resume_token,
+                                                        "seq" : self.last_seq}))
+                    self.resume_token = None
+            except OSError:
+                pass
+            self.handle_send(connection)
+            connection.close()
+
+    def on_connect(self):
+        self.connected = True
+        self.print_message("[CLIENT] Successfully connected to server!")
+
+    def on_disconnect(self):
+        self.connected = False
+        self.print_message("[CLIENT] Lost the connection to the server. Reconnecting...")
+
+    def poll_info(self):
+        self.root.after(POLL, self.poll_info)
+        if self.connected:
+            self.outgoing.put({"request" : "info", "content" : None})
 
 
-    def print_message(self, message, tag = None):
+    def print_message(self, message, tag = None, index = END):
         self.text_window.config(state = NORMAL)
-        self.text_window.insert(END, message+"\n", tag)
+        self.text_window.insert(index, message+"\n", tag)
         self.text_window.config(state = DISABLED)
 
 
@@ -80,67 +160,40 @@ class ChatClient:
         self.text_window.delete('1.0', END)
         self.text_window.config(state = DISABLED)
 
-    def handle_send(self):
+    def handle_send(self, connection):
+        """Writes requests to connection as soon as they are queued, until the connection is lost"""
         while True:
-            if self.trigger_send:
-                self.trigger_send = False
-                
-                toSend = {}
-                inp = self.text_entry.get('1.0', END).strip()
-                if len(inp) == 0:
-                    continue
-                elif inp[0] == "/":
-                    inp = inp[1:]
-                    words = list(map(str.strip, inp.strip().split()))
-                    if len(words) == 1:
-                        if words[0] == "logout":
-                            pass # logout logic here
-                        toSend["request"] = words[0]
-                        toSend["content"] = None
-                    elif len(words) == 2:
-                        if words[0] == "login":
-                            self.login_name = words[1]
-
-                        toSend["request"] = words[0]
-                        toSend["content"] = words[1]
-                    elif len(words) == 3:
-                        toSend["request"] = words[0]
-                        toSend["content"] = words[1]
-                        toSend["password"] = words[2]
-                else:
-                    toSend["request"] = "message"
-                    toSend["content"] = inp
-
-                self.connection.send(json.dumps(toSend).encode("utf-8"))
-                self.text_entry.delete('1.0', END)
-            sleep(0.1)
-
-    def handle_receive(self):
+            toSend = self.outgoing.get()
+            if toSend is None:
+                return
+            try:
+                connection.sendall(Protocol.encode(toSend))
+            except OSError:
+                pass        # The receiver sees the connection go, and tells us
+
+    def handle_receive(self, connection):
+        decoder = Protocol.FrameDecoder()
         while True:
             try:
-                recv_str = self.connection.recv(4096).decode("utf-8")
-                strs = []
-                while "{" in recv_str and "}" in recv_str:
-                    ind1 = recv_str.find("{")
-                    ind2 = ind1 + 1
-                    depth = 0
-
-                    while depth > 0 or recv_str[ind2] != "}":
-                        if recv_str[ind2] == "{":
-                            depth += 1
-                        elif recv_str[ind2] == "}":
-                            depth -= 1
-                        ind2 += 1
-
-                    strs.append(recv_str[ind1 : ind2 + 1])
-                    recv_str = recv_str[:ind1] + recv_str[ind2+1:]
-                
-                for json_str in strs:
-                    payload = json.loads(json_str)
-                    if payload.get("response", None) in self.legal_responses:
-                        self.legal_responses[payload["response"]](payload)
-            except KeyboardInterrupt:
-               tkinter.messagebox.showwarning("Error", "Error upon parsing received json")
+                data = connection.recv(4096)
+            except OSError:
+                data = b""
+            if not data:
+                self.outgoing.put(None)
+                self.post(self.on_disconnect)
+                return
+            try:
+                payloads = [Protocol.decode(frame) for frame in decoder.feed(data)]
+            except ValueError:
+                self.post(tkinter.messagebox.showwarning, "Error", "Error upon parsing received json")
+                continue
+            # One wake-up per read, however many frames it had
+            self.post(self.handle_payloads, payloads)
+
+    def handle_payloads(self, payloads):
+        for payload in payloads:
+            if payload.get("response", None) in self.legal_responses:
+                self.legal_responses[payload["response"]](payload)
 
 
     def handle_info(self, payload):
@@ -156,21 +209,64 @@ class ChatClient:
             tag = "client_user"
         else:
             tag = None
+        index = END
+        if self.older_pending > 0:
+            # Part of an older history page: goes above what is shown
+            self.older_pending -= 1
+            index = "older"
+        elif payload.get("seq", None) is not None:
+            if self.last_seq is not None and payload["seq"] <= self.last_seq:
+                return      # Got it before the connection dropped
+            self.last_seq = payload["seq"]
         self.print_message("["+self.time(payload["timestamp"])+"] " + \
-                payload["sender"] + ": " + payload["content"], tag)
+                payload["sender"] + ": " + payload["content"], tag, index)
 
     def handle_history(self, payload):
-        self.clear_textbox()
+        # The page's messages follow as "message" frames
+        if payload.get("after", None) is not None:
+            # Resumed: the messages missed while disconnected, after those shown
+            self.older_pending = 0
+            return
+        self.history_cursor = payload.get("next", None)
+        if payload.get("before", None) is None:
+            self.clear_textbox()
+            self.last_seq = None
+        else:
+            self.text_window.mark_set("older", "1.0")
+            self.older_pending = payload.get("count", 0)
         for msg in payload["content"]:
             self.handle_message(msg)
 
+    def handle_session(self, payload):
+        self.resume_token = payload["content"]
+
     def handle_control(self, payload):
+        event = payload.get("event", None)
+        if event is not None:
+            # Someone joined or left a chatroom; events of the one we just left may still come
+            if self.session is None or payload.get("chatroom") != self.session["chatroom"]:
+                return
+            if event == "join":
+                self.room_names.add(payload["user"])
+            elif event == "leave":
+                self.room_names.discard(payload["user"])
+        elif payload.get("name", None) is None:
+            self.session = None
+            self.room_names = set()
+        else:
+            self.session = payload
+            self.room_names = set(payload["names"])
+            self.login_clock = monotonic() - payload["elapsed"]
+        self.draw_session()
+
+    def draw_session(self):
         self.info_box.config(state = NORMAL)
         self.names_window.config(state = NORMAL)
 
         self.info_box.delete(1.0, END)
         self.names_window.delete(1.0, END)
-        if payload.get("name", None) is None:
+        payload = self.session
+        if payload is None:
             self.info_box.insert(END, 
                     """Status: not logged in\n\nChatroom: none\n\n\n\nLogged in as: \n\nLogged in for: """)
         else:
@@ -179,18 +275,60 @@ class ChatClient:
                             "Chatroom: " + payload.get("chatroom", "") + "\n\n\n\n" + \
                             "Logged in as: " + payload.get("name", "") + \
                             ("\n(admin)" if payload.get("admin", False) else "") + "\n\n" + \
-                            "Logged in for: "+ str(int(payload.get("elapsed", "") / 60)) + " mins")
+                            "Logged in for: "+ str(int((monotonic() - self.login_clock) / 60)) + " mins")
             self.names_window.insert(END,
-                    "\n".join(payload["names"]))
+                    "\n".join(sorted(self.room_names)))
         self.info_box.config(state = DISABLED)
         self.names_window.config(state = DISABLED)
 
+        # Redrawn when the minutes logged in go up, not on a timer
+        if self.clock is not None:
+            self.root.after_cancel(self.clock)
+            self.clock = None
+        if payload is not None:
+            left = 60 - (monotonic() - self.login_clock) % 60
+            self.clock = self.root.after(int(left * 1000) + 1, self.draw_session)
 
     def time(self, payload):
         return payload[11:]
 
     def send_event(self):
-        self.trigger_send = True
+        """Queues what is typed for the sender right away; returns "break" so Return adds no newline"""
+        toSend = {}
+        inp = self.text_entry.get('1.0', END).strip()
+        if len(inp) == 0:
+            return "break"
+        elif inp[0] == "/":
+            inp = inp[1:]
+            words = list(map(str.strip, inp.strip().split()))
+            if len(words) == 1:
+                if words[0] == "logout":
+                    self.resume_token = None
+                toSend["request"] = words[0]
+                toSend["content"] = None
+                if words[0] == "history":
+                    # Without a cursor: the page before the oldest shown
+                    if self.history_cursor is None:
+                        self.text_entry.delete('1.0', END)
+                        return "break"
+                    toSend["content"] = self.history_cursor
+            elif len(words) == 2:
+                if words[0] == "login":
+                    self.login_name = words[1]
+
+                toSend["request"] = words[0]
+                toSend["content"] = words[1]
+            elif len(words) == 3:
+                toSend["request"] = words[0]
+                toSend["content"] = words[1]
+                toSend["password"] = words[2]
+        else:
+            toSend["request"] = "message"
+            toSend["content"] = inp
+
+        self.outgoing.put(toSend)
+        self.text_entry.delete('1.0', END)
+        return "break"
 
     def set_up_window(self):
         self.left_pane = Frame(self.root, bg = self.theme)
@@ -280,13 +418,13 @@ class MessageReceiver(Thread):
         self.connection = connection
 
         self.handler = MessageParser()
+        self.decoder = Protocol.FrameDecoder()
 
     def run(self):
         while True:
-            s = None 
-            try: # Fix handle successive jsons
-                s = self.connection.recv(4096)
-                self.handler.parse(json.loads(s))
+            try:
+                for frame in self.decoder.feed(self.connection.recv(4096)):
+                    self.handler.parse(frame)
             except:
                 pass
 
@@ -1,70 +1,172 @@
 import json
 import re
+import os
+import time
+from binascii import hexlify
 from datetime import datetime
-from threading import RLock
+from threading import Lock
 from hashlib import md5
+from collections import deque
+import Protocol         # ../Server, put on sys.path by Server.py
+import History
+import MessageLog
+import Metrics
+import Outbox
 
 users = {}              # username : socket
 chatroom = {}           # username : chatroom
-history = {"all" : []}  # chatroom : list of messages
+names = {}              # socket : username
+members = {"all" : set()}   # chatroom : set of usernames
+history_size = History.DEFAULT_SIZE    # Messages kept per chatroom
+history_page = History.DEFAULT_PAGE    # Messages sent on join / per history request
+log_store = None        # MessageLog.LogStore; history is only kept in memory without one
+
+history = {"all" : History.RoomHistory(history_size)}  # chatroom : last messages
 admins = {}             # username : password - Loaded from file
 login_time = {}         # username : datetime
-banned = set()          # set of banned ip addresses
+banned = set()          # set of banned ip addresses, refused at accept and kept in snapshots (see Server.py)
+
+# Resumable sessions. Every login gets a token, sent to the client in a
+# "session" frame. A client whose connection drops sends it back in a "resume"
+# request with the seq of the last message it got, and is logged in again,
+# in the same chatroom, with only the messages it missed. Logging out, a kick,
+# a ban or a new login under the same name end the token.
+RESUME_TTL = 300        # Seconds after the connection dropped that a session can be resumed
+resume_tokens = {}      # token : [username, chatroom, time the connection dropped or None]
+session_token = {}      # username : token
+dropped = deque()       # (time, token) of dropped connections, oldest first, to expire the tokens
+
+subscribers = set()     # sockets that get presence pushed instead of polling, see handle_subscribe
+presence_events = Metrics.counter('presence_events')
+
+# Locking. registry_lock guards the dictionaries above and is only held for
+# short lookups and updates. Every chatroom also has its own lock, held while
+# a message is added to its history and queued for its members, so that all
+# members see the messages of a room in history order. Lock order is room
+# lock, then registry_lock. Nothing is written to a socket under either: the
+# sockets are Server.Connections, whose send() only queues the frame for the
+# client's writer thread, and replies are sent after the locks are released.
+# Presence events are the exception: they are queued under registry_lock, by
+# the change they report, so every subscriber sees the changes in order.
+registry_lock = Lock()
+room_locks = {"all" : Lock()}   # chatroom : Lock
+open_lock = Lock()              # Held while a new chatroom is created
 
 noneType = type(None)
 legal_requests = {"login" : unicode, "logout" : noneType, "names" : noneType, 
         "message" : unicode, "help" : noneType, "chatroom" : unicode, 
         "password" : unicode, "info" : noneType, "kick" : unicode,
-        "ban" : unicode}
+        "ban" : unicode, "history" : (noneType, unicode, int), "stats" : noneType,
+        "resume" : unicode, "subscribe" : noneType}
 
 def handle_login(socket, username, password = ""):
-    if username in users:
-        send_error(socket, "Sorry, username is taken. Try again")
-    elif socket in users.values():
-        send_error(socket, "Sorry, you're already loggedi in")
-    elif not re.match("\w+", username):
+    if not re.match("\w+", username):
         send_error(socket, "Sorry, username must be alphanumeric")
     elif username in admins and password == "":
         send_error(socket, "Sorry, "+username+" is an admin name, but you provided no password")
     elif username in admins and not auth_pass(username, password):
         send_error(socket, "Sorry, wrong password")
     else:
-        users[username] = socket
-        chatroom[username] = "all"
-        login_time[username] = datetime.now()
+        error = add_session(username, socket, "all")
+        if error:
+            send_error(socket, error)
+            return
         send_info(socket, 
                 ("[ADMIN] " if username in admins else "") +
                 "You're successfully logged in, " + username)
+        send_session(socket, new_token(username))
+        push_session(socket)
         send_history(socket, "all")
 
 def handle_logout(socket):
-    if auth(socket):
+    user = get_corr_name(socket)
+    if auth(socket) and remove_session(user):
+        with registry_lock:
+            end_token(user)
         send_info(socket, "You're successfully logged out")
-
-        user = get_corr_name(socket)
+        push_session(socket)
         socket.close()
 
-        del chatroom[user]
-        del users[user]
-        del login_time[user]
+def handle_disconnect(socket):
+    """The connection dropped: the session ends, but can be resumed with its token"""
+    with registry_lock:
+        user = names.get(socket)
+        if user is None:
+            return
+        token = session_token.get(user)
+        record = resume_tokens.get(token)
+        if record is not None:
+            record[1], record[2] = chatroom[user], time.time()
+            dropped.append((record[2], token))
+        _remove_session(user)
+        expire_tokens()
+
+def handle_resume(socket, token, seq = None):
+    """
+    Logs a reconnecting client back in to the session of token, in the
+    chatroom it was in, and sends it the messages after seq. When those are
+    no longer all kept, or there are too many, it gets the newest page
+    instead, as after a login.
+    """
+    if socket in names:
+        send_error(socket, "Sorry, you're already logged in")
+        return
+    with registry_lock:
+        record = resume_tokens.get(token)
+        if record is not None and record[2] is not None and time.time() - record[2] > RESUME_TTL:
+            end_token(record[0])
+            record = None
+        if record is not None:
+            username, room = record[0], record[1]
+            # A connection the server has not seen drop yet; the token says it is the same client
+            old = users.get(username)
+            if old is not None:
+                record[1] = chatroom[username]
+                room = record[1]
+                _remove_session(username)
+    if record is None:
+        Metrics.count('resumes', result = "refused")
+        send_error(socket, "Sorry, that session can't be resumed. Log in again")
+        return
+    if old is not None:
+        old.close()
+    open_room(room)
+    with room_locks[room]:
+        # Under the room lock no message can fall between the delta and the live ones
+        error = add_session(username, socket, room)
+        if error:
+            send_error(socket, error)
+            return
+        record[2] = None
+        delta = None
+        if isinstance(seq, (int, long)) and not isinstance(seq, bool):
+            delta = history[room].since(seq, history_page)
+        send_info(socket, "Welcome back, " + username)
+        send_session(socket, token)
+        push_session(socket)
+        if delta is None:
+            Metrics.count('resumes', result = "page")
+            send_history(socket, room)
+            return
+        Metrics.count('resumes', result = "delta")
+        parts, count, cursor = delta
+        send_page(socket, parts, count, None, cursor, after = seq)
 
 def handle_names(socket):
-    if auth(socket):
-        user = get_corr_name(socket)
-        room = chatroom[user]
-        send_info(socket, "Currently in " + room + ":\n" + "\n".join(room_members(room)))
+    user, room = session(socket)
+    if user is not None:
+        send_info(socket, "Currently in " + room + ":\n" + "\n".join(sorted(room_members(room))))
 
 def handle_message(socket, message):
-    if auth(socket):
-        #send_info(socket, "Message sent")
-
-        user = get_corr_name(socket)
-        room = chatroom[user]
-        msg = get_json(user, "message", message)
+    user, room = session(socket)
+    if user is None:
+        return
 
-        history[room].append(json.loads(msg))
-        for userSocket in [users[usr] for usr in room_members(room)]:
-            userSocket.send(msg)
+    with room_locks[room]:
+        msg = get_message(user, message, history[room].next_index)
+        history[room].append(msg)
+        for member in member_sockets(room):
+            member.send(msg.frame)
 
 def handle_help(socket):
     send_info(socket,
@@ -76,24 +178,63 @@ def handle_help(socket):
         5. chatroom(chatroom name) - changes chatroom to chatroom name.
         6. help() - shows help.
         7. info() - session information.
+        8. history(before limit) - shows up to limit messages older than before.
+        9. stats() - shows the server's metrics (admins only).
+        10. resume(token) - logs back in to a dropped session; "seq" is the last message seen.
+        11. subscribe() - pushes session changes and joins/leaves of the chatroom instead of info().
         """)
 
 def handle_info(socket):
     base = json.loads(get_json("server", "control", "Session information"))
 
-    if socket in users.values():
-        user = get_corr_name(socket)
+    with registry_lock:
+        user = names.get(socket)
+        if user is not None:
+            room, since = chatroom[user], login_time[user]
+    if user is not None:
         base["name"] = user
-        base["names"] = room_members(chatroom[user])
-        base["chatroom"] = chatroom[user]
-        base["login_time"] = login_time[user].__str__()[:-7]
-        base["elapsed"] = int((datetime.now() - login_time[user]).total_seconds())
+        base["names"] = sorted(room_members(room))
+        base["chatroom"] = room
+        base["login_time"] = since.__str__()[:-7]
+        base["elapsed"] = int((datetime.now() - since).total_seconds())
         base["admin"] = (user in admins)
     else:
         base.update({"name" : None, "names" : None, "chatroom" : None, "login_time" : None,
                 "elapsed" : None, "admin" : None})
 
-    socket.send(json.dumps(base))
+    socket.send(Protocol.encode(base))
+
+def handle_subscribe(socket):
+    """
+    From now on socket gets its session information pushed as a "control"
+    frame whenever its session changes, and a join or leave "control" event
+    whenever someone enters or leaves its chatroom, so it need not poll info.
+    """
+    with registry_lock:
+        subscribers.add(socket)
+    handle_info(socket)
+
+def unsubscribe(socket):
+    with registry_lock:
+        subscribers.discard(socket)
+
+def push_session(socket):
+    """Sends a subscriber its session information after it changed"""
+    if socket in subscribers:
+        handle_info(socket)
+
+def push_presence(room, username, event):
+    """Sends "join" or "leave" of username to the subscribers in room. Call with registry_lock held"""
+    frame = None
+    for member in members.get(room, ()):
+        member_socket = users[member]
+        if member != username and member_socket in subscribers:
+            if frame is None:
+                frame = Protocol.encode({'timestamp' : get_timestamp(), 'sender' : "server",
+                    'response' : "control", 'content' : None,
+                    'event' : event, 'user' : username, 'chatroom' : room})
+            member_socket.send(frame)
+            presence_events.add()
 
 def handle_chatroom(socket, room):
     if not auth(socket):
@@ -101,42 +242,76 @@ def handle_chatroom(socket, room):
     elif not re.match("\w+", room):
         send_error(socket, "Sorry, chatroom must be alphanumeric")
     else:
-        user = get_corr_name(socket)
-        chatroom[user] = room
-        if room not in history:
-            history[room] = []
+        open_room(room)
+        move_session(get_corr_name(socket), room)
         send_info(socket, "Successfully changed room to " + room)
+        push_session(socket)
         send_history(socket, room)
 
 def handle_kick(socket, user, ban = False):
     if not auth(socket):
         return
-    elif user not in users:
-        send_error(socket, 'Sorry, there is no user "' + user + '"')
     elif get_corr_name(socket) not in admins:
         send_error(socket, "Sorry, you're not admin")
     else:
-        if ban:
-            banned.add(users[user].getpeername()[0])
-            send_info(users[user], "You were banned by " + get_corr_name(socket))
-        else:
-            send_info(users[user], "You were kicked by " + get_corr_name(socket))
-
-        tmp = users[user]
-        del users[user]
-        del chatroom[user]
-        del login_time[user]
+        admin = get_corr_name(socket)
+        with registry_lock:
+            tmp = users.get(user)
+            if tmp is not None:
+                if ban:
+                    banned.add(tmp.getpeername()[0])
+                _remove_session(user)
+                end_token(user)
+        if tmp is None:
+            send_error(socket, 'Sorry, there is no user "' + user + '"')
+            return
+        send_info(tmp, ("You were banned by " if ban else "You were kicked by ") + admin)
         handle_info(tmp)
         tmp.close()
 
 def handle_ban(socket, user):
     handle_kick(socket, user, ban = True)
 
-def send_history(socket, chatroom):
-    socket.send(get_json(
-        "server",
-        "history",
-        history[chatroom]))
+def handle_stats(socket):
+    if not auth(socket):
+        return
+    elif get_corr_name(socket) not in admins:
+        send_error(socket, "Sorry, you're not admin")
+    else:
+        send_info(socket, Metrics.render())
+
+def handle_history(socket, content):
+    user, room = session(socket)
+    if user is None:
+        return
+    try:
+        before, limit = History.parse_cursor(content, history_page)
+    except ValueError:
+        send_error(socket, "Sorry, usage is history(before limit)")
+        return
+    send_history(socket, room, before, limit)
+
+def send_history(socket, chatroom, before = None, limit = None):
+    parts, count, cursor = history[chatroom].replay(before, history_page if limit is None else limit)
+    send_page(socket, parts, count, before, cursor)
+
+def send_page(socket, parts, count, before, cursor, after = None):
+    base = {
+        'timestamp' : get_timestamp(),
+        'sender' : "server",
+        'response' : "history",
+        'content' : [],
+        'count' : count,
+        'before' : before,
+        'next' : cursor
+        }
+    if after is not None:
+        base['after'] = after
+    for part in [Protocol.encode(base)] + parts:
+        socket.send(part, force = True)
+
+def send_session(socket, token):
+    socket.send(get_json("server", "session", token))
 
 def send_error(socket, error):
     socket.send(get_json( "server",
@@ -150,7 +325,7 @@ def send_info(socket, info):
 
 def auth(socket):
     """Check that the user is currently logged on"""
-    if socket in users.values():
+    if socket in names:
         return True
     else:
         send_error(socket, "Sorry, you're not logged in.")
@@ -165,16 +340,161 @@ def auth_pass(username, socket):
 
 def get_json(username, response, content):
     """Get json string in protocol format"""
-    return json.dumps({
-        'timestamp' : datetime.now().__str__()[:-7],
+    return Protocol.encode({
+        'timestamp' : get_timestamp(),
         'sender' : username,
         'response' : response,
         'content' : content
         })
 
+def open_room(room):
+    """Creates the history and lock of room unless it has them already"""
+    with open_lock:     # Not registry_lock: opening a log reads the disk
+        if room not in history:
+            room_history = new_history(room)
+            with registry_lock:
+                history[room] = room_history
+                room_locks[room] = Lock()
+
+def register_gauges():
+    Metrics.gauge('clients_logged_in', lambda: len(users))
+    Metrics.gauge('bytes_out', Outbox.queued_bytes)
+    Metrics.gauge('outbox_frames', lambda: sum(len(user.outbox) for user in users.values()))
+    Metrics.gauge('outbox_bytes', lambda: sum(user.outbox.queued_bytes for user in users.values()))
+    Metrics.gauge('outbox_max_bytes', lambda: max([user.outbox.queued_bytes for user in users.values()] or [0]))
+    Metrics.gauge('slow_consumer', Outbox.counters, label='event')
+    Metrics.gauge('history_messages', lambda: dict((room, len(h)) for room, h in history.items()), label='room')
+
+def new_history(room):
+    if log_store is None:
+        return History.RoomHistory(history_size)
+    return History.DurableHistory(log_store.log(room), history_size)
+
+def get_message(username, content, seq = None):
+    """Chat message, encoded once for broadcast, history and replay"""
+    return Protocol.Message(username, content, get_timestamp(), seq = seq)
+
+def new_token(username):
+    """Starts a resumable session for username, ending any earlier one"""
+    token = hexlify(os.urandom(16)).decode('ascii')
+    with registry_lock:
+        end_token(username)
+        session_token[username] = token
+        resume_tokens[token] = [username, "all", None]
+    return token
+
+def end_token(username):
+    """Ends the resumable session of username. Call with registry_lock held"""
+    resume_tokens.pop(session_token.pop(username, None), None)
+
+def expire_tokens():
+    """Ends the sessions that dropped more than RESUME_TTL ago. Call with registry_lock held"""
+    now = time.time()
+    while dropped and now - dropped[0][0] > RESUME_TTL:
+        left, token = dropped.popleft()
+        record = resume_tokens.get(token)
+        if record is not None and record[2] == left:     # Not resumed since
+            end_token(record[0])
+
+def snapshot_state():
+    """
+    (state, sections) for a Snapshot: the bans, the resumable sessions and
+    the chatrooms. Sessions that are connected count as dropped now, since
+    the server is not there anymore when the snapshot is loaded.
+    """
+    now = time.time()
+    with registry_lock:
+        sessions = dict((token, [user, chatroom.get(user, room) if left is None else room, left or now])
+                        for token, (user, room, left) in resume_tokens.items())
+        return {"banned" : sorted(banned), "sessions" : sessions, "rooms" : sorted(history)}, {}
+
+def restore_state(state):
+    """Takes up what snapshot_state() kept, at startup"""
+    for room in state["rooms"]:
+        open_room(room)
+    with registry_lock:
+        banned.update(state["banned"])
+        for token, record in sorted(state["sessions"].items(), key = lambda item: item[1][2]):
+            resume_tokens[token] = record
+            session_token[record[0]] = token
+            dropped.append((record[2], token))
+        expire_tokens()
+
+def close_all(info):
+    """Sends info to every client that is logged in and closes it once it has been written"""
+    with registry_lock:
+        sockets = list(users.values())
+    for socket in sockets:
+        send_info(socket, info)
+        socket.close()
+
+def get_timestamp():
+    return datetime.now().__str__()[:-7]
+
 def get_corr_name(socket):
-    hits = [key for key in users if users[key] is socket]
-    return hits[0] if len(hits) > 0 else None
+    return names.get(socket, None)
+
+def session(socket):
+    """(username, chatroom) of socket, or (None, None) and an error if it is not logged in"""
+    with registry_lock:
+        user = names.get(socket)
+        if user is not None:
+            return user, chatroom[user]
+    send_error(socket, "Sorry, you're not logged in.")
+    return None, None
 
 def room_members(room):
-    return [user for user in chatroom if chatroom[user] == room]
+    """Snapshot of the usernames in room"""
+    with registry_lock:
+        return list(members.get(room, ()))
+
+def member_sockets(room):
+    with registry_lock:
+        return [users[user] for user in members.get(room, ())]
+
+def add_session(username, socket, room):
+    """
+    Registers a logged in user in every index. Returns an error message
+    instead if the name is taken or the socket is already logged in.
+    """
+    with registry_lock:
+        if username in users:
+            return "Sorry, username is taken. Try again"
+        if socket in names:
+            return "Sorry, you're already loggedi in"
+        users[username] = socket
+        names[socket] = username
+        chatroom[username] = room
+        members.setdefault(room, set()).add(username)
+        login_time[username] = datetime.now()
+        push_presence(room, username, "join")
+    return None
+
+def move_session(username, room):
+    with registry_lock:
+        if username in chatroom:
+            old = chatroom[username]
+            members[old].discard(username)
+            push_presence(old, username, "leave")
+            chatroom[username] = room
+            members.setdefault(room, set()).add(username)
+            push_presence(room, username, "join")
+
+def remove_session(username):
+    """
+    Removes a user from every index; on logout, kick and ban. Returns False
+    if someone else removed it first.
+    """
+    with registry_lock:
+        if username not in users:
+            return False
+        _remove_session(username)
+    return True
+
+def _remove_session(username):
+    members[chatroom[username]].discard(username)
+    push_presence(chatroom[username], username, "leave")
+    del names[users[username]]
+    del users[username]
+    del chatroom[username]
+    del login_time[username]
@@ -1,14 +1,65 @@
 # -*- coding: utf-8 -*-
 import SocketServer
-import json
+import socket
+import logging
+import os
+import sys
+import time
+from threading import Thread
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Server'))
+import Admission
+import Handoff
+import Protocol
+import Outbox
+import MessageLog
+import Metrics
+import Profiler
+import Snapshot
 import Serve as S
-from threading import RLock
 
 """
 Variables and functions that must be used by all the ClientHandler objects
-must be written here (e.g. a dictionary for connected clients)
+must be written here (e.g. a dictionary for connected clients). They live in
+Serve.py, which also does the locking: requests of different clients, and of
+different chatrooms, are handled concurrently.
 """
-lock = RLock()
+latency = dict((request, Metrics.histogram('command_seconds', command=request))
+               for request in S.legal_requests if request != "password")
+bytes_in = Metrics.counter('bytes_in')
+
+
+class Connection(object):
+    """
+    What Serve.py sees as a client socket. send() only queues the data in the
+    client's Outbox and a Writer thread does the actual writing, so sending to
+    a slow client while holding a lock never blocks the other clients.
+    """
+    outbox_limit = Outbox.DEFAULT_LIMIT
+    slow_consumer_policy = Outbox.DROP_OLDEST
+    coalesce_window = Outbox.DEFAULT_WINDOW
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.outbox = Outbox.Outbox(self.outbox_limit, self.slow_consumer_policy, self.coalesce_window)
+        self.writer = Outbox.Writer(sock, self.outbox)
+        self.writer.start()
+
+    def send(self, data, force = False):
+        if not self.outbox.put(data, force):
+            self.outbox.abort()
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def close(self):
+        """Closes the connection once everything queued has been written"""
+        self.outbox.close()
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
 
 class ClientHandler(SocketServer.BaseRequestHandler):
     """
@@ -24,88 +75,164 @@ class ClientHandler(SocketServer.BaseRequestHandler):
         """
         self.ip = self.client_address[0]
         self.port = self.client_address[1]
-        self.connection = self.request
-
-        try:
-            lock.acquire()
-            if self.ip in S.banned:
-               return
-        finally:
-            lock.release()
-
+        self.connection = Connection(self.request)
+        Metrics.count('connections_opened')
 
+        decoder = Protocol.FrameDecoder()
         while True:
             try:
-                payload = json.loads(self.connection.recv(4096))
+                data = self.request.recv(4096)
+                if not data:
+                    raise EOFError()
+                bytes_in.add(len(data))
+                payloads = [Protocol.decode(frame) for frame in decoder.feed(data)]
             except:
-                try:
-                    lock.acquire()
-                    S.handle_logout(self.connection)
-                finally:
-                    lock.release()
                 break
 
-            request = payload.get("request", None)
-
-            if request in S.legal_requests:
-                content = payload.get("content", None)
-                pw = payload.get("password", u"")
-                if type(content) is S.legal_requests[request] and \
-                        type(pw) is S.legal_requests["password"]:
-                    lock.acquire()
-                    try: 
-                        if request == "login":
-                            S.handle_login(self.connection, content, password=pw)
-                        elif request == "logout":
-                            S.handle_logout(self.connection)
-                            break
-                        elif request == "message":
-                            S.handle_message(self.connection, content)
-                        elif request == "names":
-                            S.handle_names(self.connection)
-                        elif request == "help":
-                            S.handle_help(self.connection)
-                        elif request == "chatroom":
-                            S.handle_chatroom(self.connection, content)
-                        elif request == "info":
-                            S.handle_info(self.connection)
-                        elif request == "kick":
-                            S.handle_kick(self.connection, content)
-                        elif request == "ban":
-                            S.handle_ban(self.connection, content)
-                    except:
-                        pass
-                    finally:
-                        lock.release()
-                else:
-                    S.send_error(self.connection, "Invalid argument for request " + request)
+            for payload in payloads:
+                if not self.handle_payload(payload):
+                    return
+
+    def finish(self):
+        """Runs however handle() ended, so a client never stays logged in without a connection"""
+        Metrics.count('connections_closed')
+        S.handle_disconnect(self.connection)
+        S.unsubscribe(self.connection)
+        self.connection.close()
+        self.connection.writer.join(Outbox.DRAIN_TIMEOUT)
+
+    def handle_payload(self, payload):
+        """
+        Dispatches one decoded request. Returns False once the client has logged out.
+        """
+        if not isinstance(payload, dict):
+            S.send_error(self.connection, "Requests must be JSON objects")
+            return True
+        request = payload.get("request", None)
+
+        if isinstance(request, unicode) and request in S.legal_requests:
+            content = payload.get("content", None)
+            pw = payload.get("password", u"")
+            if isinstance(content, S.legal_requests[request]) and \
+                    type(pw) is S.legal_requests["password"]:
+                start = time.time()
+                try:
+                    if request == "login":
+                        S.handle_login(self.connection, content, password=pw)
+                    elif request == "logout":
+                        S.handle_logout(self.connection)
+                        return False
+                    elif request == "message":
+                        S.handle_message(self.connection, content)
+                    elif request == "names":
+                        S.handle_names(self.connection)
+                    elif request == "help":
+                        S.handle_help(self.connection)
+                    elif request == "chatroom":
+                        S.handle_chatroom(self.connection, content)
+                    elif request == "info":
+                        S.handle_info(self.connection)
+                    elif request == "kick":
+                        S.handle_kick(self.connection, content)
+                    elif request == "ban":
+                        S.handle_ban(self.connection, content)
+                    elif request == "history":
+                        S.handle_history(self.connection, content)
+                    elif request == "stats":
+                        S.handle_stats(self.connection)
+                    elif request == "subscribe":
+                        S.handle_subscribe(self.connection)
+                    elif request == "resume":
+                        S.handle_resume(self.connection, content, payload.get("seq", None))
+                except:
+                    pass
+                if request in latency:      # Not "password", which is no request of its own
+                    latency[request].record(time.time() - start)
             else:
-                S.send_error(self.connection, "Unknown request. See 'help' for legal requests")
+                S.send_error(self.connection, "Invalid argument for request " + request)
+        else:
+            S.send_error(self.connection, "Unknown request. See 'help' for legal requests")
+        return True
 
 
-class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+class ThreadedTCPServer(Admission.PoolMixIn, SocketServer.TCPServer):
     """
     This class is present so that each client connected will be ran as a own
-    thread. In that way, all clients will be served by the server.
-
-    No alterations are necessary
+    thread. In that way, all clients will be served by the server. Banned
+    addresses are refused before a thread or a Connection is made for them.
     """
     allow_reuse_address = True
+    request_queue_size = Admission.DEFAULT_BACKLOG
+    admission = Admission.Admission(banned = S.banned)
+    listener = None         # A listening socket to take over instead of binding one, see Handoff.py
+
+    def server_bind(self):
+        if self.listener is None:
+            SocketServer.TCPServer.server_bind(self)
+            return
+        self.socket.close()
+        self.socket = self.listener
+        self.socket.setblocking(1)
+        self.server_address = self.socket.getsockname()
+
+    def server_activate(self):
+        if self.listener is None:
+            SocketServer.TCPServer.server_activate(self)
+
+def hand_over(server, snapshotter):
+    """
+    Winds this server down for a new one that takes over its listening
+    socket, see Handoff.py. Its clients are closed and resume their
+    sessions on the new server, which gets them from the last snapshot.
+    """
+    server.shutdown()           # Stops accepting; connections wait in the backlog
+    Handoff.start_successor(server.socket)
+    S.close_all("The server is restarting, you will be reconnected")
+    deadline = time.time() + Outbox.DRAIN_TIMEOUT
+    while S.users and time.time() < deadline:
+        time.sleep(0.01)
+    snapshotter.stop()
+    snapshotter.take()
 
 if __name__ == "__main__":
     """
     This is the main method and is executed when you type "python Server.py"
-    in your terminal.
-
-    No alterations are necessary
+    in your terminal. "kill -USR2" it to restart it without refusing a
+    connection, see Handoff.py.
     """
     HOST, PORT = 'localhost', 9998
+    METRICS_PORT = 9999     # Local scrape endpoint, "curl localhost:9999"
+    SNAPSHOT = os.path.join("data", "snapshot")
+    logging.basicConfig(level = logging.INFO, format = "%(message)s")     # Snapshots and handoffs
     for line in open(".admins", "r"):
         u, p = line.split()
         S.admins[u] = p
     print str(len(S.admins)) + " admins loaded successfully."
+    ThreadedTCPServer.listener = Handoff.inherited_socket()
+    Handoff.wait_for_predecessor()
+    S.log_store = MessageLog.LogStore("data")
+    S.history["all"] = S.new_history("all")
+    try:
+        snapshot = Snapshot.load(SNAPSHOT)
+    except ValueError as e:
+        print str(e) + ", starting without it."
+        snapshot = None
+    if snapshot is not None:
+        S.restore_state(snapshot[0])
+        print "Snapshot loaded: %d rooms, %d bans, %d sessions." % (len(S.history), len(S.banned),
+                                                                    len(S.resume_tokens))
+    S.register_gauges()
+    Metrics.serve(METRICS_PORT)
+    Profiler.on_signal(commands = S.legal_requests)     # "kill -USR1" writes a profile to profiles/
     print 'Server running...'
 
     # Set up and initiate the TCP server
     server = ThreadedTCPServer((HOST, PORT), ClientHandler)
+    snapshotter = Snapshot.Snapshotter(SNAPSHOT, Snapshot.DEFAULT_INTERVAL, S.snapshot_state)
+    snapshotter.start()
+    handing_over = Thread(target = hand_over, args = (server, snapshotter), name = "Handoff")
+    Handoff.on_signal(lambda: handing_over.ident or handing_over.start())
     server.serve_forever()
+    if handing_over.ident:
+        handing_over.join()
+    S.log_store.close()